@@ -0,0 +1,118 @@
+"""
+This module parses config.ini once for all the modules of the project
+
+Every module used to parse config.ini again at import time; get_config parses it on the first call and hands
+the same ConfigParser to every later caller. The DEFAULT_PREDICTION_CONFIG environment variable points the
+project at another config file (e.g. per environment) without editing config.ini.
+
+PipelineSettings maps the config to the parameters of DefaultPredictor in one place, for main.py,
+predict_default_probability.py and batch_runner.py.
+"""
+import os
+from configparser import ConfigParser
+
+CONFIG_PATH = os.environ.get('DEFAULT_PREDICTION_CONFIG', 'config.ini')
+
+CONFIG = None
+
+
+def get_config(path=None):
+    global CONFIG
+    if path is not None:
+        config = ConfigParser()
+        config.read(path)
+        return config
+    if CONFIG is None:
+        CONFIG = ConfigParser()
+        CONFIG.read(CONFIG_PATH)
+    return CONFIG
+
+
+def get_list(value, cast=str):
+    return [cast(item) for item in value.split(",") if item]
+
+
+'''
+class: PipelineSettings
+Parameters: params -> the DefaultPredictor parameters, by name; from_config builds them from config.ini, and
+                      with resume checkpoints the run even when [CHECKPOINT] ENABLED is off
+Returns: the parameters as keyword arguments from as_kwargs; a copy with some of them changed from replace
+'''
+
+
+class PipelineSettings:
+    def __init__(self, **params):
+        self.params = params
+
+    @classmethod
+    def from_config(cls, config=None, resume=False):
+        config = get_config() if config is None else config
+        checkpoint = config.getboolean('CHECKPOINT', 'ENABLED') or resume
+        models, data, destination, query = config['MODELS'], config['DATA'], config['DESTINATION'], config['QUERY']
+        database = config['DATABASE']
+        return cls(model_path=get_list(models['ENSEMBLE']) or models['CLASSIFIER'],
+                   identifiers=get_list(data['IDENTIFIERS']),
+                   categorical=get_list(data['CATEGORICAL']),
+                   customer_rules=config.items('CUSTOMER'),
+                   scaler_path=models['SCALER'],
+                   sql=True,
+                   database={'user': database['USER'], 'password': database['PASSWORD'], 'host': database['HOST'],
+                             'port': int(database['PORT']), 'database': database['DATABASE']},
+                   input_path=data['PATH'],
+                   output_path=destination['PATH'],
+                   load_query=query['LOAD'] or None,
+                   table=destination['TABLE'],
+                   drop_query=query['DROP'],
+                   create_query=query['CREATE'],
+                   insert_query=query['INSERT'],
+                   write_mode=destination['WRITE_MODE'],
+                   write_chunk_size=int(destination['CHUNKSIZE']),
+                   chunk_size=int(data['CHUNKSIZE']),
+                   encoder_path=models['ENCODER'],
+                   compiled=config.getboolean('MODELS', 'COMPILED'),
+                   compiled_dtype=models['COMPILED_DTYPE'],
+                   compiled_trees=config.getboolean('MODELS', 'COMPILED_TREES'),
+                   aggregation=models['AGGREGATION'],
+                   weights=get_list(models['WEIGHTS'], float) or None,
+                   stacker_path=models['STACKER'] or None,
+                   n_jobs=int(models['WORKERS']),
+                   persist_mode=destination['MODE'],
+                   incremental=config.getboolean('INCREMENTAL', 'ENABLED'),
+                   store_path=config['INCREMENTAL']['STORE'],
+                   input_format=data['FORMAT'] or None,
+                   columns=get_list(data['COLUMNS']),
+                   schema_path=data['SCHEMA'] or None,
+                   metrics_path=config['METRICS']['REPORT'] or None,
+                   prometheus_path=config['METRICS']['PROMETHEUS'] or None,
+                   trace_memory=config.getboolean('METRICS', 'TRACEMALLOC'),
+                   output_format=destination['FORMAT'],
+                   output_compression=destination['COMPRESSION'] or None,
+                   partition_cols=get_list(destination['PARTITION_BY']),
+                   memory_lean=config.getboolean('MODELS', 'MEMORY_LEAN'),
+                   cache_path=config['CACHE']['PATH'] if config.getboolean('CACHE', 'ENABLED') else None,
+                   cache_ttl=float(config['CACHE']['TTL_HOURS']) * 3600,
+                   cache_max_entries=int(float(config['CACHE']['MAX_ENTRIES'])),
+                   pipelined=config.getboolean('PIPELINE', 'ENABLED'),
+                   queue_size=int(config['PIPELINE']['QUEUE_SIZE']),
+                   validation=config.getboolean('VALIDATION', 'ENABLED'),
+                   quarantine_path=config['VALIDATION']['QUARANTINE'] or None,
+                   checkpoint_path=config['CHECKPOINT']['PATH'] if checkpoint else None,
+                   resume=resume)
+
+    def replace(self, **changes):
+        return PipelineSettings(**dict(self.params, **changes))
+
+    def as_kwargs(self):
+        return dict(self.params)
+
+    def get(self, name, default=None):
+        return self.params.get(name, default)
+
+    def __getitem__(self, name):
+        return self.params[name]
+
+
+if __name__ == "__main__":
+    for section in get_config().sections():
+        print(section, dict(get_config().items(section)))
+    print(PipelineSettings.from_config().as_kwargs())
@@ -0,0 +1,224 @@
+"""
+This script runs the default prediction pipeline over many input files in parallel
+
+The input is a glob pattern or a partition directory; every data file found is one partition. The partitions are
+scored by DefaultPredictor.run_default_pipeline in the worker processes of a ProcessPoolExecutor, and the models
+are loaded once per worker (load_model.ARTIFACT_REGISTRY keeps them for the following partitions).
+
+The outputs are persisted per partition (one output file per partition, or upserted into the table so the
+partitions do not replace each other) or, with --merge, collected and persisted once by this process. A merged
+run persists nothing when a partition failed, so the previous output is not replaced by a partial one.
+The time, rows and status of every partition are logged and can be written to a JSON report.
+
+Usage: python batch_runner.py <glob or directory> [--workers N] [--merge] [--report report.json] [--resume]
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from app_config import get_config, PipelineSettings
+from datetime import date
+import numpy as np
+import pandas as pd
+from predict_default_probability import DefaultPredictor
+from ingest_data import FILE_FORMATS
+from load_model import Model
+from score_store import ScoreStore
+
+logging.basicConfig(level=logging.DEBUG)
+logging.info('Executing the script as a standalone')
+
+'''
+Read Config File
+'''
+config = get_config()
+WORKERS = int(config['BATCH']['WORKERS'])
+MERGE = config.getboolean('BATCH', 'MERGE')
+
+REPORT_KEYS = ('partition', 'status', 'rows', 'seconds', 'error', 'stages')
+
+
+def get_partitions(source):
+    if os.path.isdir(source):
+        paths = glob.glob(os.path.join(source, '**', '*'), recursive=True)
+    else:
+        paths = glob.glob(source, recursive=True)
+    return sorted(path for path in paths
+                  if os.path.isfile(path) and os.path.splitext(path)[1].lower() in FILE_FORMATS)
+
+
+def get_partition_name(path, source):
+    # partition directories usually repeat the file names (date=.../part-0.csv), so the name keeps the directories
+    root = source if os.path.isdir(source) else os.path.dirname(source.split('*')[0])
+    name = os.path.splitext(os.path.relpath(path, root or '.'))[0]
+    return str(date.today()) + '_' + name.replace(os.sep, '_').replace('=', '-')
+
+
+def get_artifact_paths(settings):
+    paths = list(settings['model_path']) if isinstance(settings['model_path'], (list, tuple)) \
+        else [settings['model_path']]
+    paths += [settings.get(key) for key in ('scaler_path', 'encoder_path', 'stacker_path')]
+    return [path for path in paths if path and os.path.exists(path)]
+
+
+def load_worker_artifacts(paths):
+    for path in paths:
+        Model(path).load_model()
+
+
+'''
+function: score_partition
+Parameters: input_path -> string value; path of the partition file
+            output_name -> string value; output file name of the partition
+            settings -> app_config.PipelineSettings of the DefaultPredictor parameters
+            persist -> persist the outputs in the worker, or return them to be merged
+Returns: dict object with the partition, status (0 or -1), rows, seconds, error and stage metrics, plus the output data,
+         the scored loans and their row hashes when persist is False
+'''
+
+
+def score_partition(input_path, output_name, settings, persist=True):
+    start = time.perf_counter()
+    result = {'partition': input_path, 'status': -1, 'rows': 0, 'seconds': None, 'error': None, 'stages': None}
+    try:
+        pipeline = DefaultPredictor.from_settings(settings, input_path=input_path, output_name=output_name)
+        result['status'] = pipeline.run_default_pipeline(persist=persist)
+        if result['status'] != 0:
+            result['error'] = "run_default_pipeline failed, check the log of the worker"
+        result['stages'] = pipeline.instrumentation.get_report()['stages']
+        if pipeline.output_data is not None:
+            result['rows'] = len(pipeline.output_data)
+        if not persist and result['status'] == 0 and pipeline.output_data is not None:
+            result['output'] = pipeline.output_data
+            if pipeline.incremental:
+                result['scored'] = pipeline.input_data
+                result['row_hashes'] = pipeline.row_hashes
+    except Exception as e:
+        result['error'] = str(e)
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+"""
+class: BatchRunner
+Parameters: source -> glob pattern or partition directory of the input files
+            settings -> app_config.PipelineSettings of the DefaultPredictor parameters, from the config by default
+            workers -> number of worker processes; the number of CPUs when 0 or None
+            merge -> persist the outputs of all the partitions once instead of per partition; nothing is persisted
+                     when a partition failed, so the previous output is kept whole
+Returns: 0 when every partition succeeded and -1 otherwise from run; the per partition results are in self.results
+"""
+
+
+class BatchRunner:
+    def __init__(self, source, settings=None, workers=None, merge=False):
+        self.source = source
+        self.settings = settings if settings is not None else PipelineSettings.from_config()
+        self.workers = workers or os.cpu_count()
+        self.merge = merge
+        self.results = []
+        self.report = None
+
+    def get_partition_settings(self):
+        # the run reports of the partitions are part of the batch report instead of overwriting each other
+        settings = self.settings.replace(metrics_path=None, prometheus_path=None)
+        if self.merge:
+            settings = settings.replace(chunk_size=None)
+        elif settings.get('database') and settings.get('persist_mode') != 'upsert':
+            logging.info("Upserting the partitions into the table so they do not replace each other")
+            settings = settings.replace(persist_mode='upsert')
+        return settings
+
+    def run_partitions(self, partitions):
+        settings = self.get_partition_settings()
+        with ProcessPoolExecutor(max_workers=min(self.workers, len(partitions)), initializer=load_worker_artifacts,
+                                 initargs=(get_artifact_paths(settings),)) as executor:
+            futures = [executor.submit(score_partition, path, get_partition_name(path, self.source), settings,
+                                       not self.merge) for path in partitions]
+            for future in as_completed(futures):
+                result = future.result()
+                if result['status'] == 0:
+                    logging.info("Scored %s: %d rows in %.2fs", result['partition'], result['rows'], result['seconds'])
+                else:
+                    logging.error("Failed to score %s: %s", result['partition'], result['error'])
+                self.results.append(result)
+        self.results.sort(key=lambda partition_result: partition_result['partition'])
+
+    def persist_merged_outputs(self):
+        outputs = [result['output'] for result in self.results if 'output' in result]
+        if not outputs:
+            logging.info("There are no outputs to persist")
+            return 0
+        pipeline = DefaultPredictor.from_settings(self.settings)
+        pipeline.output_data = pd.concat(outputs, ignore_index=True)
+        if pipeline.run_persist_data() != 0:
+            return -1
+        if pipeline.incremental:
+            scored = [result for result in self.results if 'scored' in result]
+            store = ScoreStore(pipeline.store_path, pipeline.get_model_version())
+            store.record_scored_rows(pd.concat([result['scored'] for result in scored]),
+                                     np.concatenate([result['row_hashes'] for result in scored]))
+            store.close()
+        return 0
+
+    def get_report(self, seconds):
+        failed = [result['partition'] for result in self.results if result['status'] != 0]
+        rows = sum(result['rows'] for result in self.results)
+        return {'source': self.source,
+                'workers': self.workers,
+                'merge': self.merge,
+                'seconds': seconds,
+                'rows': rows,
+                'rows_per_second': rows / seconds if seconds > 0 else 0.0,
+                'failed': failed,
+                'partitions': [{key: result[key] for key in REPORT_KEYS} for result in self.results]}
+
+    def run(self):
+        start = time.perf_counter()
+        status = 0
+        try:
+            partitions = get_partitions(self.source)
+            if not partitions:
+                logging.error("No input files were found for " + self.source)
+                return -1
+            logging.info("Scoring %d partitions with %d workers", len(partitions), self.workers)
+            self.run_partitions(partitions)
+            if any(result['status'] != 0 for result in self.results):
+                status = -1
+            if self.merge and status != 0:
+                # the merged outputs would replace the previous output without the rows of the failed partitions
+                logging.error("Not persisting the merged outputs because partitions failed, the previous output is "
+                              "kept")
+            elif self.merge and self.persist_merged_outputs() != 0:
+                logging.error("Failed to persist the merged outputs")
+                status = -1
+        except Exception as e:
+            logging.error("Failed to run the batch. Check the error below")
+            logging.error(e)
+            status = -1
+        self.report = self.get_report(time.perf_counter() - start)
+        logging.info("Scored %d rows from %d partitions in %.2fs, %d partitions failed", self.report['rows'],
+                     len(self.results), self.report['seconds'], len(self.report['failed']))
+        return status
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score many input files in parallel")
+    parser.add_argument('source', help="glob pattern or partition directory of the input files")
+    parser.add_argument('--workers', type=int, default=WORKERS, help="number of worker processes")
+    parser.add_argument('--merge', action='store_true', default=MERGE,
+                        help="persist the outputs of all the partitions once")
+    parser.add_argument('--report', help="path of the JSON report of the partition timings and failures")
+    parser.add_argument('--resume', action='store_true',
+                        help="resume the failed partitions after their last checkpoint")
+    args = parser.parse_args()
+    runner = BatchRunner(args.source, settings=PipelineSettings.from_config(resume=args.resume),
+                         workers=args.workers, merge=args.merge)
+    batch_status = runner.run()
+    if args.report:
+        with open(args.report, 'w') as report_file:
+            json.dump(runner.report, report_file, indent=2)
+    raise SystemExit(0 if batch_status == 0 else 1)
@@ -0,0 +1,429 @@
+"""
+This module benchmarks the pipeline stages against their previous implementations
+
+The stages mode runs DataLoader, DataPreprocessor, Classifier, TierClassifier, PostProcessor and DataPersister
+(file mode) on synthetic data of growing sizes, records the throughput and memory of every stage to a results file
+and compares them to a saved baseline.
+
+The memory mode runs the pipeline (without persisting) on a synthetic input of MEMORY_ROWS rows in a fresh process
+and checks the peak RSS of the memory lean mode against the MEMORY_LEAN_PEAK_MB target.
+
+The trees mode scores synthetic features with the tree models through predict_proba and through the compiled
+node arrays (infer.CompiledTreeEnsemble) for batches of growing sizes, after checking both give the same
+probabilities.
+
+The pipelined mode runs the chunked pipeline on a synthetic input of PIPELINE_ROWS rows sequentially and then
+with the reads and writes overlapping the scoring (chunk_pipeline.ChunkPipeline), and compares the wall times.
+
+The imports mode measures how long importing the pipeline takes in a fresh interpreter and fails when a heavy
+module (plotting, DB driver, model libraries) is imported before a code path needs it.
+
+Usage: python benchmark.py [implementations|stages|memory|trees|pipelined|imports] [--sizes 1000,10000]
+                            [--save-baseline] [--compare]
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from app_config import get_config
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from get_customer_tier import TierClassifier
+from prepare_input_data import CategoricalEncoder, DataPreprocessor
+from ingest_data import DataLoader, get_schema_dtypes
+from infer import Classifier, CompiledTreeEnsemble
+from prepare_output_data import PostProcessor
+from persist_data import DataPersister
+from instrumentation import PipelineInstrumentation
+from load_model import Model
+from synthetic_data import SyntheticLoanGenerator
+from predict_default_probability import DefaultPredictor
+
+logging.basicConfig(level=logging.INFO)
+logging.info('Executing the script as a standalone')
+
+'''
+Read Config File
+'''
+config = get_config()
+CUSTOMER = config.items('CUSTOMER')
+DATA = config['DATA']['PATH']
+CATEGORICAL = config.get('DATA', 'CATEGORICAL').split(",")
+IDENTIFIERS = config.get('DATA', 'IDENTIFIERS').split(",")
+COLUMNS = config.get('DATA', 'COLUMNS').split(",")
+CREATE_QUERY = config['QUERY']['CREATE']
+CLASSIFIER = config['MODELS']['CLASSIFIER']
+SCALER = config['MODELS']['SCALER']
+SIZES = [int(float(size)) for size in config['BENCHMARK']['SIZES'].split(",")]
+WORK_DIR = config['BENCHMARK']['WORK_DIR']
+RESULTS = config['BENCHMARK']['RESULTS']
+BASELINE = config['BENCHMARK']['BASELINE']
+TOLERANCE = float(config['BENCHMARK']['TOLERANCE'])
+TRACEMALLOC = config.getboolean('BENCHMARK', 'TRACEMALLOC')
+IMPORT_BUDGET = float(config['BENCHMARK']['IMPORT_BUDGET'])
+MEMORY_ROWS = int(float(config['BENCHMARK']['MEMORY_ROWS']))
+MEMORY_LEAN_PEAK_MB = float(config['BENCHMARK']['MEMORY_LEAN_PEAK_MB'])
+TREE_MODELS = config['BENCHMARK']['TREE_MODELS'].split(",")
+TREE_SIZES = [int(float(size)) for size in config['BENCHMARK']['TREE_SIZES'].split(",")]
+WORKERS = int(config['MODELS']['WORKERS'])
+PIPELINE_ROWS = int(float(config['BENCHMARK']['PIPELINE_ROWS']))
+PIPELINE_CHUNKSIZE = int(float(config['BENCHMARK']['PIPELINE_CHUNKSIZE']))
+OUTPUT_FORMAT = config['DESTINATION']['FORMAT']
+OUTPUT_COMPRESSION = config['DESTINATION']['COMPRESSION']
+
+LAZY_MODULES = ['matplotlib', 'mysql', 'sklearn', 'scipy']  # pyarrow is left out, pandas imports it itself
+IMPORT_CHECK = "import sys, time; start = time.perf_counter(); import {module}; " \
+               "print(time.perf_counter() - start); print(','.join(sorted(sys.modules)))"
+
+
+def time_call(func, repeat=3):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+'''
+function: benchmark_tier_engine
+Parameters: data -> pandas DataFrame with the rule columns
+            rules -> list of (column, "high,low,less|more") tuples
+            repeat -> number of timed runs, the best run is reported
+Returns: dict with the timings of the row-wise and vectorized rule engines
+'''
+
+
+def benchmark_tier_engine(data, rules, repeat=3):
+    row_wise_time, row_wise_tiers = time_call(lambda: TierClassifier(data, rules).rule_engine(vectorized=False),
+                                              repeat)
+    vectorized_time, vectorized_tiers = time_call(lambda: TierClassifier(data, rules).rule_engine(vectorized=True),
+                                                  repeat)
+    if not row_wise_tiers.equals(vectorized_tiers):
+        raise AssertionError("The vectorized tiers do not match the row-wise tiers")
+    results = {'rows': len(data),
+               'row_wise_seconds': row_wise_time,
+               'vectorized_seconds': vectorized_time,
+               'speedup': row_wise_time / vectorized_time}
+    logging.info("Tier engine on %d rows: row-wise %.4fs, vectorized %.4fs, speedup %.1fx",
+                 results['rows'], row_wise_time, vectorized_time, results['speedup'])
+    return results
+
+
+def encode_categorical_row_wise(data, encoder):
+    for col, levels in encoder.levels.items():
+        data[col] = data[col].apply(lambda x: levels.index(x) + 1 if x in levels else 0)
+    return data
+
+
+'''
+function: benchmark_categorical_encoding
+Parameters: data -> pandas DataFrame with the categorical columns
+            categorical -> list object of the categorical columns
+            repeat -> number of timed runs, the best run is reported
+Returns: dict with the timings of the per value apply and the vectorized CategoricalEncoder
+'''
+
+
+def benchmark_categorical_encoding(data, categorical, repeat=3):
+    encoder = CategoricalEncoder.from_config(categorical)
+    copies = [data[categorical].copy() for _ in range(2 * repeat)]
+    row_wise_time, row_wise_data = time_call(lambda: encode_categorical_row_wise(copies.pop(), encoder), repeat)
+    vectorized_time, vectorized_data = time_call(lambda: encoder.transform(copies.pop()), repeat)
+    if not row_wise_data.equals(vectorized_data):
+        raise AssertionError("The vectorized encoding does not match the row-wise encoding")
+    results = {'rows': len(data),
+               'row_wise_seconds': row_wise_time,
+               'vectorized_seconds': vectorized_time,
+               'speedup': row_wise_time / vectorized_time}
+    logging.info("Categorical encoding on %d rows: row-wise %.4fs, vectorized %.4fs, speedup %.1fx",
+                 results['rows'], row_wise_time, vectorized_time, results['speedup'])
+    return results
+
+
+'''
+function: benchmark_stages
+Parameters: input_path -> string value; path of the input file, e.g. written by SyntheticLoanGenerator
+            output_dir -> string value; directory the DataPersister output file is written to
+            trace_memory -> trace the Python allocations of every stage with tracemalloc (slower)
+Returns: dict with the rows and the wall time, CPU time, rows/sec and memory of every stage
+         (peak RSS is the peak of the process so far, so it only grows from one size to the next)
+'''
+
+
+def benchmark_stages(input_path, output_dir, trace_memory=False):
+    instrumentation = PipelineInstrumentation(name='benchmark', trace_memory=trace_memory)
+    instrumentation.start()
+    with instrumentation.stage('load') as counts:
+        data = DataLoader(file_path=input_path, columns=COLUMNS, dtypes=get_schema_dtypes(CREATE_QUERY)).load_data()
+        counts['rows'] = len(data)
+    with instrumentation.stage('prepare_input') as counts:
+        transformed_data = DataPreprocessor(data=data, scaler_path=SCALER, identifiers=IDENTIFIERS,
+                                            categorical=CATEGORICAL).prepare_data()
+        counts['rows'] = len(transformed_data)
+    with instrumentation.stage('infer') as counts:
+        predictions = Classifier(data=transformed_data, model_path=CLASSIFIER).infer_data()
+        counts['rows'] = len(predictions)
+    with instrumentation.stage('customer_tier') as counts:
+        tiers = TierClassifier(data, CUSTOMER).rule_engine()
+        counts['rows'] = len(tiers)
+    with instrumentation.stage('prepare_output') as counts:
+        output_data = PostProcessor(data=data, predictions=predictions, tiers=tiers).combine_data()
+        counts['rows'] = len(output_data)
+    with instrumentation.stage('persist') as counts:
+        file_name = 'benchmark_' + str(len(data))
+        if DataPersister(output_data, path=os.path.join(output_dir, ''), file_name=file_name).persist() != 0:
+            raise RuntimeError("The benchmark output could not be persisted")
+        counts['rows'] = len(output_data)
+    instrumentation.stop(0)
+    results = {'rows': len(data), 'stages': list(instrumentation.stages.values())}
+    for stage in results['stages']:
+        logging.info("%s on %d rows: %.4fs, %.0f rows/sec", stage['stage'], stage['rows'], stage['wall_seconds'],
+                     stage['rows_per_second'] or 0)
+    return results
+
+
+def run_stage_benchmarks(sizes, work_dir, trace_memory=False):
+    for path in [SCALER, CLASSIFIER]:  # loaded once up front so the first size does not pay for it
+        Model(path).load_model()
+    runs = []
+    for rows in sizes:
+        runs.append(benchmark_stages(get_synthetic_input(rows, work_dir), work_dir, trace_memory=trace_memory))
+    return {'started_at': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'machine': platform.machine(),
+            'runs': runs}
+
+
+'''
+function: compare_to_baseline
+Parameters: results -> dict from run_stage_benchmarks
+            baseline -> dict from an earlier run_stage_benchmarks
+            tolerance -> fraction of the baseline throughput a stage may lose before it is reported as a regression
+Returns: list of dicts with the rows, stage and throughputs of the stages slower than the baseline
+'''
+
+
+def compare_to_baseline(results, baseline, tolerance=0.2):
+    baseline_throughput = {(run['rows'], stage['stage']): stage['rows_per_second']
+                           for run in baseline['runs'] for stage in run['stages']}
+    regressions = []
+    for run in results['runs']:
+        for stage in run['stages']:
+            expected = baseline_throughput.get((run['rows'], stage['stage']))
+            if not expected or stage['rows_per_second'] is None:
+                continue
+            change = stage['rows_per_second'] / expected - 1
+            logging.info("%s on %d rows: %.0f rows/sec, %+.1f%% against the baseline", stage['stage'], run['rows'],
+                         stage['rows_per_second'], 100 * change)
+            if change < -tolerance:
+                regressions.append({'rows': run['rows'], 'stage': stage['stage'],
+                                    'baseline_rows_per_second': expected,
+                                    'rows_per_second': stage['rows_per_second']})
+    for regression in regressions:
+        logging.warning("Regression: %s on %d rows dropped from %.0f to %.0f rows/sec", regression['stage'],
+                        regression['rows'], regression['baseline_rows_per_second'], regression['rows_per_second'])
+    return regressions
+
+
+'''
+function: benchmark_imports
+Parameters: module -> name of the module to import
+            repeat -> number of fresh interpreters the import is timed in, the best run is reported
+Returns: dict with the import time and the heavy modules (LAZY_MODULES) the import pulled in
+'''
+
+
+def benchmark_imports(module='predict_default_probability', repeat=5):
+    best = None
+    loaded = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', IMPORT_CHECK.format(module=module)], capture_output=True,
+                                text=True, check=True).stdout.splitlines()
+        seconds, modules = float(output[-2]), output[-1].split(',')
+        best = seconds if best is None else min(best, seconds)
+        loaded = sorted({name.split('.')[0] for name in modules if name.split('.')[0] in LAZY_MODULES})
+    results = {'module': module, 'seconds': best, 'heavy_modules': loaded}
+    logging.info("Importing %s takes %.3fs, heavy modules imported: %s", module, best, ", ".join(loaded) or "none")
+    return results
+
+
+def get_synthetic_input(rows, work_dir):
+    input_path = os.path.join(work_dir, 'synthetic_' + str(rows) + '.csv')
+    if not os.path.exists(input_path):  # the generated inputs are reused by the following runs
+        SyntheticLoanGenerator().write(input_path, rows)
+    return input_path
+
+
+def measure_pipeline_memory(input_path, memory_lean):
+    pipeline = DefaultPredictor(CLASSIFIER, IDENTIFIERS, CATEGORICAL, CUSTOMER, SCALER, sql=False,
+                                input_path=input_path, output_path=WORK_DIR, create_query=CREATE_QUERY,
+                                columns=COLUMNS, memory_lean=memory_lean)
+    status = pipeline.run_default_pipeline(persist=False)
+    report = pipeline.instrumentation.get_report()
+    return {'memory_lean': memory_lean,
+            'status': status,
+            'rows': len(pipeline.output_data) if pipeline.output_data is not None else 0,
+            'wall_seconds': report['wall_seconds'],
+            'peak_rss_mb': report['peak_rss_bytes'] / 2 ** 20 if report['peak_rss_bytes'] else None,
+            'output_mb': pipeline.output_data.memory_usage(deep=True).sum() / 2 ** 20
+            if pipeline.output_data is not None else None}
+
+
+'''
+function: benchmark_memory
+Parameters: rows -> number of rows of the synthetic input
+            work_dir -> directory of the synthetic inputs
+            modes -> list of memory_lean values to measure
+Returns: list of dicts with the peak RSS, time and output size of every mode, each measured in a fresh process
+         (a forked process would report the peak RSS of this one)
+'''
+
+
+def benchmark_memory(rows, work_dir, modes=(True,)):
+    input_path = get_synthetic_input(rows, work_dir)
+    results = []
+    for memory_lean in modes:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            try:
+                result = executor.submit(measure_pipeline_memory, input_path, memory_lean).result()
+            except BrokenProcessPool:
+                result = {'memory_lean': memory_lean, 'status': -1, 'rows': rows, 'peak_rss_mb': None,
+                          'error': "the process died, most likely out of memory"}
+        logging.info("Memory on %d rows (memory_lean=%s): peak RSS %s MB", rows, memory_lean,
+                     "%.0f" % result['peak_rss_mb'] if result.get('peak_rss_mb') else "unknown")
+        results.append(result)
+    return results
+
+
+'''
+function: benchmark_compiled_trees
+Parameters: model_paths -> list of paths of the saved tree models
+            sizes -> list of numbers of rows scored in one batch
+            n_jobs -> number of threads of the compiled models
+            repeat -> number of timed runs, the best run is reported
+Returns: list of dicts with the predict_proba and compiled timings of every model and size
+'''
+
+
+def benchmark_compiled_trees(model_paths, sizes, n_jobs=None, repeat=3):
+    scaler = Model(SCALER).load_model()
+    data = SyntheticLoanGenerator().generate(max(sizes))
+    features = DataPreprocessor(data=data, scaler_path=SCALER, identifiers=IDENTIFIERS,
+                                categorical=CATEGORICAL).get_feature_matrix(np.float64)
+    results = []
+    for path in model_paths:
+        model = Model(path).load_model()
+        compiled_model = CompiledTreeEnsemble.compile(scaler, model, n_jobs=n_jobs)
+        if not compiled_model.validate(features, scaler, model):
+            raise AssertionError("The compiled " + path + " does not match predict_proba")
+        for rows in sizes:
+            scaled = scaler.transform(features[:rows])
+            sklearn_time, _ = time_call(lambda: model.predict_proba(scaled), repeat)
+            compiled_time, _ = time_call(lambda: compiled_model.predict_positive(features[:rows]), repeat)
+            results.append({'model': path, 'rows': rows, 'predict_proba_seconds': sklearn_time,
+                            'compiled_seconds': compiled_time, 'speedup': sklearn_time / compiled_time})
+            logging.info("%s on %d rows: predict_proba %.4fs, compiled %.4fs, speedup %.1fx", path, rows,
+                         sklearn_time, compiled_time, sklearn_time / compiled_time)
+    return results
+
+
+'''
+function: benchmark_pipelined
+Parameters: rows -> number of rows of the synthetic input
+            work_dir -> directory of the synthetic inputs and of the outputs
+            chunk_size -> number of rows of a chunk
+            repeat -> number of timed runs, the best run is reported
+Returns: dict with the wall time of the sequential and the pipelined chunked runs
+'''
+
+
+def benchmark_pipelined(rows, work_dir, chunk_size, repeat=1):
+    input_path = get_synthetic_input(rows, work_dir)
+    for path in [SCALER, CLASSIFIER]:
+        Model(path).load_model()
+    seconds = {}
+    for pipelined in (False, True):
+        pipeline = DefaultPredictor(CLASSIFIER, IDENTIFIERS, CATEGORICAL, CUSTOMER, SCALER, sql=False,
+                                    input_path=input_path, output_path=os.path.join(work_dir, ''),
+                                    output_name='pipelined_' + str(rows), create_query=CREATE_QUERY,
+                                    columns=COLUMNS, chunk_size=chunk_size, output_format=OUTPUT_FORMAT,
+                                    output_compression=OUTPUT_COMPRESSION or None, pipelined=pipelined)
+        seconds[pipelined], status = time_call(pipeline.run_default_pipeline, repeat)
+        if status != 0:
+            raise RuntimeError("The benchmark pipeline failed (pipelined=" + str(pipelined) + ")")
+    results = {'rows': rows, 'chunk_size': chunk_size, 'output_format': OUTPUT_FORMAT,
+               'compression': OUTPUT_COMPRESSION or None, 'sequential_seconds': seconds[False],
+               'pipelined_seconds': seconds[True], 'speedup': seconds[False] / seconds[True]}
+    logging.info("Chunked pipeline on %d rows: sequential %.2fs, pipelined %.2fs, speedup %.2fx", rows,
+                 seconds[False], seconds[True], results['speedup'])
+    return results
+
+
+def save_json(path, payload):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'w') as json_file:
+        json.dump(payload, json_file, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages")
+    parser.add_argument('mode', nargs='?', default='implementations',
+                        choices=['implementations', 'stages', 'memory', 'trees', 'pipelined', 'imports'],
+                        help="compare against the previous implementations, benchmark every stage by size, "
+                             "check the peak memory of the memory lean mode, compare the compiled tree models "
+                             "to predict_proba, compare the pipelined and sequential chunked runs or check the "
+                             "import time")
+    parser.add_argument('--sizes', help="comma separated numbers of rows, e.g. 1e3,1e5")
+    parser.add_argument('--save-baseline', action='store_true', help="save the results as the new baseline")
+    parser.add_argument('--compare', action='store_true', help="also measure the memory of the default mode")
+    args = parser.parse_args()
+    if args.mode == 'implementations':
+        data_ = pd.read_csv(DATA)
+        for factor in [1, 10, 100]:
+            benchmark_tier_engine(pd.concat([data_] * factor, ignore_index=True), CUSTOMER)
+        for factor in [1, 100, 10000]:
+            benchmark_categorical_encoding(pd.concat([data_] * factor, ignore_index=True), CATEGORICAL)
+    elif args.mode == 'memory':
+        rows_ = int(float(args.sizes.split(",")[0])) if args.sizes else MEMORY_ROWS
+        memory_results = benchmark_memory(rows_, WORK_DIR, modes=(True, False) if args.compare else (True,))
+        lean_peak = memory_results[0]['peak_rss_mb']
+        if memory_results[0]['status'] != 0 or lean_peak is None or lean_peak > MEMORY_LEAN_PEAK_MB:
+            logging.warning("The memory lean mode is over the target of %.0f MB", MEMORY_LEAN_PEAK_MB)
+            raise SystemExit(1)
+    elif args.mode == 'trees':
+        sizes = [int(float(size)) for size in args.sizes.split(",")] if args.sizes else TREE_SIZES
+        benchmark_compiled_trees(TREE_MODELS, sizes, n_jobs=WORKERS)
+    elif args.mode == 'pipelined':
+        rows_ = int(float(args.sizes.split(",")[0])) if args.sizes else PIPELINE_ROWS
+        benchmark_pipelined(rows_, WORK_DIR, PIPELINE_CHUNKSIZE)
+    elif args.mode == 'imports':
+        import_results = benchmark_imports()
+        if import_results['heavy_modules'] or import_results['seconds'] > IMPORT_BUDGET:
+            logging.warning("The import of the pipeline is over the budget of %.2fs or imports heavy modules",
+                            IMPORT_BUDGET)
+            raise SystemExit(1)
+    else:
+        sizes = [int(float(size)) for size in args.sizes.split(",")] if args.sizes else SIZES
+        stage_results = run_stage_benchmarks(sizes, WORK_DIR, trace_memory=TRACEMALLOC)
+        save_json(RESULTS, stage_results)
+        if args.save_baseline:
+            save_json(BASELINE, stage_results)
+        elif os.path.exists(BASELINE):
+            with open(BASELINE, 'r') as baseline_file:
+                if compare_to_baseline(stage_results, json.load(baseline_file), TOLERANCE):
+                    raise SystemExit(1)
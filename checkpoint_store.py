@@ -0,0 +1,190 @@
+"""
+This module keeps the checkpoints of a pipeline run, so a failed run can be resumed where it stopped
+
+A run is identified by a key: the hash of its input (the file contents, or the load query for a database) and of
+the models, rules and settings it runs with. The checkpoints of a run are kept in <path>/<key>/: one file per
+stage output (parquet for data frames and series, npy for arrays) and a manifest.json of the completed stages and
+the committed chunks. The files are written under a temporary name and renamed in and the manifest is written last,
+so a stage is either checkpointed completely or not at all.
+
+A whole run resumes after its last checkpointed stage. A chunked run resumes after its last committed chunk: the
+chunks before it are read and skipped, and the output files are cut back to what they were at that commit so the
+rows of a chunk that failed half way are not written twice.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import numpy as np
+import pandas as pd
+from app_config import get_config
+from instrumentation import write_atomically
+
+logging.basicConfig(level=logging.DEBUG)
+logging.info('Executing the script as a standalone')
+
+'''
+Read Config File
+'''
+config = get_config()
+CHECKPOINTS = config['CHECKPOINT']['PATH']
+
+MANIFEST = 'manifest.json'
+TEMP_SUFFIX = '.tmp'
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def get_input_hash(input_path=None, query=None):
+    # a database input is identified by its query, so a resumed run assumes the table did not change in between
+    input_hash = hashlib.sha256()
+    if input_path and os.path.isdir(input_path):
+        paths = sorted(os.path.join(root, name) for root, _, names in os.walk(input_path) for name in names)
+    else:
+        paths = [input_path] if input_path else []
+    for path in paths:
+        input_hash.update(os.path.relpath(path, input_path).encode('utf-8'))
+        with open(path, 'rb') as input_file:
+            for block in iter(lambda: input_file.read(HASH_BLOCK_SIZE), b''):
+                input_hash.update(block)
+    input_hash.update(repr(query).encode('utf-8'))
+    return input_hash.hexdigest()[:16]
+
+
+def get_output_mark(path):
+    # what a file output (its size) or a directory output (its files) holds at the time of a commit
+    if os.path.isdir(path):
+        return {'files': sorted(os.path.relpath(os.path.join(root, name), path)
+                                for root, _, names in os.walk(path) for name in names)}
+    if os.path.isfile(path):
+        return {'size': os.path.getsize(path)}
+    return None
+
+
+def restore_output_mark(path, mark):
+    # False when the output no longer holds what was committed, so the run has to start over
+    if mark is None:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+        return True
+    current = get_output_mark(path)
+    if current is None or set(mark) != set(current):
+        return False
+    if 'size' in mark:
+        if current['size'] < mark['size']:
+            return False
+        with open(path, 'r+b') as output_file:
+            output_file.truncate(mark['size'])
+        return True
+    if not set(mark['files']).issubset(current['files']):
+        return False
+    for name in set(current['files']) - set(mark['files']):
+        os.remove(os.path.join(path, name))
+    return True
+
+
+'''
+class: CheckpointStore
+Parameters: path -> string value; directory the checkpoints of all the runs are kept in
+            key -> string value; identifies the run, e.g. from get_model_version over the input hash and settings
+Returns: True when there is a checkpoint to resume from load, and the saved stage outputs from get_outputs
+'''
+
+
+class CheckpointStore:
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        self.directory = os.path.join(path, key)
+        self.manifest = self.get_empty_manifest()
+
+    def get_empty_manifest(self):
+        return {'key': self.key, 'stages': [], 'outputs': {}, 'chunks': 0, 'marks': None}
+
+    def get_manifest_path(self):
+        return os.path.join(self.directory, MANIFEST)
+
+    def load(self):
+        if not os.path.exists(self.get_manifest_path()):
+            return False
+        with open(self.get_manifest_path(), 'r') as manifest_file:
+            self.manifest = json.load(manifest_file)
+        return bool(self.manifest['stages'] or self.manifest['chunks'])
+
+    def reset(self):
+        self.remove()
+        os.makedirs(self.directory, exist_ok=True)
+        self.manifest = self.get_empty_manifest()
+
+    def remove(self):
+        if os.path.isdir(self.directory):
+            shutil.rmtree(self.directory)
+
+    def write_manifest(self):
+        write_atomically(self.get_manifest_path(), json.dumps(self.manifest, indent=2))
+
+    def write_output(self, name, value):
+        if isinstance(value, pd.DataFrame):
+            kind, file_name = 'frame', name + '.parquet'
+        elif isinstance(value, pd.Series):
+            kind, file_name = 'series', name + '.parquet'
+        else:
+            kind, file_name = 'array', name + '.npy'
+        temp_path = os.path.join(self.directory, file_name + TEMP_SUFFIX)
+        if kind == 'frame':
+            value.to_parquet(temp_path)
+        elif kind == 'series':
+            value.to_frame('values').to_parquet(temp_path)
+        else:
+            with open(temp_path, 'wb') as array_file:
+                np.save(array_file, np.asarray(value))
+        os.replace(temp_path, os.path.join(self.directory, file_name))
+        return {'file': file_name, 'kind': kind, 'name': value.name if kind == 'series' else None}
+
+    def read_output(self, output):
+        path = os.path.join(self.directory, output['file'])
+        if output['kind'] == 'frame':
+            return pd.read_parquet(path)
+        if output['kind'] == 'series':
+            return pd.read_parquet(path)['values'].rename(output['name'])
+        return np.load(path)
+
+    def save_stage(self, stage, outputs):
+        # outputs is a dict of the values the stages after this one need; None values are not saved
+        for name, value in outputs.items():
+            if value is not None:
+                self.manifest['outputs'][name] = self.write_output(name, value)
+        self.manifest['stages'].append(stage)
+        self.write_manifest()
+        logging.info("Checkpointed the %s stage of run %s", stage, self.key)
+
+    def get_last_stage(self):
+        return self.manifest['stages'][-1] if self.manifest['stages'] else None
+
+    def get_outputs(self):
+        return {name: self.read_output(output) for name, output in self.manifest['outputs'].items()}
+
+    def commit_chunks(self, chunks, marks=None):
+        # chunks input chunks are done; marks holds what every output looked like right after them
+        self.manifest['chunks'] = chunks
+        self.manifest['marks'] = marks
+        self.write_manifest()
+        logging.info("Committed %d chunks of run %s", chunks, self.key)
+
+    def get_committed_chunks(self):
+        return self.manifest['chunks']
+
+    def get_marks(self):
+        return self.manifest['marks']
+
+
+if __name__ == "__main__":
+    checkpoint = CheckpointStore(CHECKPOINTS, get_input_hash(query='standalone'))
+    checkpoint.reset()
+    checkpoint.save_stage('infer', {'predictions': np.random.default_rng(0).random(5),
+                                    'customer_tiers': pd.Series(['A', 'B', 'C', 'A', 'B'])})
+    resumed = CheckpointStore(CHECKPOINTS, checkpoint.key)
+    print(resumed.load(), resumed.get_last_stage(), resumed.get_outputs())
+    resumed.remove()
@@ -0,0 +1,138 @@
+"""
+This module overlaps reading, scoring and writing the chunks of a pipeline run
+
+A reader thread pulls the chunks from the loader into a bounded queue, the calling thread scores them and a
+writer thread persists the scored chunks from a second bounded queue. Reading chunk N+1 and writing chunk N-1
+overlap scoring chunk N. A full queue blocks its producer (backpressure), so at most queue_size chunks wait
+between two stages. The first error of any stage stops the other two and is raised again by run.
+
+The scoring stays in the calling thread, so whatever it opened there (e.g. sqlite connections) can be used and
+closed by the caller afterwards. The gain comes from the I/O that runs outside the GIL: file reads, the DB
+drivers and the compressed/parquet writers.
+"""
+import logging
+import queue
+import threading
+from app_config import get_config
+
+logging.basicConfig(level=logging.DEBUG)
+logging.info('Executing the script as a standalone')
+
+'''
+Read Config File
+'''
+config = get_config()
+QUEUE_SIZE = int(config['PIPELINE']['QUEUE_SIZE'])
+
+POLL_SECONDS = 0.1
+DONE = object()
+
+'''
+class: ChunkPipeline
+Parameters: queue_size -> number of chunks each queue holds before its producer blocks
+            poll_seconds -> how often a blocked thread checks whether another stage failed
+Returns: the number of chunks written from run; the first error of a stage is raised again
+'''
+
+
+class ChunkPipeline:
+    def __init__(self, queue_size=QUEUE_SIZE, poll_seconds=POLL_SECONDS):
+        self.queue_size = queue_size
+        self.poll_seconds = poll_seconds
+        self.stop_event = threading.Event()
+        self.errors = []
+        self.written = 0
+
+    def fail(self, error):
+        self.errors.append(error)
+        self.stop_event.set()
+
+    def put(self, chunk_queue, item):
+        # False when another stage failed while waiting for room in the queue
+        while not self.stop_event.is_set():
+            try:
+                chunk_queue.put(item, timeout=self.poll_seconds)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(self, chunk_queue):
+        # DONE when the producer is finished or another stage failed
+        while not self.stop_event.is_set():
+            try:
+                return chunk_queue.get(timeout=self.poll_seconds)
+            except queue.Empty:
+                continue
+        return DONE
+
+    def read(self, chunks, read_queue):
+        try:
+            for chunk in chunks:
+                if not self.put(read_queue, chunk):
+                    return
+            self.put(read_queue, DONE)
+        except Exception as e:
+            logging.error("Failed to read a chunk")
+            self.fail(e)
+
+    def write(self, write_queue, writer, close):
+        try:
+            while True:
+                item = self.get(write_queue)
+                if item is DONE:
+                    return
+                writer(item)
+                self.written += 1
+        except Exception as e:
+            logging.error("Failed to write a chunk")
+            self.fail(e)
+        finally:
+            if close is not None:
+                close()
+
+    def run(self, chunks, scorer, writer, close=None):
+        # scorer returns the item to write for a chunk, or None to skip it; close runs in the writer thread last
+        self.stop_event.clear()
+        self.errors = []
+        self.written = 0
+        read_queue = queue.Queue(maxsize=self.queue_size)
+        write_queue = queue.Queue(maxsize=self.queue_size)
+        reader_thread = threading.Thread(target=self.read, args=(chunks, read_queue), name='chunk-reader', daemon=True)
+        writer_thread = threading.Thread(target=self.write, args=(write_queue, writer, close), name='chunk-writer',
+                                         daemon=True)
+        reader_thread.start()
+        writer_thread.start()
+        try:
+            while True:
+                chunk = self.get(read_queue)
+                if chunk is DONE:
+                    break
+                scored = scorer(chunk)
+                if scored is not None and not self.put(write_queue, scored):
+                    break
+            self.put(write_queue, DONE)
+        except Exception as e:
+            logging.error("Failed to score a chunk")
+            self.fail(e)
+        writer_thread.join()
+        # the reader may be blocked on a full queue or in the middle of a read; it stops at its next put
+        self.stop_event.set()
+        reader_thread.join()
+        if self.errors:
+            raise self.errors[0]
+        return self.written
+
+
+if __name__ == "__main__":
+    import time
+
+    def slow_chunks(count):
+        for number in range(count):
+            time.sleep(0.05)
+            yield number
+
+    start = time.perf_counter()
+    written = ChunkPipeline(queue_size=2).run(slow_chunks(20), lambda chunk: time.sleep(0.05) or chunk,
+                                              lambda item: time.sleep(0.05))
+    print(written, "chunks in", round(time.perf_counter() - start, 2), "s instead of about 3 s sequentially")
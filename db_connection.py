@@ -0,0 +1,194 @@
+"""
+This module manages the database connections shared by the data loader and the data persister
+
+Connections are pooled per set of connection details (built from the [DATABASE] section), so repeated
+pipeline runs in one process reuse the connection instead of paying the connection and TLS setup every time.
+The pool caps the number of open connections, checks the health of an idle connection before handing it
+out and closes connections that stayed idle for too long.
+"""
+import atexit
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from app_config import get_config
+
+logging.basicConfig(level=logging.DEBUG)
+logging.info('Executing the script as a standalone')
+
+'''
+Read Config File
+'''
+config = get_config()
+USER = config['DATABASE']['USER']
+PASSWORD = config['DATABASE']['PASSWORD']
+HOST = config['DATABASE']['HOST']
+PORT = int(config['DATABASE']['PORT'])
+DATABASE = config['DATABASE']['DATABASE']
+POOL_SIZE = int(config['DATABASE']['POOL_SIZE'])
+POOL_IDLE_TIMEOUT = float(config['DATABASE']['POOL_IDLE_TIMEOUT'])
+POOL_TIMEOUT = float(config['DATABASE']['POOL_TIMEOUT'])
+
+
+def connect_to_mysql(db):
+    import mysql.connector
+    return mysql.connector.connect(**db)
+
+
+def close_quietly(connection):
+    try:
+        connection.close()
+    except Exception as e:
+        logging.warning("Failed to close a database connection")
+        logging.warning(e)
+
+
+def is_healthy(connection):
+    try:
+        if hasattr(connection, 'is_connected'):
+            return connection.is_connected()
+        cursor = connection.cursor()
+        cursor.execute("SELECT 1")
+        cursor.fetchall()
+        cursor.close()
+        return True
+    except Exception:
+        return False
+
+
+'''
+class: ConnectionPool
+Parameters: connect -> function returning a new DB-API connection
+            max_size -> maximum number of connections open at the same time (idle and checked out)
+            idle_timeout -> seconds after which an idle connection is closed
+            timeout -> seconds to wait for a connection when max_size connections are checked out
+            health_check -> check an idle connection is still alive before handing it out
+Returns: an open connection from get_connection, which should be handed back with release (or discard when broken)
+         connection() does the same as a context manager
+'''
+
+
+class ConnectionPool:
+    def __init__(self, connect, max_size=5, idle_timeout=300, timeout=30, health_check=True):
+        self.connect = connect
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.health_check = health_check
+        self.idle = []
+        self.open_connections = 0
+        self.condition = threading.Condition()
+
+    def evict_idle(self):
+        now = time.monotonic()
+        expired = [connection for connection, released_at in self.idle if now - released_at > self.idle_timeout]
+        if expired:
+            self.idle = [(connection, released_at) for connection, released_at in self.idle
+                         if now - released_at <= self.idle_timeout]
+            self.open_connections -= len(expired)
+            self.condition.notify_all()
+        return expired
+
+    def get_connection(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self.condition:
+                expired = self.evict_idle()
+                connection = None
+                if self.idle:
+                    connection, _ = self.idle.pop()
+                elif self.open_connections < self.max_size:
+                    self.open_connections += 1
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError("No database connection was released within " + str(self.timeout) + "s")
+                    self.condition.wait(remaining)
+                    continue
+            for expired_connection in expired:
+                close_quietly(expired_connection)
+            if connection is None:
+                return self.open_new()
+            if not self.health_check or is_healthy(connection):
+                return connection
+            logging.info("Discarding an unhealthy database connection")
+            self.discard(connection)
+
+    def open_new(self):
+        try:
+            logging.info("Opening a new database connection")
+            return self.connect()
+        except Exception:
+            with self.condition:
+                self.open_connections -= 1
+                self.condition.notify()
+            raise
+
+    def release(self, connection):
+        with self.condition:
+            self.idle.append((connection, time.monotonic()))
+            self.condition.notify()
+
+    def discard(self, connection):
+        close_quietly(connection)
+        with self.condition:
+            self.open_connections -= 1
+            self.condition.notify()
+
+    def recycle(self, connection):
+        try:
+            connection.rollback()
+        except Exception:
+            self.discard(connection)
+            return
+        self.release(connection)
+
+    @contextmanager
+    def connection(self):
+        connection = self.get_connection()
+        try:
+            yield connection
+        except BaseException:
+            self.recycle(connection)
+            raise
+        self.release(connection)
+
+    def close(self):
+        with self.condition:
+            idle, self.idle = self.idle, []
+            self.open_connections -= len(idle)
+            self.condition.notify_all()
+        for connection, _ in idle:
+            close_quietly(connection)
+
+
+POOLS = {}
+POOLS_LOCK = threading.Lock()
+
+
+def get_pool(db):
+    key = tuple(sorted(db.items()))
+    with POOLS_LOCK:
+        if key not in POOLS:
+            POOLS[key] = ConnectionPool(lambda: connect_to_mysql(db), max_size=POOL_SIZE,
+                                        idle_timeout=POOL_IDLE_TIMEOUT, timeout=POOL_TIMEOUT)
+        return POOLS[key]
+
+
+def close_pools():
+    with POOLS_LOCK:
+        pools = list(POOLS.values())
+        POOLS.clear()
+    for pool in pools:
+        pool.close()
+
+
+atexit.register(close_pools)
+
+
+if __name__ == "__main__":
+    database_details = {'user': USER, 'password': PASSWORD, 'host': HOST, 'port': PORT, 'database': DATABASE}
+    pool = get_pool(database_details)
+    with pool.connection() as connection_:
+        print(connection_)
+    close_pools()
@@ -1,111 +1,190 @@
-import logging
-from configparser import ConfigParser
-import pandas as pd
-from matplotlib import pyplot as plt
-
-"""
-This module calculates customer tier using standard rules and points
-
-Rules:
-Points based system to divide the customers into three different groups
-
-past Loans Matured:
-if > 2: then points = 10
-elif > 0: then points = 5
-else: points = 0
-
-Non-Payments:
-if == 0: then points = 10
-elif < 2: then points = 5
-else: points = 0
-
-Savings:
-if savings > 100000: then points = 10
-elif savings > 50000: then points = 5
-else: points = 0
-"""
-
-logging.basicConfig(level=logging.DEBUG)
-logging.info('Executing the script as a standalone')
-
-'''
-Read Config File
-'''
-config = ConfigParser()
-config.read('config.ini')
-CUSTOMER = config.items('CUSTOMER')
-DATA = config['DATA']['PATH']
-
-
-class TierClassifier:
-    def __init__(self, data, rules):
-        self.data = data
-        self.rules = rules
-
-    def apply_rule(self, val, x, rule):
-        try:
-            high = rule[0]
-            low = rule[1]
-            if val == 'less':
-                if x <= low:
-                    return 10
-                elif x <= high:
-                    return 5
-                else:
-                    return 0
-            else:
-                if x > high:
-                    return 10
-                elif x > low:
-                    return 5
-                else:
-                    return 0
-        except Exception as e:
-            logging.error("Failed to Apply rule. check here")
-            logging.error(e)
-
-    def get_points(self, x):
-        points = 0
-        try:
-            for rule in self.rules:
-                col_name = rule[0]
-                high, low, value = rule[1].split(",")
-                points += self.apply_rule(value, x[col_name], [int(high), int(low)])
-            return points
-        except Exception as e:
-            logging.error("Failed to get Points")
-            logging.error(e)
-
-    def get_tier(self, x):
-        try:
-            points = self.get_points(x)
-            if points >= 22:
-                return 'A'
-            elif points >= 15:
-                return 'B'
-            else:
-                return 'C'
-        except Exception as e:
-            logging.error("Failed to get tier")
-            logging.error(e)
-
-    def rule_engine(self):
-        try:
-            logging.info("Applying the rule engine to get tiers")
-            tiers = self.data.apply(self.get_tier, axis=1)
-            return tiers
-        except Exception as e:
-            logging.error("Failed to apply rules engine to get tiers")
-            logging.error(e)
-            return
-
-if __name__ == "__main__":
-    data_ = pd.read_csv(DATA)
-    tier_classifier = TierClassifier(data_, CUSTOMER)
-    tier = tier_classifier.rule_engine()
-    plt.hist(tier)
-    plt.show()
-
-
-
-
+import logging
+from app_config import get_config
+import numpy as np
+import pandas as pd
+
+"""
+This module calculates customer tier using standard rules and points
+
+Rules:
+Points based system to divide the customers into three different groups
+
+past Loans Matured:
+if > 2: then points = 10
+elif > 0: then points = 5
+else: points = 0
+
+Non-Payments:
+if == 0: then points = 10
+elif < 2: then points = 5
+else: points = 0
+
+Savings:
+if savings > 100000: then points = 10
+elif savings > 50000: then points = 5
+else: points = 0
+
+The rules are compiled once into threshold arrays and scored on whole columns with numpy.
+The original row-wise path (get_tier) is kept for reference and benchmarking.
+"""
+
+logging.basicConfig(level=logging.DEBUG)
+logging.info('Executing the script as a standalone')
+
+'''
+Read Config File
+'''
+config = get_config()
+CUSTOMER = config.items('CUSTOMER')
+DATA = config['DATA']['PATH']
+
+
+TIER_LABELS = np.array(['A', 'B', 'C'], dtype=object)
+
+
+class TierClassifier:
+    def __init__(self, data, rules, cache=None, feature_hashes=None):
+        self.data = data
+        self.rules = rules
+        self.compiled_rules = None
+        self.cache = cache
+        self.feature_hashes = feature_hashes
+
+    def apply_rule(self, val, x, rule):
+        try:
+            high = rule[0]
+            low = rule[1]
+            if val == 'less':
+                if x <= low:
+                    return 10
+                elif x <= high:
+                    return 5
+                else:
+                    return 0
+            else:
+                if x > high:
+                    return 10
+                elif x > low:
+                    return 5
+                else:
+                    return 0
+        except Exception as e:
+            logging.error("Failed to Apply rule. check here")
+            logging.error(e)
+
+    def get_points(self, x):
+        points = 0
+        try:
+            for rule in self.rules:
+                col_name = rule[0]
+                high, low, value = rule[1].split(",")
+                points += self.apply_rule(value, x[col_name], [int(high), int(low)])
+            return points
+        except Exception as e:
+            logging.error("Failed to get Points")
+            logging.error(e)
+
+    def get_tier(self, x):
+        try:
+            points = self.get_points(x)
+            if points >= 22:
+                return 'A'
+            elif points >= 15:
+                return 'B'
+            else:
+                return 'C'
+        except Exception as e:
+            logging.error("Failed to get tier")
+            logging.error(e)
+
+    def compile_rules(self):
+        try:
+            logging.info("Compiling the rules into threshold arrays")
+            columns, highs, lows, less = [], [], [], []
+            for rule in self.rules:
+                high, low, value = rule[1].split(",")
+                columns.append(rule[0])
+                highs.append(int(high))
+                lows.append(int(low))
+                less.append(value == 'less')
+            self.compiled_rules = {'columns': columns,
+                                   'high': np.array(highs),
+                                   'low': np.array(lows),
+                                   'less': np.array(less, dtype=bool)}
+        except Exception as e:
+            logging.error("Failed to compile the rules")
+            logging.error(e)
+            return 1
+        return 0
+
+    def get_points_vectorized(self):
+        rules = self.compiled_rules
+        points = np.zeros(len(self.data), dtype=np.int64)
+        for col, high, low, less in zip(rules['columns'], rules['high'], rules['low'], rules['less']):
+            x = self.data[col].to_numpy()
+            if less:
+                conditions = [x <= low, x <= high]
+            else:
+                conditions = [x > high, x > low]
+            points += np.select(conditions, [10, 5], default=0)
+        return points
+
+    def get_tier_codes(self):
+        points = self.get_points_vectorized()
+        codes = np.full(len(points), 2, dtype=np.int8)
+        codes[points >= 15] = 1
+        codes[points >= 22] = 0
+        return codes
+
+    def get_tiers_vectorized(self, categorical=False):
+        if self.compiled_rules is None:
+            if self.compile_rules() != 0:
+                raise ValueError("The rules could not be compiled")
+        codes = self.get_tier_codes()
+        if categorical:
+            # one byte per row instead of a string object per row
+            return pd.Series(pd.Categorical.from_codes(codes, categories=TIER_LABELS), index=self.data.index)
+        return pd.Series(TIER_LABELS[codes], index=self.data.index)
+
+    def get_cached_tiers(self, vectorized=True, categorical=False):
+        found, cached = self.cache.get(self.feature_hashes)
+        tiers = np.empty(len(found), dtype=object)
+        tiers[found] = cached
+        if not found.all():
+            data = self.data
+            self.data = data.iloc[~found]
+            try:
+                missed = self.get_tiers_vectorized() if vectorized else self.data.apply(self.get_tier, axis=1)
+            finally:
+                self.data = data
+            tiers[~found] = missed.to_numpy(dtype=object)
+            self.cache.put(self.feature_hashes[~found], missed.tolist())
+        tiers = pd.Series(tiers, index=self.data.index)
+        return tiers.astype(pd.CategoricalDtype(TIER_LABELS)) if categorical else tiers
+
+    def rule_engine(self, vectorized=True, categorical=False):
+        try:
+            logging.info("Applying the rule engine to get tiers")
+            if self.cache is not None:
+                tiers = self.get_cached_tiers(vectorized=vectorized, categorical=categorical)
+            elif vectorized:
+                tiers = self.get_tiers_vectorized(categorical=categorical)
+            else:
+                tiers = self.data.apply(self.get_tier, axis=1)
+            return tiers
+        except Exception as e:
+            logging.error("Failed to apply rules engine to get tiers")
+            logging.error(e)
+            return
+
+if __name__ == "__main__":
+    data_ = pd.read_csv(DATA)
+    tier_classifier = TierClassifier(data_, CUSTOMER)
+    tier = tier_classifier.rule_engine()
+    from matplotlib import pyplot as plt  # imported here, it takes longer to import than the pipeline needs to run
+    plt.hist(tier)
+    plt.show()
+
+
+
+
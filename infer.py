@@ -1,82 +1,476 @@
-"""
-This module will pre-process the input data
-"""
-import pandas as pd
-from load_model import Model
-from configparser import ConfigParser
-import logging
-
-
-logging.basicConfig(level=logging.DEBUG)
-logging.info('Executing the script as a standalone')
-
-'''
-Read the config File
-'''
-config = ConfigParser()
-config.read('config.ini')
-CLASSIFIER = config['MODELS']['CLASSIFIER']
-
-'''
-class: Classifier
-Parameters: data --> Numpy ndarray of the transformed data
-            model_path --> String value; full or relative path to the saved model
-Returns: Numpy array of the default Probabilities
-'''
-
-
-class Classifier:
-    def __init__(self, data, model_path):
-        self.data = data
-        self.model_path = model_path
-        self.model = None
-        self.probabilities = None
-
-    def load_model(self):
-        try:
-            self.model = Model(self.model_path).load_model()
-            logging.info("The model successfully loaded")
-        except Exception as e:
-            logging.error("The model Failed to load")
-            return 1
-        return 0
-
-    def get_probabilities(self):
-        try:
-            self.probabilities = self.model.predict_proba(self.data)[:,1]
-            logging.info("Successfully inferred the probabilities")
-        except Exception as e:
-            logging.error("The Probabilities could not be inferred")
-            return 1
-        return 0
-
-    def infer_data(self):
-        try:
-            logging.info('Starting inference')
-            model_result = self.load_model()
-            if model_result != 0:
-                logging.error('Inference failed. Please check the error messages')
-                return None
-            probability_result = self.get_probabilities()
-            if probability_result != 0:
-                logging.error('Inference failed. Please check the error messages')
-                return None
-            logging.info('Successfully Inferred')
-        except Exception as e:
-            logging.error('Inference failed. Please check the error messages')
-            return None
-        return self.probabilities
-
-
-if __name__ == "__main__":
-    import prepare_input_data as pid
-    DATA = config['DATA']['PATH']
-    SCALER = config['MODELS']['SCALER']
-    IDENTIFIERS = ['customer_id', 'loan_id']
-    data_ = pd.read_csv(DATA)
-    _, input_data = pid.DataPreprocess(data_, SCALER, IDENTIFIERS).prepare_data()
-    print(CLASSIFIER)
-    classifier_model = Classifier(input_data, CLASSIFIER)
-    probabilities = classifier_model.infer_data()
-    print(probabilities)
-
+"""
+This module will pre-process the input data
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from load_model import Model
+from app_config import get_config
+import logging
+
+
+logging.basicConfig(level=logging.DEBUG)
+logging.info('Executing the script as a standalone')
+
+'''
+Read the config File
+'''
+config = get_config()
+CLASSIFIER = config['MODELS']['CLASSIFIER']
+CACHE_SIZE = int(config['MODELS']['CACHE_SIZE'])
+VALIDATION_ROWS = 1000
+TREE_BLOCK_ROWS = 512
+FOREST_MODELS = ['RandomForestClassifier', 'ExtraTreesClassifier', 'DecisionTreeClassifier']
+BOOSTING_MODELS = ['GradientBoostingClassifier']
+# the leaf values of other losses (e.g. exponential) are not log odds, so the sigmoid of their sum is no probability
+BOOSTING_LOSSES = ['log_loss', 'deviance']
+
+'''
+class: CompiledLinearModel
+Parameters: weights --> Numpy array of the logistic regression coefficients with the scaler folded in
+            bias --> float; the intercept with the scaler offset folded in
+Returns: Numpy array of the default Probabilities from predict_positive, computed from the raw
+         (encoded but not normalized) features with one GEMV and an in-place sigmoid
+'''
+
+
+class CompiledLinearModel:
+    def __init__(self, weights, bias):
+        self.weights = weights
+        self.bias = bias
+
+    @staticmethod
+    def get_affine_scaling(scaler):
+        name = type(scaler).__name__
+        if name == 'MinMaxScaler':
+            if getattr(scaler, 'clip', False):
+                raise ValueError("A clipping MinMaxScaler is not affine and can not be compiled")
+            return scaler.scale_, scaler.min_
+        if name == 'StandardScaler':
+            scale = 1 / scaler.scale_ if scaler.scale_ is not None else np.ones(scaler.n_features_in_)
+            offset = -scaler.mean_ * scale if scaler.mean_ is not None else np.zeros(scaler.n_features_in_)
+            return scale, offset
+        raise ValueError("The scaler " + name + " can not be compiled")
+
+    @classmethod
+    def compile(cls, scaler, model, dtype=np.float64):
+        if model.coef_.shape[0] != 1:
+            raise ValueError("Only binary linear models can be compiled")
+        scale, offset = cls.get_affine_scaling(scaler)
+        coefficients = model.coef_[0]
+        weights = np.ascontiguousarray(scale * coefficients, dtype=dtype)
+        bias = float(offset @ coefficients + model.intercept_[0])
+        return cls(weights, bias)
+
+    def predict_positive(self, features):
+        features = np.ascontiguousarray(features, dtype=self.weights.dtype)
+        probabilities = features @ self.weights
+        probabilities += self.bias
+        with np.errstate(over='ignore'):
+            np.negative(probabilities, out=probabilities)
+            np.exp(probabilities, out=probabilities)
+        probabilities += 1
+        np.reciprocal(probabilities, out=probabilities)
+        return probabilities
+
+    def validate(self, features, scaler, model):
+        features = np.asarray(features)[:VALIDATION_ROWS]
+        expected = model.predict_proba(scaler.transform(features))[:, 1]
+        tolerance = 1e-4 if self.weights.dtype == np.float32 else 1e-9
+        return np.allclose(self.predict_positive(features), expected, rtol=tolerance, atol=tolerance)
+
+
+'''
+class: CompiledTreeEnsemble
+Parameters: features, thresholds, children, missing_left, values --> Numpy arrays of the nodes of all the trees,
+                concatenated and numbered so the right child of a node follows its left child (children holds the
+                left one); a leaf is its own child and reads the always -inf column n_features so it never moves
+            roots --> Numpy array of the index of the root node of every tree
+            depth --> the depth of the deepest tree
+            n_features --> number of features of the model
+            scale, offset --> the affine scaling of the scaler, applied before the trees (None when unscaled)
+            kind --> 'forest' averages the leaf values (class 1 fractions), 'boosting' returns
+                     sigmoid(init + learning_rate * sum of the leaf values)
+            init, learning_rate --> the initial log odds and the learning rate of a boosting model
+            n_jobs --> number of threads scoring the blocks of rows
+Returns: Numpy array of the default Probabilities from predict_positive, computed from the raw (encoded but not
+         normalized) features by moving the rows of a block down all the trees one level at a time
+'''
+
+
+class CompiledTreeEnsemble:
+    def __init__(self, features, thresholds, children, missing_left, values, roots, depth, n_features, scale=None,
+                 offset=None, kind='forest', init=0.0, learning_rate=1.0, n_jobs=None):
+        self.features = features
+        self.thresholds = thresholds
+        self.children = children
+        self.missing_left = missing_left
+        self.values = values
+        self.roots = roots
+        self.depth = depth
+        self.n_features = n_features
+        self.scale = scale
+        self.offset = offset
+        self.kind = kind
+        self.init = init
+        self.learning_rate = learning_rate
+        self.n_jobs = n_jobs
+
+    @staticmethod
+    def get_init(model):
+        if model.init_ == 'zero':
+            return 0.0
+        if type(model.init_).__name__ != 'DummyClassifier':
+            raise ValueError("Only a prior or zero init of a boosting model can be compiled")
+        prior = np.clip(model.init_.class_prior_[1], np.finfo(np.float64).eps, 1 - np.finfo(np.float64).eps)
+        return float(np.log(prior / (1 - prior)))
+
+    @classmethod
+    def compile(cls, scaler, model, n_jobs=None):
+        name = type(model).__name__
+        if name in FOREST_MODELS:
+            if model.n_classes_ != 2:
+                raise ValueError("Only binary tree models can be compiled")
+            estimators = getattr(model, 'estimators_', [model])
+            kind, init, learning_rate = 'forest', 0.0, 1.0
+        elif name in BOOSTING_MODELS:
+            if model.estimators_.shape[1] != 1:
+                raise ValueError("Only binary boosting models can be compiled")
+            if getattr(model, 'loss', 'log_loss') not in BOOSTING_LOSSES:
+                raise ValueError("Only log loss boosting models can be compiled, not " + str(model.loss))
+            estimators = model.estimators_[:, 0]
+            kind, init, learning_rate = 'boosting', cls.get_init(model), float(model.learning_rate)
+        else:
+            raise ValueError("The model " + name + " can not be compiled")
+        trees = [estimator.tree_ for estimator in estimators]
+        offsets = np.cumsum([0] + [tree.node_count for tree in trees])
+        left = np.concatenate([np.where(tree.children_left < 0, -1, tree.children_left + start)
+                               for tree, start in zip(trees, offsets)])
+        right = np.concatenate([tree.children_right + start for tree, start in zip(trees, offsets)])
+        is_leaf = left < 0
+        internal = np.flatnonzero(~is_leaf)
+        # renumber: the roots first, then the children of every internal node side by side
+        first_child = len(trees) + 2 * np.arange(len(internal))
+        new_ids = np.empty(len(left), dtype=np.intp)
+        new_ids[offsets[:-1]] = np.arange(len(trees))
+        new_ids[left[internal]] = first_child
+        new_ids[right[internal]] = first_child + 1
+        order = np.empty_like(new_ids)
+        order[new_ids] = np.arange(len(new_ids))
+        children = new_ids.copy()
+        children[internal] = first_child
+        if kind == 'forest':
+            values = np.concatenate([tree.value[:, 0, 1] / tree.value[:, 0].sum(axis=1) for tree in trees])
+        else:
+            values = np.concatenate([tree.value[:, 0, 0] for tree in trees])
+        missing_left = np.concatenate([getattr(tree, 'missing_go_to_left', np.ones(tree.node_count, np.uint8))
+                                       for tree in trees]).astype(bool) | is_leaf
+        features = np.where(is_leaf, model.n_features_in_, np.concatenate([tree.feature for tree in trees]))
+        thresholds = np.where(is_leaf, np.inf, np.concatenate([tree.threshold for tree in trees]))
+        scale, offset = CompiledLinearModel.get_affine_scaling(scaler) if scaler is not None else (None, None)
+        return cls(features=features[order].astype(np.intp), thresholds=thresholds[order],
+                   children=children[order], missing_left=missing_left[order], values=values[order],
+                   roots=np.arange(len(trees), dtype=np.intp), depth=max(tree.max_depth for tree in trees),
+                   n_features=model.n_features_in_, scale=scale, offset=offset, kind=kind, init=init,
+                   learning_rate=learning_rate, n_jobs=n_jobs)
+
+    def get_state(self):
+        # the scalar parameters and the arrays exported by load_model.export_artifact
+        arrays = {'features': self.features, 'thresholds': self.thresholds, 'children': self.children,
+                  'missing_left': self.missing_left, 'values': self.values, 'roots': self.roots}
+        if self.scale is not None:
+            arrays.update(scale=self.scale, offset=self.offset)
+        params = {'depth': int(self.depth), 'n_features': int(self.n_features), 'kind': self.kind,
+                  'init': float(self.init), 'learning_rate': float(self.learning_rate)}
+        return params, arrays
+
+    def with_scaler(self, scaler, n_jobs=None):
+        scale, offset = CompiledLinearModel.get_affine_scaling(scaler) if scaler is not None else (None, None)
+        params, arrays = self.get_state()
+        arrays.update(scale=scale, offset=offset)
+        return CompiledTreeEnsemble(n_jobs=n_jobs, **params, **arrays)
+
+    def scale_features(self, features):
+        # same operations and float32 cast as scaler.transform of float64 features followed by the sklearn trees;
+        # float32 features (memory_lean) are scaled in float64 too so they cross the same thresholds
+        features = np.array(features, dtype=np.float64)
+        if self.scale is not None:
+            features *= self.scale
+            features += self.offset
+        return features.astype(np.float32)
+
+    def sum_leaf_values(self, features):
+        rows = len(features)
+        # one row per feature plus the -inf row of the leaves, so a feature and a row index make a flat position
+        columns = np.empty((self.n_features + 1, rows), dtype=np.float32)
+        columns[:self.n_features] = features.T
+        columns[self.n_features] = -np.inf
+        columns = columns.ravel()
+        check_missing = not self.missing_left.all() and np.isnan(features).any()
+        feature_offsets = self.features * rows
+        row_offsets = np.arange(rows, dtype=np.intp)
+        nodes = np.repeat(self.roots[:, np.newaxis], rows, axis=1)
+        positions = np.empty(nodes.shape, dtype=np.intp)
+        values = np.empty(nodes.shape, dtype=np.float32)
+        thresholds = np.empty(nodes.shape, dtype=np.float64)
+        go_right = np.empty(nodes.shape, dtype=bool)
+        for _ in range(self.depth):
+            np.take(feature_offsets, nodes, out=positions)
+            positions += row_offsets
+            np.take(columns, positions, out=values)
+            np.take(self.thresholds, nodes, out=thresholds)
+            np.greater(values, thresholds, out=go_right)
+            if check_missing:
+                go_right |= np.isnan(values) & ~self.missing_left[nodes]
+            np.take(self.children, nodes, out=nodes)
+            nodes += go_right
+        return self.values[nodes].sum(axis=0)
+
+    def predict_positive(self, features):
+        features = self.scale_features(features)
+        blocks = [features[start:start + TREE_BLOCK_ROWS] for start in range(0, len(features), TREE_BLOCK_ROWS)]
+        if len(blocks) > 1 and self.n_jobs != 1:
+            # numpy releases the GIL in the gathers and comparisons, so the blocks are scored concurrently
+            with ThreadPoolExecutor(max_workers=self.n_jobs) as executor:
+                sums = list(executor.map(self.sum_leaf_values, blocks))
+        else:
+            sums = [self.sum_leaf_values(block) for block in blocks]
+        scores = np.concatenate(sums) if sums else np.empty(0)
+        if self.kind == 'forest':
+            return scores / len(self.roots)
+        scores *= self.learning_rate
+        scores += self.init
+        return 1 / (1 + np.exp(-scores))
+
+    def predict_proba(self, features):
+        # like the sklearn model: the features are already scaled unless the ensemble was compiled with a scaler
+        positive = self.predict_positive(features)
+        return np.column_stack([1 - positive, positive])
+
+    def validate(self, features, scaler, model):
+        features = np.asarray(features)[:VALIDATION_ROWS]
+        scaled = np.asarray(features, dtype=np.float64)
+        expected = model.predict_proba(scaler.transform(scaled) if scaler is not None else scaled)[:, 1]
+        return np.allclose(self.predict_positive(features), expected, rtol=1e-9, atol=1e-9)
+
+
+def is_tree_model(model):
+    return type(model).__name__ in FOREST_MODELS + BOOSTING_MODELS
+
+
+def compile_model(scaler, model, dtype=np.float64, n_jobs=None):
+    if isinstance(model, CompiledTreeEnsemble):  # loaded from an artifact directory
+        return model.with_scaler(scaler, n_jobs=n_jobs)
+    if is_tree_model(model):
+        return CompiledTreeEnsemble.compile(scaler, model, n_jobs=n_jobs)
+    return CompiledLinearModel.compile(scaler, model, dtype)
+
+
+'''
+class: CompiledModelRegistry
+Parameters: max_size --> number of compiled models kept, the least recently used is dropped first
+Returns: the compiled model of a loaded model and scaler from get; it is compiled and checked against
+         predict_proba on the first features it scores, and reused by every later call
+'''
+
+
+class CompiledModelRegistry:
+    def __init__(self, max_size=CACHE_SIZE):
+        self.max_size = max_size
+        self.compiled_models = OrderedDict()
+        # the ensemble members and the scoring service workers get their compiled models from several threads
+        self.lock = threading.RLock()
+
+    def get(self, scaler, model, features, dtype=np.float64, n_jobs=None):
+        # keyed on the objects, which the entry keeps alive so their ids are not reused
+        key = (id(model), id(scaler), np.dtype(dtype).name, n_jobs)
+        with self.lock:
+            if key in self.compiled_models:
+                self.compiled_models.move_to_end(key)
+                return self.compiled_models[key][2]
+            compiled_model = compile_model(scaler, model, dtype, n_jobs=n_jobs)
+            if not isinstance(model, CompiledTreeEnsemble) and not compiled_model.validate(features, scaler, model):
+                raise ValueError("The compiled model does not match predict_proba")
+            self.compiled_models[key] = (model, scaler, compiled_model)
+            while len(self.compiled_models) > self.max_size:
+                self.compiled_models.popitem(last=False)
+            return compiled_model
+
+    def clear(self):
+        with self.lock:
+            self.compiled_models.clear()
+
+
+COMPILED_REGISTRY = CompiledModelRegistry()
+
+
+'''
+class: Classifier
+Parameters: data --> Numpy ndarray of the transformed data (raw features when compiled is True)
+            model_path --> String value; full or relative path to the saved model
+            model --> an already loaded model, used instead of loading model_path
+            compiled --> compile the model (a logistic regression) with the scaler folded in and score the raw
+                         features directly; the compiled model is kept in COMPILED_REGISTRY for the later calls
+            compiled_trees --> with compiled, also compile the random forest and gradient boosting models to flat
+                               node arrays; only faster than predict_proba on small batches (up to a few hundred
+                               rows), otherwise the trees score the scaled features with predict_proba
+            scaler --> the loaded scaler, required when compiled is True
+            dtype --> numpy float type used by the compiled logistic regression (the trees always use float32)
+            An ensemble is scored when model_path (or model) is a list; the models run concurrently on the
+            same features and their probabilities are combined with aggregation:
+            aggregation --> 'mean', 'weighted' (uses weights) or 'stacking' (uses stacker)
+            weights --> list of floats, one per model
+            stacker --> loaded model scoring the matrix of the ensemble probabilities (one column per model)
+            n_jobs --> number of threads used to run the ensemble
+            cache --> result_cache.ResultCache of the probabilities; only the rows not found are scored
+            feature_hashes --> numpy array of the feature row hashes (result_cache.hash_features), the cache keys
+Returns: Numpy array of the default Probabilities
+'''
+
+
+class Classifier:
+    def __init__(self, data, model_path, model=None, compiled=False, scaler=None, dtype=np.float64,
+                 aggregation='mean', weights=None, stacker=None, n_jobs=None, cache=None, feature_hashes=None,
+                 compiled_trees=False):
+        self.data = data
+        self.model_path = model_path
+        self.model = model
+        self.compiled = compiled
+        self.compiled_trees = compiled_trees
+        self.scaler = scaler
+        self.dtype = dtype
+        self.aggregation = aggregation
+        self.weights = weights
+        self.stacker = stacker
+        self.n_jobs = n_jobs
+        self.cache = cache
+        self.feature_hashes = feature_hashes
+        self.model_timings = {}
+        self.probabilities = None
+
+    def is_ensemble(self):
+        return isinstance(self.model_path, (list, tuple)) or isinstance(self.model, (list, tuple))
+
+    def get_model_names(self):
+        if isinstance(self.model_path, (list, tuple)):
+            return [os.path.basename(path) for path in self.model_path]
+        return ['model_' + str(i) for i in range(len(self.model))]
+
+    def load_model(self):
+        try:
+            if self.model is not None:
+                logging.info("Using the already loaded model")
+                return 0
+            if self.is_ensemble():
+                self.model = [Model(path).load_model() for path in self.model_path]
+                if any(model is None for model in self.model):
+                    raise ValueError("One of the ensemble models failed to load")
+            else:
+                self.model = Model(self.model_path).load_model()
+            logging.info("The model successfully loaded")
+        except Exception as e:
+            logging.error("The model Failed to load")
+            return 1
+        return 0
+
+    def get_compiled_probabilities(self, model=None):
+        model = self.model if model is None else model
+        features = np.asarray(self.data)
+        if is_tree_model(model) and not self.compiled_trees:
+            return model.predict_proba(self.scaler.transform(np.asarray(features, dtype=np.float64)))[:, 1]
+        compiled_model = COMPILED_REGISTRY.get(self.scaler, model, features, self.dtype, n_jobs=self.n_jobs)
+        return compiled_model.predict_positive(features)
+
+    def score_model(self, model):
+        start = time.perf_counter()
+        if self.compiled:
+            probabilities = self.get_compiled_probabilities(model)
+        else:
+            probabilities = model.predict_proba(self.data)[:, 1]
+        return probabilities, time.perf_counter() - start
+
+    def get_ensemble_probabilities(self):
+        self.data = np.asarray(self.data)
+        with ThreadPoolExecutor(max_workers=self.n_jobs) as executor:
+            results = list(executor.map(self.score_model, self.model))
+        model_probabilities = np.column_stack([probabilities for probabilities, _ in results])
+        self.model_timings = {name: seconds for name, (_, seconds) in zip(self.get_model_names(), results)}
+        for name, seconds in self.model_timings.items():
+            logging.info("Scored %s in %.4f seconds", name, seconds)
+        if self.aggregation == 'mean':
+            return model_probabilities.mean(axis=1)
+        if self.aggregation == 'weighted':
+            return np.average(model_probabilities, axis=1, weights=self.weights)
+        if self.aggregation == 'stacking':
+            return self.stacker.predict_proba(model_probabilities)[:, 1]
+        raise ValueError("Unknown aggregation " + str(self.aggregation))
+
+    def score_probabilities(self):
+        if self.is_ensemble():
+            return self.get_ensemble_probabilities()
+        if self.compiled:
+            return self.get_compiled_probabilities()
+        return self.model.predict_proba(self.data)[:,1]
+
+    def get_cached_probabilities(self):
+        found, cached = self.cache.get(self.feature_hashes)
+        probabilities = np.empty(len(found), dtype=np.float64)
+        probabilities[found] = cached.astype(np.float64)
+        if not found.all():
+            data = self.data
+            self.data = data.iloc[~found] if hasattr(data, 'iloc') else np.asarray(data)[~found]
+            try:
+                scored = self.score_probabilities()
+            finally:
+                self.data = data
+            probabilities[~found] = scored
+            self.cache.put(self.feature_hashes[~found], scored.tolist())
+        return probabilities
+
+    def get_probabilities(self):
+        try:
+            if self.cache is not None:
+                self.probabilities = self.get_cached_probabilities()
+            else:
+                self.probabilities = self.score_probabilities()
+            logging.info("Successfully inferred the probabilities")
+        except Exception as e:
+            logging.error("The Probabilities could not be inferred")
+            logging.error(e)
+            return 1
+        return 0
+
+    def infer_data(self):
+        try:
+            logging.info('Starting inference')
+            model_result = self.load_model()
+            if model_result != 0:
+                logging.error('Inference failed. Please check the error messages')
+                return None
+            probability_result = self.get_probabilities()
+            if probability_result != 0:
+                logging.error('Inference failed. Please check the error messages')
+                return None
+            logging.info('Successfully Inferred')
+        except Exception as e:
+            logging.error('Inference failed. Please check the error messages')
+            return None
+        return self.probabilities
+
+
+if __name__ == "__main__":
+    import prepare_input_data as pid
+    DATA = config['DATA']['PATH']
+    SCALER = config['MODELS']['SCALER']
+    IDENTIFIERS = ['customer_id', 'loan_id']
+    data_ = pd.read_csv(DATA)
+    _, input_data = pid.DataPreprocess(data_, SCALER, IDENTIFIERS).prepare_data()
+    print(CLASSIFIER)
+    classifier_model = Classifier(input_data, CLASSIFIER)
+    probabilities = classifier_model.infer_data()
+    print(probabilities)
+
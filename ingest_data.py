@@ -1,57 +1,195 @@
-"""
-This script is for ingesting the data from the source to memory
-"""
-import pandas as pd
-import logging
-from configparser import ConfigParser
-
-logging.basicConfig(level=logging.DEBUG)
-logging.info('Executing the script as a standalone')
-
-'''
-Read Config File
-'''
-config = ConfigParser()
-config.read('config.ini')
-PATH = config['DATA']['PATH']
-
-
-"""
-Class Name: DataLoader
-Parameters: database = database connectivity details
-            query = SQL Query to extract the data
-            file_path = path a saved data file (only works when database is not given)
-Returns: a Loaded Model
-"""
-
-
-class DataLoader:
-    def __init__(self, database=None, query=None, file_path=None):
-        self.database = database
-        self.query = query
-        self.data = None
-        self.file_path = file_path
-
-    def load_data(self):
-        try:
-            logging.info('Loading the Data')
-            if self.database and self.query:
-                logging.info('Loading the Data From database')
-                pass  # TODO complete the SQL connection here
-                logging.info('Successfully loaded the data from the database')
-            else:
-                logging.info('Loading the data from csv')
-                self.data = pd.read_csv(self.file_path)
-                logging.info('Successfully loaded the data from CSV')
-        except Exception as e:
-            logging.error('There some problem with loading the data. Please check the error below.')
-            logging.error(e)
-            return None
-        return self.data
-
-
-if __name__ == "__main__":
-    loader = DataLoader(file_path=PATH)
-    my_data = loader.load_data()
-    print(my_data)
-
+"""
+This script is for ingesting the data from the source to memory
+
+When database and query are given the query runs on an unbuffered (server side streaming) cursor and the rows are
+fetched with fetchmany in chunks, so a large SELECT is never held in client memory at once.
+
+Supported file formats: csv, parquet and feather (arrow). Parquet and feather are read with pyarrow through a
+memory map and only the requested columns are read. An explicit dtype schema can be derived from the
+CREATE TABLE query so the columns are not inferred by scanning the file.
+"""
+import os
+import re
+import pandas as pd
+import logging
+from app_config import get_config
+from db_connection import get_pool
+
+logging.basicConfig(level=logging.DEBUG)
+logging.info('Executing the script as a standalone')
+
+'''
+Read Config File
+'''
+config = get_config()
+PATH = config['DATA']['PATH']
+COLUMNS = config.get('DATA', 'COLUMNS').split(",")
+FILE_FORMAT = config['DATA']['FORMAT']
+SCHEMA = config['DATA']['SCHEMA']
+FETCH_SIZE = 10000
+
+FILE_FORMATS = {'.csv': 'csv', '.parquet': 'parquet', '.pq': 'parquet', '.feather': 'feather', '.arrow': 'feather'}
+COLUMN_PATTERN = re.compile(r"`(\w+)`\s+(\w+)\s*(?:\(([^)]*)\))?\s*(NOT NULL)?", re.IGNORECASE)
+
+
+def get_schema_columns(create_query_path):
+    # [(column, SQL type, size arguments e.g. (10, 2) of DECIMAL(10,2), NOT NULL)] in the order of the query
+    with open(create_query_path, 'r') as query_file:
+        create_query = query_file.read()
+    return [(col, sql_type.upper(), tuple(int(size) for size in sizes.split(",") if size.strip()), bool(not_null))
+            for col, sql_type, sizes, not_null in COLUMN_PATTERN.findall(create_query)]
+
+
+'''
+function: get_schema_dtypes
+Parameters: create_query_path -> string value; path of the CREATE TABLE query
+Returns: dict object {'col': dtype} with int32/int64 counts (nullable when the column allows NULL),
+         float32 decimals, float64 doubles and categorical strings
+'''
+
+
+def get_schema_dtypes(create_query_path):
+    dtypes = {}
+    for col, sql_type, _, not_null in get_schema_columns(create_query_path):
+        if sql_type in ('INT', 'INTEGER', 'SMALLINT', 'TINYINT', 'MEDIUMINT'):
+            dtypes[col] = 'int32' if not_null else 'Int32'
+        elif sql_type == 'BIGINT':
+            dtypes[col] = 'int64' if not_null else 'Int64'
+        elif sql_type in ('DECIMAL', 'FLOAT'):
+            dtypes[col] = 'float32'
+        elif sql_type == 'DOUBLE':
+            dtypes[col] = 'float64'
+        elif sql_type in ('CHAR', 'VARCHAR', 'TEXT'):
+            dtypes[col] = 'category'
+    return dtypes
+
+
+"""
+Class Name: DataLoader
+Parameters: database = database connectivity details
+            query = SQL Query to extract the data, or the path of a file with the query ({db} is the database name)
+            file_path = path a saved data file (only works when database is not given)
+            chunk_size = number of rows per chunk yielded by load_data_chunks
+            file_format = 'csv', 'parquet' or 'feather'; inferred from the file extension when not given
+            columns = list of the columns to read, in the order they are returned; all columns when not given
+            dtypes = dict of column dtypes, e.g. from get_schema_dtypes
+            pool = db_connection.ConnectionPool to check the connection out of; the shared pool for database by default
+Returns: a Loaded Model
+"""
+
+
+class DataLoader:
+    def __init__(self, database=None, query=None, file_path=None, chunk_size=None, file_format=None, columns=None,
+                 dtypes=None, pool=None):
+        self.database = database
+        self.query = query
+        self.data = None
+        self.file_path = file_path
+        self.chunk_size = chunk_size
+        self.file_format = file_format or FILE_FORMATS.get(os.path.splitext(str(file_path))[1].lower(), 'csv')
+        self.columns = columns
+        self.dtypes = dtypes
+        self.pool = pool
+
+    def get_dtypes(self, columns):
+        if not self.dtypes:
+            return None
+        return {col: dtype for col, dtype in self.dtypes.items() if columns is None or col in columns}
+
+    def apply_schema(self, data, cast=True):
+        if self.columns is not None and list(data.columns) != list(self.columns):
+            data = data[self.columns]
+        dtypes = self.get_dtypes(data.columns) if cast else None
+        if dtypes:
+            data = data.astype(dtypes)
+        return data
+
+    def read_arrow_table(self):
+        if self.file_format == 'parquet':
+            import pyarrow.parquet as pq
+            return pq.read_table(self.file_path, columns=self.columns, memory_map=True)
+        import pyarrow.feather as feather
+        return feather.read_table(self.file_path, columns=self.columns, memory_map=True)
+
+    def get_query(self):
+        if os.path.isfile(self.query):
+            with open(self.query, 'r') as query_file:
+                return query_file.read().format(db=self.database.get('database'))
+        return self.query
+
+    def load_sql_chunks(self):
+        pool = self.pool if self.pool is not None else get_pool(self.database)
+        with pool.connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(self.get_query())
+            columns = [description[0] for description in cursor.description]
+            start = 0
+            while True:
+                rows = cursor.fetchmany(self.chunk_size or FETCH_SIZE)
+                if not rows:
+                    break
+                chunk = self.apply_schema(pd.DataFrame.from_records(rows, columns=columns, coerce_float=True))
+                chunk.index = pd.RangeIndex(start, start + len(chunk))
+                start += len(chunk)
+                yield chunk
+            cursor.close()
+            connection.rollback()
+
+    def load_data(self):
+        try:
+            logging.info('Loading the Data')
+            if self.database and self.query:
+                logging.info('Loading the Data From database')
+                chunks = list(self.load_sql_chunks())
+                self.data = pd.concat(chunks) if chunks else pd.DataFrame(columns=self.columns)
+                logging.info('Successfully loaded the data from the database')
+            elif self.file_format == 'csv':
+                logging.info('Loading the data from csv')
+                self.data = self.apply_schema(pd.read_csv(self.file_path, usecols=self.columns,
+                                                          dtype=self.get_dtypes(self.columns)), cast=False)
+                logging.info('Successfully loaded the data from CSV')
+            else:
+                logging.info('Loading the data from ' + self.file_format)
+                self.data = self.apply_schema(self.read_arrow_table().to_pandas())
+                logging.info('Successfully loaded the data from ' + self.file_format)
+        except Exception as e:
+            logging.error('There some problem with loading the data. Please check the error below.')
+            logging.error(e)
+            return None
+        return self.data
+
+    def load_arrow_chunks(self):
+        if self.file_format == 'parquet':
+            import pyarrow.parquet as pq
+            batches = pq.ParquetFile(self.file_path, memory_map=True).iter_batches(batch_size=self.chunk_size,
+                                                                                   columns=self.columns)
+        else:
+            batches = self.read_arrow_table().to_batches(max_chunksize=self.chunk_size)
+        start = 0
+        for batch in batches:
+            chunk = self.apply_schema(batch.to_pandas())
+            chunk.index = pd.RangeIndex(start, start + len(chunk))
+            start += len(chunk)
+            yield chunk
+
+    def load_data_chunks(self):
+        logging.info('Loading the data in chunks of ' + str(self.chunk_size) + ' rows')
+        if self.database and self.query:
+            for chunk in self.load_sql_chunks():
+                yield chunk
+        elif self.file_format == 'csv':
+            chunks = pd.read_csv(self.file_path, chunksize=self.chunk_size, usecols=self.columns,
+                                 dtype=self.get_dtypes(self.columns))
+            for chunk in chunks:
+                yield self.apply_schema(chunk, cast=False)
+        else:
+            for chunk in self.load_arrow_chunks():
+                yield chunk
+        logging.info('Successfully loaded all the chunks')
+
+
+if __name__ == "__main__":
+    loader = DataLoader(file_path=PATH, file_format=FILE_FORMAT or None, columns=COLUMNS,
+                        dtypes=get_schema_dtypes(SCHEMA) if SCHEMA else None)
+    my_data = loader.load_data()
+    print(my_data.dtypes)
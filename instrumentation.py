@@ -0,0 +1,216 @@
+"""
+This module records the wall time, CPU time, rows and memory of every stage of a pipeline run
+
+Every stage is measured with the stage context manager. A stage that runs several times (once per chunk in a
+chunked run) is aggregated under its name. The run is reported as a JSON document and optionally as a Prometheus
+textfile (for the node exporter textfile collector), both written atomically so a scraper never reads half a file.
+
+Peak RSS comes from the resource module and is not reported on Windows. Python allocations are traced with
+tracemalloc only when trace_memory is set, because tracing slows the stages down.
+
+CPU time and traced memory are process wide, so when the stages run concurrently (overlapped, e.g. the pipelined
+mode) they can not be told apart: only the wall time of the stages is reported then, and the CPU time of the run.
+"""
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+from app_config import get_config
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+logging.basicConfig(level=logging.DEBUG)
+logging.info('Executing the script as a standalone')
+
+'''
+Read Config File
+'''
+config = get_config()
+SERVICE = config['SERVICE']['SERVICENAME']
+REPORT = config['METRICS']['REPORT']
+PROMETHEUS = config['METRICS']['PROMETHEUS']
+TRACEMALLOC = config.getboolean('METRICS', 'TRACEMALLOC')
+
+METRIC_PREFIX = 'default_prediction'
+STAGE_METRICS = [('wall_seconds', 'Wall time spent in the stage'),
+                 ('cpu_seconds', 'CPU time spent in the stage'),
+                 ('rows', 'Rows processed by the stage'),
+                 ('rows_per_second', 'Rows processed per second of wall time'),
+                 ('peak_rss_bytes', 'Peak resident set size of the process at the end of the stage'),
+                 ('tracemalloc_delta_bytes', 'Python memory still allocated at the end of the stage'),
+                 ('tracemalloc_peak_bytes', 'Peak Python memory allocated during the stage')]
+
+
+def get_peak_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # kilobytes everywhere but macOS
+
+
+def write_atomically(path, text):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as temp_file:
+        temp_file.write(text)
+    os.replace(temp_path, path)
+
+
+'''
+class: PipelineInstrumentation
+Parameters: name -> name of the pipeline, reported with the run
+            trace_memory -> trace the Python allocations of every stage with tracemalloc
+            overlapped -> the stages run concurrently; their CPU time and traced memory are not reported
+Returns: the run report dict from get_report
+'''
+
+
+class PipelineInstrumentation:
+    def __init__(self, name=SERVICE, trace_memory=False, overlapped=False):
+        self.name = name
+        self.trace_memory = trace_memory
+        self.overlapped = overlapped
+        self.stages = OrderedDict()
+        self.started_at = None
+        self.start_wall = None
+        self.start_cpu = None
+        self.wall_seconds = None
+        self.cpu_seconds = None
+        self.status = None
+        self.values = OrderedDict()
+        self.started_tracing = False
+
+    def start(self):
+        self.stages = OrderedDict()
+        self.values = OrderedDict()
+        self.started_at = datetime.now()
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.status = None
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+
+    def stop(self, status):
+        self.wall_seconds = time.perf_counter() - self.start_wall
+        self.cpu_seconds = time.process_time() - self.start_cpu
+        self.status = status
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+    def get_stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = {'stage': name, 'calls': 0, 'wall_seconds': 0.0,
+                                 'cpu_seconds': None if self.overlapped else 0.0, 'rows': 0,
+                                 'rows_per_second': None, 'peak_rss_bytes': None, 'tracemalloc_delta_bytes': None,
+                                 'tracemalloc_peak_bytes': None}
+        return self.stages[name]
+
+    @contextmanager
+    def stage(self, name):
+        # the caller sets counts['rows'] to the number of rows the stage processed
+        counts = {'rows': 0}
+        tracing = tracemalloc.is_tracing() and not self.overlapped
+        if tracing:
+            tracemalloc.reset_peak()
+            traced_before = tracemalloc.get_traced_memory()[0]
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            yield counts
+        finally:
+            metrics = self.get_stage(name)
+            metrics['calls'] += 1
+            metrics['wall_seconds'] += time.perf_counter() - start_wall
+            if not self.overlapped:
+                metrics['cpu_seconds'] += time.process_time() - start_cpu
+            metrics['rows'] += counts['rows'] or 0
+            if metrics['wall_seconds'] > 0:
+                metrics['rows_per_second'] = metrics['rows'] / metrics['wall_seconds']
+            metrics['peak_rss_bytes'] = get_peak_rss()
+            if tracing:
+                traced, traced_peak = tracemalloc.get_traced_memory()
+                metrics['tracemalloc_delta_bytes'] = (metrics['tracemalloc_delta_bytes'] or 0) + traced - traced_before
+                metrics['tracemalloc_peak_bytes'] = max(metrics['tracemalloc_peak_bytes'] or 0,
+                                                        traced_peak - traced_before)
+
+    def record_value(self, name, value):
+        # run level values that are not stage timings, e.g. cache hit rates
+        self.values[name] = value
+
+    def instrument_chunks(self, name, chunks):
+        # times the production of every chunk (e.g. reading it) as one call of the stage
+        chunks = iter(chunks)
+        while True:
+            with self.stage(name) as counts:
+                chunk = next(chunks, None)
+                counts['rows'] = len(chunk) if chunk is not None else 0
+            if chunk is None:
+                return
+            yield chunk
+
+    def get_report(self):
+        return {'pipeline': self.name,
+                'started_at': self.started_at.isoformat() if self.started_at else None,
+                'status': self.status,
+                'wall_seconds': self.wall_seconds,
+                'cpu_seconds': self.cpu_seconds,
+                'peak_rss_bytes': get_peak_rss(),
+                'stages': list(self.stages.values()),
+                'values': dict(self.values)}
+
+    def write_report(self, path):
+        write_atomically(path, json.dumps(self.get_report(), indent=2))
+        logging.info("Saved the run report at " + path)
+
+    def get_prometheus_metrics(self):
+        lines = []
+        for metric, description in STAGE_METRICS:
+            values = [(stage['stage'], stage[metric]) for stage in self.stages.values() if stage[metric] is not None]
+            if not values:
+                continue
+            lines.append('# HELP %s_stage_%s %s' % (METRIC_PREFIX, metric, description))
+            lines.append('# TYPE %s_stage_%s gauge' % (METRIC_PREFIX, metric))
+            for stage, value in values:
+                lines.append('%s_stage_%s{pipeline="%s",stage="%s"} %s' % (METRIC_PREFIX, metric, self.name, stage,
+                                                                           repr(float(value))))
+        run_metrics = [('run_status', 'Status of the last run, 0 on success', self.status),
+                       ('run_wall_seconds', 'Wall time of the last run', self.wall_seconds),
+                       ('run_cpu_seconds', 'CPU time of the last run', self.cpu_seconds),
+                       ('run_timestamp_seconds', 'Start time of the last run',
+                        self.started_at.timestamp() if self.started_at else None)]
+        run_metrics += [(name, name.replace('_', ' ').capitalize() + ' of the last run', value)
+                        for name, value in self.values.items()]
+        for metric, description, value in run_metrics:
+            if value is None:
+                continue
+            lines.append('# HELP %s_%s %s' % (METRIC_PREFIX, metric, description))
+            lines.append('# TYPE %s_%s gauge' % (METRIC_PREFIX, metric))
+            lines.append('%s_%s{pipeline="%s"} %s' % (METRIC_PREFIX, metric, self.name, repr(float(value))))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        write_atomically(path, self.get_prometheus_metrics())
+        logging.info("Saved the Prometheus metrics at " + path)
+
+
+if __name__ == "__main__":
+    instrumentation = PipelineInstrumentation(trace_memory=TRACEMALLOC)
+    instrumentation.start()
+    with instrumentation.stage('allocate') as stage_counts:
+        numbers = list(range(1000000))
+        stage_counts['rows'] = len(numbers)
+    instrumentation.stop(0)
+    print(json.dumps(instrumentation.get_report(), indent=2))
+    print(instrumentation.get_prometheus_metrics())
@@ -1,47 +1,280 @@
-"""
-Import Required Libraries
-"""
-import pickle
-import logging
-from configparser import ConfigParser
-
-
-logging.basicConfig(level=logging.DEBUG)
-logging.info('Executing the script as a standalone')
-
-'''
-Read Config File
-'''
-config = ConfigParser()
-config.read('config.ini')
-MODEL_PATH = config['MODELS']['CLASSIFIER']
-
-"""
-Class Name: Model
-Parameters: model_path --> Full or relative path in double quotes
-Returns: a Loaded Model
-"""
-
-
-class Model:
-    def __init__(self, model_path):
-        self.model_path = model_path
-        self.model = None
-
-    def load_model(self):
-        try:
-            logging.info('Loading the Model')
-            self.model = pickle.load(open(self.model_path,'rb'))
-            logging.info('Successfully loaded the model')
-        except Exception as e:
-            logging.error('Could not load the model. Please check the path and model file. Please check the error here')
-            logging.error(e)
-            return None
-        return self.model
-
-
-if __name__ == "__main__":
-    my_model = Model(MODEL_PATH)
-    my_loaded_model = my_model.load_model()
-    print(my_loaded_model)
-
+"""
+Import Required Libraries
+
+An artifact is either a pickle file or a memory mapped artifact directory written by export_artifact: a
+header.json with the class, parameters and scalar attributes of the artifact and one .npy file per array,
+loaded with np.load(mmap_mode='r'). The arrays are then pages of the file shared by every process through the
+page cache instead of a private copy per worker, and loading does not read them at all.
+Scalers and linear models keep their sklearn class; tree ensembles are exported as the node arrays of
+infer.CompiledTreeEnsemble, which scores like predict_proba.
+
+Usage: python load_model.py export <pickle path> <artifact directory>
+"""
+import hashlib
+import importlib
+import json
+import os
+import pickle
+import logging
+import shutil
+import sys
+import threading
+import time
+from collections import OrderedDict
+from app_config import get_config
+import numpy as np
+
+
+logging.basicConfig(level=logging.DEBUG)
+logging.info('Executing the script as a standalone')
+
+'''
+Read Config File
+'''
+config = get_config()
+MODEL_PATH = config['MODELS']['CLASSIFIER']
+CACHE_SIZE = int(config['MODELS']['CACHE_SIZE'])
+
+ARTIFACT_HEADER = 'header.json'
+ARTIFACT_FORMAT = 1
+TEMP_SUFFIX = '.tmp'
+OLD_SUFFIX = '_old'
+TREE_MODELS = ['RandomForestClassifier', 'ExtraTreesClassifier', 'DecisionTreeClassifier', 'GradientBoostingClassifier']
+LINEAR_MODELS = ['LogisticRegression']
+SCALERS = ['MinMaxScaler', 'StandardScaler']
+EQUIVALENCE_ROWS = 1000
+
+
+def get_artifact_file(path):
+    # the header of an artifact directory holds the checksum of its arrays, so it stands for the whole directory
+    return os.path.join(path, ARTIFACT_HEADER) if os.path.isdir(path) else path
+
+
+def to_json_value(value):
+    value = value.item() if isinstance(value, np.generic) else value
+    try:
+        json.dumps(value)
+    except (TypeError, ValueError):
+        return None, False
+    return value, True
+
+
+def check_exportable(artifact):
+    # only what the pipeline scores with: the scalers and the binary models infer can compile (the tree models are
+    # checked by CompiledTreeEnsemble.compile, e.g. gradient boosting only with the log loss)
+    name = type(artifact).__name__
+    if name in LINEAR_MODELS and artifact.coef_.shape[0] != 1:
+        raise ValueError("Only binary linear models can be exported")
+    if hasattr(artifact, 'get_params') and name not in TREE_MODELS + LINEAR_MODELS + SCALERS:
+        raise ValueError("The model " + name + " can not be exported")
+
+
+def get_artifact_state(artifact):
+    check_exportable(artifact)
+    name = type(artifact).__name__
+    if name in TREE_MODELS:
+        from infer import CompiledTreeEnsemble
+        artifact = CompiledTreeEnsemble.compile(None, artifact)
+        name = type(artifact).__name__
+    header = {'module': type(artifact).__module__, 'class': name}
+    if hasattr(artifact, 'get_state'):
+        header['kind'] = 'compiled'
+        header['params'], arrays = artifact.get_state()
+        return header, arrays
+    if hasattr(artifact, 'get_params'):
+        header.update(kind='estimator', params={}, attributes={}, object_arrays={})
+        for key, value in artifact.get_params(deep=False).items():
+            header['params'][key], is_json = to_json_value(value)
+            if not is_json:
+                raise ValueError("The parameter " + key + " of " + name + " can not be exported")
+        arrays = {}
+        for key, value in vars(artifact).items():
+            if not key.endswith('_') or key.startswith('_'):
+                continue
+            if isinstance(value, np.ndarray) and value.dtype != object:
+                arrays[key] = value
+            elif isinstance(value, np.ndarray):
+                header['object_arrays'][key] = value.tolist()
+            else:
+                header['attributes'][key], is_json = to_json_value(value)
+                if not is_json:
+                    raise ValueError("The attribute " + key + " of " + name + " can not be exported")
+        return header, arrays
+    header = {'kind': 'json'}
+    header['value'], is_json = to_json_value(artifact)
+    if not is_json:
+        raise ValueError("The artifact " + name + " can not be exported")
+    return header, {}
+
+
+def export_artifact(artifact, path):
+    header, arrays = get_artifact_state(artifact)
+    temp_path = path + TEMP_SUFFIX
+    shutil.rmtree(temp_path, ignore_errors=True)
+    os.makedirs(temp_path)
+    checksum = hashlib.sha256()
+    for name in sorted(arrays):
+        array = np.ascontiguousarray(arrays[name])
+        np.save(os.path.join(temp_path, name + '.npy'), array, allow_pickle=False)
+        checksum.update(name.encode('utf-8'))
+        checksum.update(array.tobytes())
+    header.update(format=ARTIFACT_FORMAT, arrays=sorted(arrays))
+    checksum.update(json.dumps(header, sort_keys=True).encode('utf-8'))
+    header['checksum'] = checksum.hexdigest()
+    with open(os.path.join(temp_path, ARTIFACT_HEADER), 'w') as header_file:
+        json.dump(header, header_file, indent=2)
+    # swapped in whole so a reader never maps the arrays of two versions
+    if os.path.exists(path):
+        shutil.rmtree(path + OLD_SUFFIX, ignore_errors=True)
+        os.replace(path, path + OLD_SUFFIX)
+    os.replace(temp_path, path)
+    shutil.rmtree(path + OLD_SUFFIX, ignore_errors=True)
+    return path
+
+
+def load_artifact_directory(path):
+    with open(os.path.join(path, ARTIFACT_HEADER), 'r') as header_file:
+        header = json.load(header_file)
+    if header.get('format') != ARTIFACT_FORMAT:
+        raise ValueError("Unsupported artifact format " + str(header.get('format')) + " in " + path)
+    if header['kind'] == 'json':
+        return header['value']
+    arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r', allow_pickle=False)
+              for name in header['arrays']}
+    artifact_class = getattr(importlib.import_module(header['module']), header['class'])
+    if header['kind'] == 'compiled':
+        return artifact_class(**header['params'], **arrays)
+    artifact = artifact_class(**header['params'])
+    for key, value in header['attributes'].items():
+        setattr(artifact, key, value)
+    for key, value in header['object_arrays'].items():
+        setattr(artifact, key, np.array(value, dtype=object))
+    for key, value in arrays.items():
+        setattr(artifact, key, value)
+    return artifact
+
+
+def load_artifact(path):
+    if os.path.isdir(path):
+        return load_artifact_directory(path)
+    with open(path, 'rb') as artifact_file:
+        return pickle.load(artifact_file)
+
+
+def is_equivalent(original, exported, features):
+    if hasattr(original, 'predict_proba'):
+        return np.allclose(original.predict_proba(features), exported.predict_proba(features), rtol=1e-9, atol=1e-12)
+    if hasattr(original, 'transform'):
+        return np.allclose(original.transform(features), exported.transform(features), rtol=1e-9, atol=1e-12)
+    return original == exported
+
+"""
+Class Name: ArtifactRegistry
+Parameters: max_size --> maximum number of loaded artifacts kept in memory
+            use_hash --> key the artifacts on a sha256 of the file (the header of an artifact directory) instead of
+                         its modification time
+Returns: the loaded artifact from get, loading the file only when it is not cached or has changed
+"""
+
+
+class ArtifactRegistry:
+    def __init__(self, max_size=8, use_hash=False):
+        self.max_size = max_size
+        self.use_hash = use_hash
+        self.artifacts = OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_key(self, path):
+        full_path = os.path.abspath(path)
+        if self.use_hash:
+            with open(get_artifact_file(full_path), 'rb') as artifact_file:
+                return full_path, hashlib.sha256(artifact_file.read()).hexdigest()
+        stat = os.stat(get_artifact_file(full_path))
+        return full_path, stat.st_mtime_ns, stat.st_size
+
+    def get(self, path):
+        key = self.get_key(path)
+        with self.lock:
+            if key in self.artifacts:
+                self.artifacts.move_to_end(key)
+                self.hits += 1
+                return self.artifacts[key]
+            self.misses += 1
+            artifact = load_artifact(path)
+            for stale_key in [k for k in self.artifacts if k[0] == key[0]]:
+                del self.artifacts[stale_key]
+            self.artifacts[key] = artifact
+            while len(self.artifacts) > self.max_size:
+                self.artifacts.popitem(last=False)
+            return artifact
+
+    def clear(self):
+        with self.lock:
+            self.artifacts.clear()
+
+
+ARTIFACT_REGISTRY = ArtifactRegistry(max_size=CACHE_SIZE)
+
+"""
+Class Name: Model
+Parameters: model_path --> Full or relative path in double quotes; a pickle file or an artifact directory
+            use_cache --> reuse the artifact already loaded in this process by ARTIFACT_REGISTRY
+Returns: a Loaded Model
+"""
+
+
+class Model:
+    def __init__(self, model_path, use_cache=True):
+        self.model_path = model_path
+        self.use_cache = use_cache
+        self.model = None
+
+    def load_model(self):
+        try:
+            logging.info('Loading the Model')
+            if self.use_cache:
+                self.model = ARTIFACT_REGISTRY.get(self.model_path)
+            else:
+                self.model = load_artifact(self.model_path)
+            logging.info('Successfully loaded the model')
+        except Exception as e:
+            logging.error('Could not load the model. Please check the path and model file. Please check the error here')
+            logging.error(e)
+            return None
+        return self.model
+
+    def export_model(self, artifact_path, features=None):
+        # features (scaled like the model input) check the exported artifact scores like the loaded one
+        try:
+            if self.model is None and self.load_model() is None:
+                return -1
+            export_artifact(self.model, artifact_path)
+            if features is not None and not is_equivalent(self.model, load_artifact(artifact_path), features):
+                logging.error('The exported artifact ' + artifact_path + ' does not match ' + self.model_path)
+                return -1
+            logging.info('Exported ' + self.model_path + ' to ' + artifact_path)
+        except Exception as e:
+            logging.error('Could not export the model. Please check the error here')
+            logging.error(e)
+            return -1
+        return 0
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == 'export':
+        pickled = Model(sys.argv[2], use_cache=False).load_model()
+        n_features = getattr(pickled, 'n_features_in_', None)
+        check_features = np.random.default_rng(0).random((EQUIVALENCE_ROWS, n_features)) if n_features else None
+        if Model(sys.argv[2], use_cache=False).export_model(sys.argv[3], check_features) != 0:
+            raise SystemExit(1)
+        for load_path in [sys.argv[2], sys.argv[3]]:
+            load_start = time.perf_counter()
+            load_artifact(load_path)
+            logging.info("Loaded %s in %.4fs", load_path, time.perf_counter() - load_start)
+    else:
+        my_model = Model(MODEL_PATH)
+        my_loaded_model = my_model.load_model()
+        print(my_loaded_model)
+
@@ -1,137 +1,453 @@
-from configparser import ConfigParser
-import logging
-from datetime import date
-import pandas as pd
-import mysql.connector
-
-'''
-This python script will persist the output data to the destination we provide.
-example - Local file storage, HDFS file storage or SQL Database
-'''
-
-logging.basicConfig(level=logging.DEBUG)
-logging.info('Executing the script as a standalone')
-
-'''
-Read config variables
-'''
-config = ConfigParser()
-config.read('config.ini')
-TABLE = config['DESTINATION']['TABLE']
-PATH = config['DESTINATION']['PATH']
-USER = config['DATABASE']['USER']
-PASSWORD = config['DATABASE']['PASSWORD']
-HOST = config['DATABASE']['HOST']
-PORT = int(config['DATABASE']['PORT'])
-DATABASE = config['DATABASE']['DATABASE']
-INSERT_QUERY = config['QUERY']['INSERT']
-DROP_QUERY = config['QUERY']['DROP']
-CREATE_QUERY = config['QUERY']['CREATE']
-
-
-class DataPersister:
-    def __init__(self, data, db=None, table=None, create_query=None, drop_query=None, insert_query=None, path=None):
-        self.db = db
-        self.connector = None
-        self.table = table
-        self.data = data
-        self.path = path
-        self.drop_query = drop_query
-        self.create_query = create_query
-        self.insert_query = insert_query
-        self.cursor = None
-
-    def connect_to_db(self):
-        try:
-            logging.info("Establishing connection with DB")
-            self.connector = mysql.connector.connect(user=self.db.get('user'),
-                                                     password=self.db.get('password'),
-                                                     host=self.db.get('host'),
-                                                     port=self.db.get('port'),
-                                                     database=self.db.get('database')
-                                                     )
-            self.cursor = self.connector.cursor()
-            logging.info("Successfully connected to DB")
-        except Exception as e:
-            logging.error("Failed to connect to the DB. Please check the error below")
-            logging.error(e)
-            return 1
-        return 0
-
-    def save_to_file(self):
-        try:
-            logging.info("Saving to File")
-            file_path = self.path + str(date.today()) + ".csv"
-            self.data.to_csv(file_path)
-            logging.info("Successfully saved the file at the provided path")
-        except Exception as e:
-            logging.error("Failed to save the file to the path. Please check the error below")
-            logging.error(e)
-            return 1
-        return 0
-
-    def save_to_table(self):
-        try:
-            self.create_query = open(self.create_query, 'r').read()
-            self.drop_query = open(self.drop_query, 'r').read()
-            self.insert_query = open(self.insert_query, 'r').read()
-
-            logging.info("Saving to Table")
-            cols = "`,`".join([str(i) for i in self.data.columns.tolist()])
-
-            self.cursor.execute(self.drop_query.format(db=self.db.get('database'), table=self.table))
-            #self.cursor.execute("Drop Table if Exists hackathon_demo.bank_loan_default_prediction")
-            self.connector.commit()
-
-            self.cursor.execute(self.create_query.format(db=self.db.get('database'), table=self.table))
-            self.connector.commit()
-
-            for i, row in self.data.iterrows():
-                #sql = "INSERT INTO `"+self.table+"` (`"+cols+"`) VALUES ("+"%s," * (len(row) - 1) + "%s)"
-                sql = self.insert_query.format(table=self.table, columns=cols)
-                self.cursor.execute(sql, tuple(row))
-            self.connector.commit()
-            logging.info("Successfully saved to table")
-        except Exception as e:
-            logging.error("Failed to save to Table")
-            logging.error(e)
-            return 1
-        return 0
-
-    def persist(self):
-        try:
-            logging.info("Started Persisting the data")
-            if self.db:
-                connection_result = self.connect_to_db()
-                if connection_result != 0:
-                    logging.error("Failed to Persist")
-                    return -1
-                save_result = self.save_to_table()
-                if save_result != 0:
-                    logging.error("Failed to Persist")
-                    return -1
-            else:
-                save_result = self.save_to_file()
-                if save_result != 0:
-                    logging.error("Failed to Persist")
-                    return -1
-        except Exception as e:
-            logging.error("Failed to Persist to Table. Check error below")
-            logging.error(e)
-            return -1
-        return 0
-
-
-if __name__ == "__main__":
-    DATA = "data\\insights\\2020-07-31.csv"
-    data_ = pd.read_csv(DATA)
-    database_details = {'user': USER, 'password': PASSWORD, 'host': HOST, 'port': PORT, 'database': DATABASE}
-    persister = DataPersister(data_, db=database_details, table=TABLE, path=PATH, create_query=CREATE_QUERY,
-                              drop_query=DROP_QUERY, insert_query=INSERT_QUERY)
-    persister.persist()
-    print(config.items('DATABASE'))
-
-
-
-
-
+from app_config import get_config
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+from datetime import date
+from urllib.parse import quote
+import pandas as pd
+from db_connection import get_pool
+
+'''
+This python script will persist the output data to the destination we provide.
+example - Local file storage, HDFS file storage or SQL Database
+
+Rows are written to the table in chunks with one commit per chunk. Supported write modes:
+row         -> one execute per row (previous behaviour)
+executemany -> one executemany per chunk, sent as a multi-row INSERT by the MySQL connector
+load_data   -> LOAD DATA LOCAL INFILE from a temporary CSV file per chunk
+
+Supported persist modes for the table:
+replace -> drop and recreate the table before inserting the data
+swap    -> load a staging table and swap it in with one atomic RENAME TABLE, so readers never see a partial table
+upsert  -> create the table if needed and insert or update the rows on their primary key (loan_id) with
+           INSERT ... AS new ON DUPLICATE KEY UPDATE col=new.col on MySQL 8.0.19+, or with
+           ON DUPLICATE KEY UPDATE col=VALUES(col) on older MySQL servers, MariaDB and connections that do not report
+           their server version; MySQL does not rewrite rows whose values are unchanged. In load_data mode every
+           chunk is loaded into a temporary table and upserted from there, so existing rows are updated in place
+           like in the other write modes instead of deleted and reinserted
+
+Supported file formats: csv (optionally gzip/bz2/xz/zstd compressed) and parquet (snappy/zstd/gzip compressed),
+written in chunks of chunk_size rows. Parquet outputs and outputs partitioned by columns (e.g. Customer_tiers and
+loan_type) are directories of part files in Hive layout (col=value/part-00000.parquet), so readers only scan the
+partitions they need. Files are written to a temporary path that is renamed to the output path once complete,
+so readers never see a partial file.
+'''
+
+logging.basicConfig(level=logging.DEBUG)
+logging.info('Executing the script as a standalone')
+
+'''
+Read config variables
+'''
+config = get_config()
+TABLE = config['DESTINATION']['TABLE']
+PATH = config['DESTINATION']['PATH']
+USER = config['DATABASE']['USER']
+PASSWORD = config['DATABASE']['PASSWORD']
+HOST = config['DATABASE']['HOST']
+PORT = int(config['DATABASE']['PORT'])
+DATABASE = config['DATABASE']['DATABASE']
+INSERT_QUERY = config['QUERY']['INSERT']
+DROP_QUERY = config['QUERY']['DROP']
+CREATE_QUERY = config['QUERY']['CREATE']
+WRITE_MODE = config['DESTINATION']['WRITE_MODE']
+CHUNKSIZE = int(config['DESTINATION']['CHUNKSIZE'])
+MODE = config['DESTINATION']['MODE']
+FILE_FORMAT = config['DESTINATION']['FORMAT']
+COMPRESSION = config['DESTINATION']['COMPRESSION']
+PARTITION_BY = [col for col in config['DESTINATION']['PARTITION_BY'].split(",") if col]
+
+LOAD_DATA_QUERY = "LOAD DATA LOCAL INFILE '{path}' INTO TABLE `{table}` FIELDS TERMINATED BY ',' " \
+                  "OPTIONALLY ENCLOSED BY '\"' LINES TERMINATED BY '\\n' (`{columns}`)"
+SWAP_QUERY = "RENAME TABLE {db}.{table} TO {db}.{old}, {db}.{staging} TO {db}.{table}"
+CREATE_UPSERT_STAGING_QUERY = "CREATE TEMPORARY TABLE IF NOT EXISTS `{staging}` LIKE `{table}`"
+CLEAR_UPSERT_STAGING_QUERY = "DELETE FROM `{staging}`"
+DROP_UPSERT_STAGING_QUERY = "DROP TEMPORARY TABLE IF EXISTS `{staging}`"
+# new is the derived table of the staged rows here, which both update forms of get_upsert_updates can follow
+UPSERT_FROM_STAGING_QUERY = "INSERT INTO `{table}` (`{columns}`) SELECT * FROM (SELECT `{columns}` FROM `{staging}`) " \
+                            "AS new ON DUPLICATE KEY UPDATE {updates}"
+STAGING_SUFFIX = '_staging'
+UPSERT_SUFFIX = '_upsert'
+OLD_SUFFIX = '_old'
+TEMP_SUFFIX = '.tmp'
+ROW_ALIAS_VERSION = (8, 0, 19)  # first MySQL version with INSERT ... AS new ON DUPLICATE KEY UPDATE
+CSV_EXTENSIONS = {None: '.csv', 'gzip': '.csv.gz', 'bz2': '.csv.bz2', 'xz': '.csv.xz', 'zstd': '.csv.zst'}
+NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+
+
+def remove_path(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def copy_path(source, destination):
+    if os.path.isdir(source):
+        shutil.copytree(source, destination)
+    else:
+        shutil.copyfile(source, destination)
+
+
+def replace_path(temp_path, path):
+    # os.replace is atomic for files; a directory can only replace an empty one, so the previous output
+    # directory is renamed aside first and readers may briefly find no output, but never a partial one
+    if os.path.isdir(temp_path) and os.path.exists(path):
+        remove_path(path + OLD_SUFFIX)
+        os.replace(path, path + OLD_SUFFIX)
+        os.replace(temp_path, path)
+        remove_path(path + OLD_SUFFIX)
+    else:
+        os.replace(temp_path, path)
+
+
+'''
+class: DataPersister
+Parameters: data -> Pandas DataFrame
+            db -> dict of database connectivity details
+            write_mode -> 'row', 'executemany' or 'load_data'
+            chunk_size -> number of rows written and committed together
+            connector -> an already opened DB-API connection, used instead of connecting to db (e.g. sqlite3)
+            pool -> db_connection.ConnectionPool to check the connection out of; the shared pool for db by default
+                    (the data is saved to a table when any of db, connector or pool is given, else to a file)
+            append -> add the data to an existing table or file instead of recreating it (used for chunked runs)
+            persist_mode -> 'replace', 'swap' or 'upsert'
+            swap -> in swap mode, swap the staging table in after saving; for files, rename the temporary file to
+                    the output file after saving (False for all but the last chunk)
+            file_name -> name of the output file without the extension; today's date by default
+            file_format -> 'csv' or 'parquet'
+            compression -> 'gzip', 'bz2', 'xz' or 'zstd' for csv, 'snappy' (default), 'zstd' or 'gzip' for parquet
+            partition_cols -> list of the columns the output files are partitioned by
+Returns: 0 on success and -1 on failure from persist
+'''
+
+
+class DataPersister:
+    def __init__(self, data, db=None, table=None, create_query=None, drop_query=None, insert_query=None, path=None,
+                 write_mode='executemany', chunk_size=10000, connector=None, append=False, persist_mode='replace',
+                 swap=True, pool=None, file_name=None, file_format='csv', compression=None, partition_cols=None):
+        self.db = db
+        self.connector = connector
+        self.table = table
+        self.data = data
+        self.path = path
+        self.drop_query = drop_query
+        self.create_query = create_query
+        self.insert_query = insert_query
+        self.cursor = None
+        self.write_mode = write_mode
+        self.chunk_size = chunk_size
+        self.write_stats = None
+        self.append = append
+        self.persist_mode = persist_mode
+        self.swap = swap
+        self.pool = pool
+        self.pooled = False
+        self.file_name = file_name
+        self.file_format = file_format or 'csv'
+        self.compression = compression or None
+        self.partition_cols = partition_cols or []
+        self.row_alias = None
+
+    def connect_to_db(self):
+        try:
+            logging.info("Establishing connection with DB")
+            if self.connector is None:
+                if self.pool is None:
+                    db = dict(self.db, allow_local_infile=True) if self.write_mode == 'load_data' else self.db
+                    self.pool = get_pool(db)
+                self.connector = self.pool.get_connection()
+                self.pooled = True
+            self.cursor = self.connector.cursor()
+            logging.info("Successfully connected to DB")
+        except Exception as e:
+            logging.error("Failed to connect to the DB. Please check the error below")
+            logging.error(e)
+            return 1
+        return 0
+
+    def release_connection(self):
+        if self.pooled and self.connector is not None:
+            if self.cursor is not None:
+                self.cursor.close()
+            self.pool.recycle(self.connector)
+            self.connector = None
+            self.pooled = False
+
+    def is_table_output(self):
+        return bool(self.db) or self.connector is not None or self.pool is not None
+
+    def format_query(self, query, **tables):
+        database = self.db.get('database') if self.db else None
+        if database is None:  # a connector or pool without db details writes to the database it is connected to
+            query = query.replace('{db}.', '')
+        return query.format(db=database, **tables)
+
+    def is_directory_output(self):
+        return self.file_format == 'parquet' or bool(self.partition_cols)
+
+    def get_file_path(self):
+        file_path = self.path + (self.file_name or str(date.today()))
+        if self.is_directory_output():
+            return file_path
+        return file_path + CSV_EXTENSIONS[self.compression]
+
+    def get_partitions(self):
+        if not self.partition_cols:
+            yield '', self.data
+            return
+        for keys, partition in self.data.groupby(self.partition_cols, observed=True, dropna=False, sort=True):
+            keys = keys if isinstance(keys, tuple) else (keys,)
+            directories = [col + '=' + (NULL_PARTITION if pd.isna(key) else quote(str(key), safe=''))
+                           for col, key in zip(self.partition_cols, keys)]
+            yield os.path.join(*directories), partition.drop(columns=self.partition_cols)
+
+    def write_csv(self, data, file_path):
+        # compressed chunks are written as consecutive compressed streams, which gzip/bz2/xz/zstd readers concatenate
+        header = not os.path.exists(file_path)
+        with open(file_path, 'ab') as csv_file:
+            for start in range(0, max(len(data), 1), self.chunk_size):
+                data.iloc[start:start + self.chunk_size].to_csv(csv_file, header=header and start == 0,
+                                                                compression=self.compression)
+
+    def write_parquet(self, data, file_path):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        writer = None
+        try:
+            for start in range(0, max(len(data), 1), self.chunk_size):
+                table = pa.Table.from_pandas(data.iloc[start:start + self.chunk_size], preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(file_path, table.schema, compression=self.compression or 'snappy')
+                writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
+
+    def write_part(self, data, directory):
+        os.makedirs(directory, exist_ok=True)
+        extension = '.parquet' if self.file_format == 'parquet' else CSV_EXTENSIONS[self.compression]
+        part_path = os.path.join(directory, 'part-%05d%s' % (len(os.listdir(directory)), extension))
+        if self.file_format == 'parquet':
+            self.write_parquet(data, part_path)
+        else:
+            self.write_csv(data, part_path)
+
+    def save_to_file(self):
+        try:
+            logging.info("Saving to File")
+            file_path = self.get_file_path()
+            temp_path = file_path + TEMP_SUFFIX
+            if not self.append:
+                remove_path(temp_path)
+            elif not os.path.exists(temp_path) and os.path.exists(file_path):
+                copy_path(file_path, temp_path)  # appending to an output that was already renamed in
+            start = time.perf_counter()
+            if self.is_directory_output():
+                for directory, partition in self.get_partitions():
+                    self.write_part(partition, os.path.join(temp_path, directory))
+            else:
+                self.write_csv(self.data, temp_path)
+            if self.swap:
+                replace_path(temp_path, file_path)
+            logging.info("Wrote %d rows to %s in %.3f seconds", len(self.data), file_path, time.perf_counter() - start)
+            logging.info("Successfully saved the file at the provided path")
+        except Exception as e:
+            logging.error("Failed to save the file to the path. Please check the error below")
+            logging.error(e)
+            return 1
+        return 0
+
+    @staticmethod
+    def read_query(path):
+        with open(path, 'r') as query_file:
+            return query_file.read()
+
+    def save_to_table(self):
+        try:
+            create_query = self.read_query(self.create_query)
+            drop_query = self.read_query(self.drop_query)
+            insert_query = self.read_query(self.insert_query)
+
+            logging.info("Saving to Table")
+            cols = "`,`".join([str(i) for i in self.data.columns.tolist()])
+            table = self.table + STAGING_SUFFIX if self.persist_mode == 'swap' else self.table
+
+            if self.persist_mode == 'upsert':
+                self.cursor.execute(self.format_query(create_query, table=table))
+                self.connector.commit()
+            elif self.persist_mode not in ('replace', 'swap'):
+                raise ValueError("Unknown persist mode " + str(self.persist_mode))
+            elif not self.append:
+                self.cursor.execute(self.format_query(drop_query, table=table))
+                #self.cursor.execute("Drop Table if Exists hackathon_demo.bank_loan_default_prediction")
+                self.connector.commit()
+
+                self.cursor.execute(self.format_query(create_query, table=table))
+                self.connector.commit()
+
+            start = time.perf_counter()
+            sql = insert_query.format(table=table, columns=cols)
+            if self.persist_mode == 'upsert':
+                sql = self.get_upsert_query(sql)
+            if self.write_mode == 'row':
+                for i, row in self.data.iterrows():
+                    self.cursor.execute(sql, tuple(row))
+                self.connector.commit()
+            elif self.write_mode == 'executemany':
+                self.insert_chunks(sql)
+            elif self.write_mode == 'load_data':
+                self.load_data_chunks(table, cols)
+            else:
+                raise ValueError("Unknown write mode " + str(self.write_mode))
+            self.report_write_stats(time.perf_counter() - start)
+            logging.info("Successfully saved to table")
+            if self.persist_mode == 'swap' and self.swap:
+                return self.swap_tables()
+        except Exception as e:
+            logging.error("Failed to save to Table")
+            logging.error(e)
+            return 1
+        return 0
+
+    def swap_tables(self):
+        try:
+            logging.info("Swapping the staging table in")
+            create_query = self.read_query(self.create_query)
+            drop_query = self.read_query(self.drop_query)
+            old_table = self.table + OLD_SUFFIX
+            self.cursor.execute(self.format_query(create_query, table=self.table))
+            self.cursor.execute(self.format_query(drop_query, table=old_table))
+            self.cursor.execute(self.format_query(SWAP_QUERY, table=self.table, old=old_table,
+                                                  staging=self.table + STAGING_SUFFIX))
+            self.cursor.execute(self.format_query(drop_query, table=old_table))
+            self.connector.commit()
+            logging.info("Successfully swapped the staging table in")
+        except Exception as e:
+            logging.error("Failed to swap the staging table in")
+            logging.error(e)
+            return 1
+        return 0
+
+    def supports_row_alias(self):
+        # mysql.connector reports e.g. '8.0.21', '5.7.32-log' or '5.5.5-10.5.8-MariaDB'
+        if self.row_alias is None:
+            get_server_info = getattr(self.connector, 'get_server_info', None)
+            server = str(get_server_info() or '') if get_server_info is not None else ''
+            version = tuple(int(part) for part in re.findall(r'\d+', server)[:3])
+            self.row_alias = 'mariadb' not in server.lower() and version >= ROW_ALIAS_VERSION
+            logging.info("Upserting with %s on the server version '%s'",
+                         "the row alias" if self.row_alias else "VALUES()", server)
+        return self.row_alias
+
+    def get_upsert_updates(self):
+        # VALUES() in ON DUPLICATE KEY UPDATE is deprecated since MySQL 8.0.20, so the row alias is used where known
+        if self.supports_row_alias():
+            return ", ".join(["`{0}`=new.`{0}`".format(col) for col in self.data.columns.tolist()])
+        return ", ".join(["`{0}`=VALUES(`{0}`)".format(col) for col in self.data.columns.tolist()])
+
+    def get_upsert_query(self, insert_sql):
+        alias = " AS new" if self.supports_row_alias() else ""
+        return insert_sql.strip().rstrip(';') + alias + " ON DUPLICATE KEY UPDATE " + self.get_upsert_updates()
+
+    def get_chunks(self):
+        for start in range(0, len(self.data), self.chunk_size):
+            yield self.data.iloc[start:start + self.chunk_size]
+
+    def insert_chunks(self, sql):
+        for chunk in self.get_chunks():
+            self.cursor.executemany(sql, list(chunk.itertuples(index=False, name=None)))
+            self.connector.commit()
+
+    def load_data_chunks(self, table, cols):
+        upsert = self.persist_mode == 'upsert'
+        staging = table + UPSERT_SUFFIX
+        if upsert:
+            self.cursor.execute(CREATE_UPSERT_STAGING_QUERY.format(staging=staging, table=table))
+        try:
+            for chunk in self.get_chunks():
+                temp_file = tempfile.NamedTemporaryFile('w', suffix='.csv', newline='', delete=False)
+                try:
+                    with temp_file:
+                        chunk.to_csv(temp_file, index=False, header=False, na_rep='\\N', lineterminator='\n')
+                    if upsert:
+                        self.cursor.execute(CLEAR_UPSERT_STAGING_QUERY.format(staging=staging))
+                    self.cursor.execute(LOAD_DATA_QUERY.format(path=temp_file.name.replace('\\', '/'),
+                                                               table=staging if upsert else table, columns=cols))
+                    if upsert:
+                        self.cursor.execute(UPSERT_FROM_STAGING_QUERY.format(table=table, staging=staging, columns=cols,
+                                                                             updates=self.get_upsert_updates()))
+                    self.connector.commit()
+                finally:
+                    os.remove(temp_file.name)
+        finally:
+            if upsert:
+                self.cursor.execute(DROP_UPSERT_STAGING_QUERY.format(staging=staging))
+
+    def report_write_stats(self, seconds):
+        rows = len(self.data)
+        self.write_stats = {'rows': rows, 'seconds': seconds,
+                            'rows_per_second': rows / seconds if seconds > 0 else float('inf')}
+        logging.info("Wrote %d rows in %.3f seconds (%.0f rows/sec) using %s mode with chunks of %d rows",
+                     rows, seconds, self.write_stats['rows_per_second'], self.write_mode, self.chunk_size)
+
+    def persist_swap(self):
+        try:
+            logging.info("Started swapping the persisted data in")
+            if not self.is_table_output():
+                replace_path(self.get_file_path() + TEMP_SUFFIX, self.get_file_path())
+            elif self.connect_to_db() != 0 or self.swap_tables() != 0:
+                logging.error("Failed to Persist")
+                return -1
+        except Exception as e:
+            logging.error("Failed to swap the staging table in. Check error below")
+            logging.error(e)
+            return -1
+        finally:
+            self.release_connection()
+        return 0
+
+    def persist(self):
+        try:
+            logging.info("Started Persisting the data")
+            if self.is_table_output():
+                connection_result = self.connect_to_db()
+                if connection_result != 0:
+                    logging.error("Failed to Persist")
+                    return -1
+                save_result = self.save_to_table()
+                if save_result != 0:
+                    logging.error("Failed to Persist")
+                    return -1
+            else:
+                save_result = self.save_to_file()
+                if save_result != 0:
+                    logging.error("Failed to Persist")
+                    return -1
+        except Exception as e:
+            logging.error("Failed to Persist to Table. Check error below")
+            logging.error(e)
+            return -1
+        finally:
+            self.release_connection()
+        return 0
+
+
+if __name__ == "__main__":
+    DATA = "data\\insights\\2020-07-31.csv"
+    data_ = pd.read_csv(DATA)
+    database_details = {'user': USER, 'password': PASSWORD, 'host': HOST, 'port': PORT, 'database': DATABASE}
+    persister = DataPersister(data_, db=database_details, table=TABLE, path=PATH, create_query=CREATE_QUERY,
+                              drop_query=DROP_QUERY, insert_query=INSERT_QUERY, write_mode=WRITE_MODE,
+                              chunk_size=CHUNKSIZE, persist_mode=MODE, file_format=FILE_FORMAT,
+                              compression=COMPRESSION, partition_cols=PARTITION_BY)
+    persister.persist()
+    print(config.items('DATABASE'))
+
+
+
+
+
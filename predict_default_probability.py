@@ -1,227 +1,766 @@
-import logging
-from configparser import ConfigParser
-from ingest_data import DataLoader
-from prepare_input_data import DataPreprocessor
-from infer import Classifier
-from prepare_output_data import PostProcessor
-from persist_data import DataPersister
-from get_customer_tier import TierClassifier
-
-
-"""
-This script performs Data Ingestion to Insights Persisting by calling all the logic in Order
-"""
-
-'''
-Read Config File
-'''
-config = ConfigParser()
-config.read('config.ini')
-INPUT_PATH = config['DATA']['PATH']
-CLASSIFIER = config['MODELS']['CLASSIFIER']
-SCALER = config['MODELS']['SCALER']
-TABLE = config['DESTINATION']['TABLE']
-OUTPUT_PATH = config['DESTINATION']['PATH']
-SERVICE = config['SERVICE']['SERVICENAME']
-ENV = config['APP']['ENVIRONMENT']
-IDENTIFIERS = config.get('DATA','IDENTIFIERS').split(",")
-CATEGORICAL = config.get('DATA', 'CATEGORICAL').split(",")
-CUSTOMER = config.items('CUSTOMER')
-INSERT_QUERY = config['QUERY']['INSERT']
-DROP_QUERY = config['QUERY']['DROP']
-CREATE_QUERY = config['QUERY']['CREATE']
-USER = config['DATABASE']['USER']
-PASSWORD = config['DATABASE']['PASSWORD']
-HOST = config['DATABASE']['HOST']
-PORT = int(config['DATABASE']['PORT'])
-DATABASE = config['DATABASE']['DATABASE']
-
-logging.basicConfig(level=logging.DEBUG)
-logging.info("Executing in the standalone mode")
-logging.info('Started execution of '+SERVICE+' in the '+ENV+' environment')
-
-"""
-class: DefaultPredictor
-Parameters: 
-Returns: None
-Calls all operations in order
-Ingestion --> Data Preparation --> Model Load --> Infer --> Post Process --> Persist results
-"""
-
-
-class DefaultPredictor:
-    def __init__(self,  model_path, identifiers, categorical, customer_rules, scaler_path=None, sql=True, database=None,
-                 input_path=None, output_path=None, load_query=None, table=None, drop_query=None, create_query=None,
-                 insert_query=None):
-        self.model_path = model_path
-        self.scaler_path = scaler_path
-        self.sql = sql
-        self.database = database
-        self.input_path = input_path
-        self.output_path = output_path
-        self.load_query = load_query
-        self.drop_query = drop_query
-        self.create_query = create_query
-        self.insert_query = insert_query
-        self.table = table
-        self.identifiers = identifiers
-        self.categorical = categorical
-        self.customer_rules = customer_rules
-        self.input_data = None
-        self.transformed_data = None
-        self.predictions = None
-        self.customer_tiers = None
-        self.output_data = None
-
-    def validate_params(self):
-        try:
-            logging.info("Validating the input parameters")
-            if self.sql:
-                if self.database is None:
-                    logging.error("If SQL is TRUE then valid Database details should be provided")
-                    return -1
-                #elif self.load_query is None:
-                #    logging.error("If SQL is TRUE then a valid load query should be provided")
-                #    return -1
-                elif self.insert_query is None:
-                    logging.error("If SQL is TRUE then a valid save query should be provided")
-                    return -1
-                else:
-                    pass
-            else:
-                if self.input_path is None:
-                    logging.error("If SQL is False then a valid input path should be provided")
-                    return -1
-                elif self.output_path is None:
-                    logging.error("If SQL is False then a Valid output path should be given")
-                    return -1
-                else:
-                    pass
-            logging.info("Successfully validated the input Parameters")
-        except Exception as e:
-            logging.error("Failed to Validate the input Parameters")
-            return -1
-        return 0
-
-    def run_ingest_data(self):
-        try:
-            logging.info("Calling the method to ingest data")
-            data_loader = DataLoader(database=self.database, query=self.load_query, file_path=self.input_path)
-            self.input_data = data_loader.load_data()
-        except Exception as e:
-            logging.error("Failed to ingest data")
-            return -1
-        return 0
-
-    def run_prepare_input_data(self):
-        try:
-            logging.info("Calling the method to prepare input")
-            data_preprocessor = DataPreprocessor(data=self.input_data, scaler_path=self.scaler_path,
-                                                 identifiers=self.identifiers, categorical=self.categorical)
-            self.transformed_data = data_preprocessor.prepare_data()
-        except Exception as e:
-            logging.error("Failed to prepare data")
-            logging.error(e)
-            return -1
-        return 0
-
-    def run_infer(self):
-        try:
-            logging.info("Calling the method to infer data")
-            classifier = Classifier(data=self.transformed_data, model_path=self.model_path)
-            self.predictions = classifier.infer_data()
-        except Exception as e:
-            logging.error("Failed to Infer data")
-            return -1
-        return 0
-
-    def run_get_customer_tier(self):
-        try:
-            logging.info("calling the method to generate customer tier")
-            tier_classifier = TierClassifier(self.input_data, self.customer_rules)
-            self.customer_tiers = tier_classifier.rule_engine()
-        except Exception as e:
-            logging.error("Failed to get customer tiers")
-            return -1
-        return 0
-
-    def run_prepare_output_data(self):
-        try:
-            logging.info("Calling the method to prepare outputs")
-            post_processor = PostProcessor(data=self.input_data, predictions=self.predictions, tiers=self.customer_tiers)
-            self.output_data = post_processor.combine_data()
-        except Exception as e:
-            logging.error("Failed to prepare outputs")
-            return 1
-        return 0
-
-    def run_persist_data(self):
-        try:
-            logging.info("Calling the method persist data")
-            data_persister = DataPersister(data=self.output_data, db=self.database,
-                                           table=self.table, path=self.output_path,
-                                           create_query=self.create_query,
-                                           drop_query=self.drop_query,
-                                           insert_query=self.insert_query)
-            persist_results = data_persister.persist()
-            if persist_results != 0:
-                logging.error("Failed in persisting")
-                return -1
-            return 0
-        except Exception as e:
-            logging.error("Failed in persisting")
-            return -1
-
-    def run_default_pipeline(self):
-        try:
-            logging.info("Running the pipeline")
-            validate_results = self.validate_params()
-            if validate_results != 0:
-                logging.error("Failed to execute the pipeline at validating parameters")
-                return
-            ingest_results = self.run_ingest_data()
-            if ingest_results != 0:
-                logging.error("Failed to execute the pipeline at ingesting data")
-                return
-            prepare_input_results = self.run_prepare_input_data()
-            if prepare_input_results != 0:
-                logging.error("Failed to execute the pipeline at preparing inputs")
-                return
-            infer_results = self.run_infer()
-            if infer_results != 0:
-                logging.error("Failed to execute the pipeline at inferring data")
-                return
-            tier_results = self.run_get_customer_tier()
-            if tier_results != 0:
-                logging.error("Failed to execute the pipeline at getting tiers")
-                return
-            prepare_output_results = self.run_prepare_output_data()
-            if prepare_output_results != 0:
-                logging.error("Failed to execute the pipeline at preparing output data")
-                return
-            persist_results = self.run_persist_data()
-            if persist_results != 0:
-                logging.error("Failed to execute the pipeline at persisting data")
-                return
-            logging.info("Successfully executed the pipeline")
-        except Exception as e:
-            logging.error("Failed to execute the pipeline. Check the error below")
-            logging.error(e)
-        return
-
-
-if __name__ == "__main__":
-    database_details = {'user': USER, 'password': PASSWORD, 'host': HOST, 'port': PORT, 'database': DATABASE}
-    prediction_pipeline = DefaultPredictor(CLASSIFIER, IDENTIFIERS, CATEGORICAL, CUSTOMER, SCALER, sql=True,
-                                           input_path=INPUT_PATH, output_path=OUTPUT_PATH, table=TABLE,
-                                           drop_query=DROP_QUERY, create_query=CREATE_QUERY, insert_query=INSERT_QUERY,
-                                           database=database_details)
-    prediction_pipeline.run_default_pipeline()
-
-
-
-
-
-
-
-
+import itertools
+import logging
+import os
+from collections import Counter
+from datetime import date
+import numpy as np
+from app_config import get_config, PipelineSettings
+from ingest_data import DataLoader, get_schema_dtypes
+from prepare_input_data import DataPreprocessor, CategoricalEncoder, DataValidator
+from infer import Classifier
+from load_model import Model
+from prepare_output_data import PostProcessor
+from persist_data import DataPersister, STAGING_SUFFIX, TEMP_SUFFIX
+from get_customer_tier import TierClassifier
+from score_store import ScoreStore, hash_rows, get_model_version
+from instrumentation import PipelineInstrumentation
+from result_cache import ResultCache, hash_features
+from chunk_pipeline import ChunkPipeline
+from checkpoint_store import CheckpointStore, get_input_hash, get_output_mark, restore_output_mark
+
+
+"""
+This script performs Data Ingestion to Insights Persisting by calling all the logic in Order
+"""
+
+'''
+Read Config File
+'''
+config = get_config()
+SERVICE = config['SERVICE']['SERVICENAME']
+ENV = config['APP']['ENVIRONMENT']
+
+PIPELINE_STAGES = ['ingest', 'filter_changed', 'prepare_input', 'infer', 'customer_tier', 'prepare_output', 'persist',
+                   'record_scored']
+# what the stages after a checkpointed stage need from it
+STAGE_OUTPUTS = {'prepare_input': ['input_data', 'transformed_data', 'row_hashes', 'feature_hashes'],
+                 'infer': ['predictions'],
+                 'customer_tier': ['customer_tiers'],
+                 'prepare_output': ['output_data'],
+                 'persist': []}
+
+logging.basicConfig(level=logging.DEBUG)
+logging.info("Executing in the standalone mode")
+logging.info('Started execution of '+SERVICE+' in the '+ENV+' environment')
+
+"""
+class: DefaultPredictor
+Parameters: model_path -> path of the classifier, or a list of paths to score an ensemble
+            aggregation, weights, stacker_path, n_jobs -> how the ensemble is combined and run (see infer.Classifier)
+            compiled, compiled_dtype, compiled_trees -> score the raw features with the logistic regression compiled
+                                                        with the scaler folded in, and the tree models compiled to
+                                                        node arrays when compiled_trees (see infer.Classifier)
+            input_format, columns, schema_path -> file format, column projection and the CREATE TABLE query the
+                                                 input dtypes are derived from (see ingest_data.DataLoader)
+            incremental -> only score the loans that are new or changed since the last run (tracked in store_path)
+                           and upsert them instead of recreating the table
+            output_name -> name of the output file without the extension; today's date by default
+            output_format, output_compression, partition_cols -> file format, compression and partition columns of
+                                                                 the output files (see persist_data.DataPersister)
+            metrics_path, prometheus_path -> where the JSON run report and the Prometheus textfile of the per stage
+                                             wall time, CPU time, rows and memory are written (see instrumentation)
+            trace_memory -> trace the Python allocations of every stage with tracemalloc
+            memory_lean -> build the features as one float32 matrix straight from the input columns and score it
+                           with the compiled model, keep the tiers as a categorical column and read the input with
+                           the dtypes of schema_path (or create_query)
+            cache_path, cache_ttl, cache_max_entries -> sqlite cache of the probabilities and tiers of the feature
+                                                        rows already scored (see result_cache.ResultCache)
+            pipelined, queue_size -> with chunk_size, read and persist the chunks in their own threads while the
+                                     chunks between them are scored (see chunk_pipeline.ChunkPipeline); the
+                                     run report then has the wall time of the stages but not their CPU time
+            validation -> reject the rows with missing or invalid values (see prepare_input_data.DataValidator,
+                          the rules come from schema_path or create_query and the [CATEGORIES] and [RANGES] config)
+                          instead of scoring them; the counts per rule are in the run report
+            quarantine_path -> directory the rejected rows are written to, <output_name>_rejected.csv
+            checkpoint_path -> directory the stage outputs and committed chunks of the runs are checkpointed in
+                               (see checkpoint_store.CheckpointStore); the checkpoint is removed once a run succeeds
+            resume -> resume the failed run of the same input, models and settings from its checkpoint: after its
+                      last checkpointed stage or, when chunk_size is set, after its last committed chunk
+Returns: 0 on success and -1 on failure from run_default_pipeline
+The parameters of the config are built once by app_config.PipelineSettings, see from_settings
+Calls all operations in order
+Ingestion --> Data Preparation --> Model Load --> Infer --> Post Process --> Persist results
+When chunk_size is set the input is streamed in chunks of that many rows and every chunk goes through
+Data Preparation --> Infer --> Tiers --> Post Process --> Persist before the next one is read, or when pipelined
+the next chunk is read and the previous one persisted while a chunk is scored
+"""
+
+
+class DefaultPredictor:
+    def __init__(self,  model_path, identifiers, categorical, customer_rules, scaler_path=None, sql=True, database=None,
+                 input_path=None, output_path=None, load_query=None, table=None, drop_query=None, create_query=None,
+                 insert_query=None, write_mode='executemany', write_chunk_size=10000, chunk_size=None, model=None,
+                 scaler=None, encoder_path=None, compiled=False, compiled_dtype='float64', aggregation='mean',
+                 weights=None, stacker_path=None, n_jobs=None, persist_mode='replace', incremental=False,
+                 store_path=None, input_format=None, columns=None, schema_path=None, output_name=None,
+                 metrics_path=None, prometheus_path=None, trace_memory=False, output_format='csv',
+                 output_compression=None, partition_cols=None, memory_lean=False, cache_path=None, cache_ttl=None,
+                 cache_max_entries=None, pipelined=False, queue_size=2, validation=False, quarantine_path=None,
+                 checkpoint_path=None, resume=False, compiled_trees=False):
+        self.model_path = model_path
+        self.scaler_path = scaler_path
+        self.sql = sql
+        self.database = database
+        self.input_path = input_path
+        self.output_path = output_path
+        self.output_name = output_name
+        self.output_format = output_format
+        self.output_compression = output_compression
+        self.partition_cols = partition_cols
+        self.load_query = load_query
+        self.drop_query = drop_query
+        self.create_query = create_query
+        self.insert_query = insert_query
+        self.write_mode = write_mode
+        self.write_chunk_size = write_chunk_size
+        self.chunk_size = chunk_size
+        self.model = model
+        self.scaler = scaler
+        self.encoder_path = encoder_path
+        self.encoder = None
+        self.memory_lean = memory_lean
+        self.compiled = compiled or memory_lean
+        self.compiled_dtype = 'float32' if memory_lean else compiled_dtype
+        self.compiled_trees = compiled_trees
+        self.aggregation = aggregation
+        self.weights = weights
+        self.stacker_path = stacker_path
+        self.n_jobs = n_jobs
+        self.model_timings = None
+        self.persist_mode = persist_mode
+        self.incremental = incremental
+        self.store_path = store_path
+        self.score_store = None
+        self.row_hashes = None
+        self.input_format = input_format
+        self.columns = columns
+        self.schema_path = schema_path
+        self.cache_path = cache_path
+        self.cache_ttl = cache_ttl
+        self.cache_max_entries = cache_max_entries
+        self.result_caches = None
+        self.feature_hashes = None
+        self.pipelined = pipelined
+        self.queue_size = queue_size
+        self.persisted_chunks = 0
+        self.score_recorder = None
+        self.validation = validation
+        self.quarantine_path = quarantine_path
+        self.validator = None
+        self.reject_counts = Counter()
+        self.rejected_rows = 0
+        self.deferred_rejected_data = None
+        self.checkpoint_path = checkpoint_path
+        self.resume = resume
+        self.checkpoint = None
+        self.committed_chunks = 0
+        self.scored_chunks = 0
+        self.upsert_resumed_chunk = False
+        self.metrics_path = metrics_path
+        self.prometheus_path = prometheus_path
+        self.instrumentation = PipelineInstrumentation(trace_memory=trace_memory)
+        self.table = table
+        self.identifiers = identifiers
+        self.categorical = categorical
+        self.customer_rules = customer_rules
+        self.input_data = None
+        self.transformed_data = None
+        self.predictions = None
+        self.customer_tiers = None
+        self.output_data = None
+
+    @classmethod
+    def from_settings(cls, settings, **changes):
+        return cls(**settings.replace(**changes).as_kwargs())
+
+    def validate_params(self):
+        try:
+            logging.info("Validating the input parameters")
+            if self.sql:
+                if self.database is None:
+                    logging.error("If SQL is TRUE then valid Database details should be provided")
+                    return -1
+                #elif self.load_query is None:
+                #    logging.error("If SQL is TRUE then a valid load query should be provided")
+                #    return -1
+                elif self.insert_query is None:
+                    logging.error("If SQL is TRUE then a valid save query should be provided")
+                    return -1
+                else:
+                    pass
+            else:
+                if self.input_path is None:
+                    logging.error("If SQL is False then a valid input path should be provided")
+                    return -1
+                elif self.output_path is None:
+                    logging.error("If SQL is False then a Valid output path should be given")
+                    return -1
+                else:
+                    pass
+            logging.info("Successfully validated the input Parameters")
+        except Exception as e:
+            logging.error("Failed to Validate the input Parameters")
+            return -1
+        return 0
+
+    def get_data_loader(self, chunk_size=None):
+        schema_path = self.schema_path or (self.create_query if self.memory_lean else None)
+        dtypes = get_schema_dtypes(schema_path) if schema_path else None
+        if dtypes and self.validation:
+            # one bad number would fail the whole read, so the numbers are parsed when they are validated
+            dtypes = {col: dtype for col, dtype in dtypes.items() if dtype == 'category'}
+        return DataLoader(database=self.database, query=self.load_query, file_path=self.input_path,
+                          chunk_size=chunk_size, file_format=self.input_format, columns=self.columns,
+                          dtypes=dtypes)
+
+    def run_ingest_data(self):
+        try:
+            logging.info("Calling the method to ingest data")
+            data_loader = self.get_data_loader()
+            self.input_data = data_loader.load_data()
+        except Exception as e:
+            logging.error("Failed to ingest data")
+            return -1
+        return 0
+
+    def get_artifact_paths(self):
+        paths = list(self.model_path) if isinstance(self.model_path, (list, tuple)) else [self.model_path]
+        return paths + [path for path in [self.scaler_path, self.encoder_path, self.stacker_path]
+                        if path and os.path.exists(path)]
+
+    def get_model_version(self):
+        return get_model_version(self.get_artifact_paths(), self.customer_rules)
+
+    def get_result_caches(self):
+        if self.result_caches is None:
+            # the probabilities depend on the artifacts and how they are scored, the tiers only on the rules
+            scoring = (self.aggregation, self.weights, self.compiled, self.compiled_dtype, self.compiled_trees)
+            versions = {'probability': get_model_version(self.get_artifact_paths(), scoring),
+                        'tier': get_model_version([], self.customer_rules)}
+            self.result_caches = {namespace: ResultCache(self.cache_path, namespace, version, ttl=self.cache_ttl,
+                                                         max_entries=self.cache_max_entries)
+                                  for namespace, version in versions.items()}
+        return self.result_caches
+
+    def record_cache_stats(self):
+        if self.result_caches is None:
+            return
+        for namespace, cache in self.result_caches.items():
+            stats = cache.get_stats()
+            logging.info("The %s cache served %d of %d rows", namespace, stats['hits'], stats['hits'] + stats['misses'])
+            for name, value in stats.items():
+                if value is not None:
+                    self.instrumentation.record_value('cache_' + namespace + '_' + name, value)
+            cache.close()
+        self.result_caches = None
+
+    def get_validator(self):
+        if self.validator is None:
+            self.validator = DataValidator.from_schema(self.schema_path or self.create_query)
+        return self.validator
+
+    def get_quarantine_file(self):
+        return os.path.join(self.quarantine_path, (self.output_name or str(date.today())) + '_rejected.csv')
+
+    def quarantine_rows(self, rejected_data):
+        if self.quarantine_path:
+            os.makedirs(self.quarantine_path, exist_ok=True)
+            path = self.get_quarantine_file()
+            # the first rejected rows of a run replace the quarantine file of the previous run, unless it is resumed
+            append = self.rejected_rows > 0 or self.committed_chunks > 0
+            header = not append or not os.path.exists(path) or os.path.getsize(path) == 0
+            rejected_data.to_csv(path, mode='a' if append else 'w', header=header, index=False)
+            logging.info("Quarantined %d rejected rows at %s", len(rejected_data), path)
+        self.rejected_rows += len(rejected_data)
+
+    def record_reject_counts(self):
+        if not self.validation:
+            return
+        self.instrumentation.record_value('rejected_rows', self.rejected_rows)
+        for name, count in self.reject_counts.items():
+            self.instrumentation.record_value('rejected_' + name, count)
+
+    def get_run_key(self):
+        # a checkpoint only applies to the same input, scored the same way and persisted to the same place
+        settings = (self.customer_rules, self.aggregation, self.weights, self.compiled, self.compiled_dtype,
+                    self.compiled_trees,
+                    self.memory_lean, self.columns, self.chunk_size, self.incremental, self.validation,
+                    self.output_path, self.output_name, self.output_format, self.output_compression,
+                    self.partition_cols, self.table, self.get_persist_mode())
+        input_hash = get_input_hash(self.input_path, self.load_query)
+        return get_model_version(self.get_artifact_paths(), (input_hash, settings))
+
+    def get_output_marks(self):
+        # the staged output file and the quarantine file, which the chunks of a run are appended to
+        marks = {}
+        if self.database is None:
+            marks['output'] = get_output_mark(self.get_data_persister().get_file_path() + TEMP_SUFFIX)
+        if self.quarantine_path:
+            marks['quarantine'] = get_output_mark(self.get_quarantine_file())
+        return marks
+
+    def restore_output_marks(self, marks):
+        paths = {'quarantine': self.get_quarantine_file() if self.quarantine_path else None}
+        if self.database is None:
+            paths['output'] = self.get_data_persister().get_file_path() + TEMP_SUFFIX
+        return all(restore_output_mark(paths[name], mark) for name, mark in marks.items() if paths.get(name))
+
+    def run_open_checkpoint(self):
+        try:
+            logging.info("Calling the method to open the checkpoint of the run")
+            self.checkpoint = CheckpointStore(self.checkpoint_path, self.get_run_key())
+            self.committed_chunks = 0
+            if not self.resume or not self.checkpoint.load():
+                if self.resume:
+                    logging.info("There is no checkpoint to resume from, running from the start")
+                self.checkpoint.reset()
+                return 0
+            if self.checkpoint.get_committed_chunks():
+                if not self.restore_output_marks(self.checkpoint.get_marks()):
+                    logging.warning("The outputs of the committed chunks changed, running from the start")
+                    self.checkpoint.reset()
+                    return 0
+                self.committed_chunks = self.checkpoint.get_committed_chunks()
+                # rows of the chunk that failed may already be in the table, so the next chunk is upserted
+                self.upsert_resumed_chunk = self.database is not None
+                logging.info("Resuming after the %d committed chunks", self.committed_chunks)
+            elif self.checkpoint.get_last_stage():
+                for name, value in self.checkpoint.get_outputs().items():
+                    setattr(self, name, value)
+                logging.info("Resuming after the " + self.checkpoint.get_last_stage() + " stage")
+        except Exception as e:
+            logging.error("Failed to open the checkpoint of the run")
+            logging.error(e)
+            return -1
+        return 0
+
+    def close_checkpoint(self, pipeline_results):
+        # a successful run needs no checkpoint, a failed one keeps it to be resumed
+        if self.checkpoint is not None and pipeline_results == 0:
+            self.checkpoint.remove()
+        self.checkpoint = None
+
+    def is_checkpointed(self, stage_name):
+        last_stage = self.checkpoint.get_last_stage() if self.checkpoint is not None else None
+        return last_stage is not None and PIPELINE_STAGES.index(stage_name) <= PIPELINE_STAGES.index(last_stage)
+
+    def run_checkpointed_stage(self, stage_name, stage, *args, **kwargs):
+        # the stages a resumed run is past are skipped, run_open_checkpoint restored what they produced
+        if self.is_checkpointed(stage_name):
+            logging.info("Skipping the " + stage_name + " stage, it is checkpointed")
+            return 0
+        stage_results = self.run_stage(stage_name, stage, *args, **kwargs)
+        if stage_results == 0 and self.checkpoint is not None and stage_name in STAGE_OUTPUTS:
+            with self.instrumentation.stage('checkpoint'):
+                self.checkpoint.save_stage(stage_name, {name: getattr(self, name)
+                                                        for name in STAGE_OUTPUTS[stage_name]})
+        return stage_results
+
+    def commit_chunks(self, chunks):
+        # the first chunks input chunks are scored and their outputs persisted (and recorded)
+        self.upsert_resumed_chunk = False
+        if self.checkpoint is not None:
+            self.checkpoint.commit_chunks(chunks, self.get_output_marks())
+
+    def run_filter_changed_data(self):
+        try:
+            logging.info("Calling the method to filter the new or changed loans")
+            if self.score_store is None:
+                self.score_store = ScoreStore(self.store_path, self.get_model_version())
+            row_hashes = hash_rows(self.input_data)
+            changed = self.score_store.get_changed_rows(self.input_data, row_hashes)
+            if not changed.all():
+                self.input_data = self.input_data.loc[changed].copy()
+            self.row_hashes = row_hashes[changed]
+        except Exception as e:
+            logging.error("Failed to filter the changed loans")
+            logging.error(e)
+            return -1
+        return 0
+
+    def run_record_scored_data(self):
+        try:
+            logging.info("Calling the method to record the scored loans")
+            if self.score_store is None:  # a resumed run skips filtering the changed loans
+                self.score_store = ScoreStore(self.store_path, self.get_model_version())
+            self.score_store.record_scored_rows(self.input_data, self.row_hashes)
+        except Exception as e:
+            logging.error("Failed to record the scored loans")
+            logging.error(e)
+            return -1
+        return 0
+
+    def run_prepare_input_data(self):
+        try:
+            logging.info("Calling the method to prepare input")
+            if self.encoder is None and self.encoder_path and os.path.exists(self.encoder_path):
+                self.encoder = CategoricalEncoder.load(self.encoder_path)
+            data_preprocessor = DataPreprocessor(data=self.input_data, scaler_path=self.scaler_path,
+                                                 identifiers=self.identifiers, categorical=self.categorical,
+                                                 scaler=self.scaler, encoder=self.encoder,
+                                                 validator=self.get_validator() if self.validation else None)
+            if self.memory_lean:
+                self.transformed_data = data_preprocessor.prepare_features(dtype=self.compiled_dtype)
+            else:
+                self.transformed_data = data_preprocessor.prepare_data(normalize=not self.compiled)
+            if self.transformed_data is None:
+                logging.error("Failed to prepare data")
+                return -1
+            if data_preprocessor.rejected_data is not None:
+                # only the valid loans go on to be scored, persisted and recorded as scored
+                self.input_data = data_preprocessor.data
+                if self.row_hashes is not None:
+                    self.row_hashes = self.row_hashes[data_preprocessor.valid_rows]
+                self.reject_counts.update(data_preprocessor.reject_counts)
+                if self.deferred_rejected_data is not None:  # quarantined by the writer thread with its chunk
+                    self.deferred_rejected_data.append(data_preprocessor.rejected_data)
+                else:
+                    self.quarantine_rows(data_preprocessor.rejected_data)
+            if self.cache_path:
+                features = self.transformed_data if self.memory_lean \
+                    else data_preprocessor.get_feature_matrix(np.float64)
+                self.feature_hashes = hash_features(features)
+        except Exception as e:
+            logging.error("Failed to prepare data")
+            logging.error(e)
+            return -1
+        return 0
+
+    def run_infer(self):
+        try:
+            logging.info("Calling the method to infer data")
+            if self.compiled and self.scaler is None:
+                self.scaler = Model(self.scaler_path).load_model()
+            classifier = Classifier(data=self.transformed_data, model_path=self.model_path, model=self.model,
+                                    compiled=self.compiled, compiled_trees=self.compiled_trees,
+                                    scaler=self.scaler, dtype=self.compiled_dtype,
+                                    aggregation=self.aggregation, weights=self.weights,
+                                    stacker=Model(self.stacker_path).load_model() if self.stacker_path else None,
+                                    n_jobs=self.n_jobs,
+                                    cache=self.get_result_caches()['probability'] if self.cache_path else None,
+                                    feature_hashes=self.feature_hashes)
+            self.predictions = classifier.infer_data()
+            self.model_timings = classifier.model_timings
+            if self.predictions is None:
+                logging.error("Failed to Infer data")
+                return -1
+        except Exception as e:
+            logging.error("Failed to Infer data")
+            return -1
+        return 0
+
+    def run_get_customer_tier(self):
+        try:
+            logging.info("calling the method to generate customer tier")
+            tier_classifier = TierClassifier(self.input_data, self.customer_rules,
+                                             cache=self.get_result_caches()['tier'] if self.cache_path else None,
+                                             feature_hashes=self.feature_hashes)
+            self.customer_tiers = tier_classifier.rule_engine(categorical=self.memory_lean)
+        except Exception as e:
+            logging.error("Failed to get customer tiers")
+            return -1
+        return 0
+
+    def run_prepare_output_data(self):
+        try:
+            logging.info("Calling the method to prepare outputs")
+            post_processor = PostProcessor(data=self.input_data, predictions=self.predictions, tiers=self.customer_tiers)
+            self.output_data = post_processor.combine_data()
+        except Exception as e:
+            logging.error("Failed to prepare outputs")
+            return 1
+        return 0
+
+    def get_persist_mode(self):
+        return 'upsert' if self.incremental else self.persist_mode
+
+    def run_persist_empty_delta(self):
+        # a file output of an incremental run holds only the loans it scored, so a run without new or changed
+        # loans writes an empty output instead of leaving the loans of the previous run in it
+        if self.database is not None or self.input_data is None:
+            return 0
+        self.output_data = PostProcessor(data=self.input_data.head(0).copy(), predictions=[], tiers=[]).combine_data()
+        return self.run_persist_data()
+
+    def get_data_persister(self, append=False, swap=True, data=None):
+        persist_mode, table = self.get_persist_mode(), self.table
+        if append and self.upsert_resumed_chunk and persist_mode != 'upsert':
+            table = self.table + STAGING_SUFFIX if persist_mode == 'swap' else self.table
+            persist_mode = 'upsert'
+        return DataPersister(data=self.output_data if data is None else data, db=self.database,
+                             table=table, path=self.output_path,
+                             create_query=self.create_query,
+                             drop_query=self.drop_query,
+                             insert_query=self.insert_query,
+                             write_mode=self.write_mode,
+                             chunk_size=self.write_chunk_size,
+                             append=append,
+                             persist_mode=persist_mode,
+                             swap=swap,
+                             file_name=self.output_name,
+                             file_format=self.output_format,
+                             compression=self.output_compression,
+                             partition_cols=self.partition_cols)
+
+    def run_persist_data(self, append=False, swap=True, data=None):
+        try:
+            logging.info("Calling the method persist data")
+            data_persister = self.get_data_persister(append=append, swap=swap, data=data)
+            persist_results = data_persister.persist()
+            if persist_results != 0:
+                logging.error("Failed in persisting")
+                return -1
+            return 0
+        except Exception as e:
+            logging.error("Failed in persisting")
+            return -1
+
+    def run_swap_persisted_data(self):
+        try:
+            logging.info("Calling the method to swap the persisted chunks in")
+            if self.get_data_persister().persist_swap() != 0:
+                logging.error("Failed in swapping the persisted chunks in")
+                return -1
+        except Exception as e:
+            logging.error("Failed in swapping the persisted chunks in")
+            return -1
+        return 0
+
+    def run_stage(self, stage_name, stage, *args, **kwargs):
+        with self.instrumentation.stage(stage_name) as counts:
+            stage_results = stage(*args, **kwargs)
+            data = self.output_data if stage_name == 'persist' else self.input_data
+            counts['rows'] = len(data) if data is not None else 0
+        return stage_results
+
+    def write_run_report(self):
+        try:
+            if self.metrics_path:
+                self.instrumentation.write_report(self.metrics_path)
+            if self.prometheus_path:
+                self.instrumentation.write_prometheus(self.prometheus_path)
+        except Exception as e:
+            logging.error("Failed to write the run report")
+            logging.error(e)
+            return -1
+        return 0
+
+    def get_input_chunks(self):
+        data_loader = self.get_data_loader(chunk_size=self.chunk_size)
+        chunks = self.instrumentation.instrument_chunks('ingest', data_loader.load_data_chunks())
+        if self.committed_chunks:
+            logging.info("Skipping the %d chunks committed before", self.committed_chunks)
+        self.scored_chunks = self.committed_chunks
+        return itertools.islice(chunks, self.committed_chunks, None)
+
+    def score_chunk(self, chunk):
+        # the output, scored loans, row hashes and number of the chunk, or None when none of its loans changed
+        self.input_data = chunk
+        self.scored_chunks += 1
+        if self.incremental:
+            if self.run_stage('filter_changed', self.run_filter_changed_data) != 0:
+                raise RuntimeError("Failed to process the chunk at filtering changed loans")
+            if self.input_data.empty:
+                return None
+        stages = [('prepare_input', self.run_prepare_input_data, "preparing inputs"),
+                  ('infer', self.run_infer, "inferring data"),
+                  ('customer_tier', self.run_get_customer_tier, "getting tiers"),
+                  ('prepare_output', self.run_prepare_output_data, "preparing output data")]
+        for stage_name, stage, stage_description in stages:
+            if self.run_stage(stage_name, stage) != 0:
+                raise RuntimeError("Failed to process the chunk at " + stage_description)
+            if self.input_data.empty:  # every loan of the chunk was rejected
+                return None
+        return self.output_data, self.input_data, self.row_hashes, self.scored_chunks
+
+    def generate_output_chunks(self):
+        for chunk in self.get_input_chunks():
+            if self.score_chunk(chunk) is not None:
+                yield self.output_data
+
+    def score_pipelined_chunk(self, chunk):
+        # the scored chunk (or None) and its rejected rows, or None when there is nothing to write for the chunk
+        self.deferred_rejected_data = []
+        scored = self.score_chunk(chunk)
+        rejected_data = self.deferred_rejected_data
+        if scored is None and not rejected_data:
+            return None
+        return scored, rejected_data, self.scored_chunks
+
+    def persist_scored_chunk(self, item, swap=True):
+        # runs in the writer thread of the pipelined mode, so it only uses the data it is given; the output and
+        # quarantine files are only appended to here, so the marks committed with a chunk match its outputs
+        scored, rejected_data, chunks = item
+        for rejected in rejected_data:
+            self.quarantine_rows(rejected)
+        if scored is not None:
+            output_data, input_data, row_hashes, _ = scored
+            with self.instrumentation.stage('persist') as counts:
+                persist_results = self.run_persist_data(append=self.persisted_chunks > 0, swap=swap,
+                                                        data=output_data)
+                counts['rows'] = len(output_data)
+            if persist_results != 0:
+                raise RuntimeError("Failed to persist chunk " + str(self.persisted_chunks))
+            if self.incremental:
+                with self.instrumentation.stage('record_scored') as counts:
+                    if self.score_recorder is None:  # sqlite connections belong to the thread that opened them
+                        self.score_recorder = ScoreStore(self.store_path, self.get_model_version())
+                    self.score_recorder.record_scored_rows(input_data, row_hashes)
+                    counts['rows'] = len(input_data)
+            logging.info("Successfully persisted chunk " + str(self.persisted_chunks))
+            self.persisted_chunks += 1
+        self.commit_chunks(chunks)
+
+    def close_score_recorder(self):
+        if self.score_recorder is not None:
+            self.score_recorder.close()
+            self.score_recorder = None
+
+    def run_pipelined_pipeline(self):
+        try:
+            logging.info("Running the pipeline in chunks of " + str(self.chunk_size) + " rows with overlapped "
+                         "reads and writes")
+            validate_results = self.validate_params()
+            if validate_results != 0:
+                logging.error("Failed to execute the pipeline at validating parameters")
+                return -1
+            swap_at_end = self.database is None or self.get_persist_mode() == 'swap'
+            self.persisted_chunks = self.committed_chunks
+            try:
+                ChunkPipeline(queue_size=self.queue_size).run(
+                    self.get_input_chunks(), self.score_pipelined_chunk,
+                    lambda item: self.persist_scored_chunk(item, swap=not swap_at_end), close=self.close_score_recorder)
+            finally:
+                self.deferred_rejected_data = None
+            if swap_at_end and self.persisted_chunks and self.run_stage('swap', self.run_swap_persisted_data) != 0:
+                logging.error("Failed to execute the pipeline at swapping the persisted chunks in")
+                return -1
+            if self.incremental and not self.persisted_chunks and self.run_persist_empty_delta() != 0:
+                logging.error("Failed to execute the pipeline at persisting the empty output")
+                return -1
+            logging.info("Successfully executed the pipeline")
+        except Exception as e:
+            logging.error("Failed to execute the pipeline. Check the error below")
+            logging.error(e)
+            return -1
+        return 0
+
+    def run_streaming_pipeline(self):
+        try:
+            logging.info("Running the pipeline in chunks of " + str(self.chunk_size) + " rows")
+            validate_results = self.validate_params()
+            if validate_results != 0:
+                logging.error("Failed to execute the pipeline at validating parameters")
+                return -1
+            # output files, like staging tables, are only renamed in once every chunk has been written
+            swap_at_end = self.database is None or self.get_persist_mode() == 'swap'
+            self.persisted_chunks = self.committed_chunks
+            for output_chunk in self.generate_output_chunks():
+                self.output_data = output_chunk
+                persist_results = self.run_stage('persist', self.run_persist_data, append=self.persisted_chunks > 0,
+                                                 swap=not swap_at_end)
+                if persist_results != 0:
+                    logging.error("Failed to execute the pipeline at persisting chunk " + str(self.persisted_chunks))
+                    return -1
+                if self.incremental and self.run_stage('record_scored', self.run_record_scored_data) != 0:
+                    logging.error("Failed to execute the pipeline at recording chunk " + str(self.persisted_chunks))
+                    return -1
+                logging.info("Successfully processed chunk " + str(self.persisted_chunks))
+                self.persisted_chunks += 1
+                self.commit_chunks(self.scored_chunks)
+            if swap_at_end and self.persisted_chunks and self.run_stage('swap', self.run_swap_persisted_data) != 0:
+                logging.error("Failed to execute the pipeline at swapping the persisted chunks in")
+                return -1
+            if self.incremental and not self.persisted_chunks and self.run_persist_empty_delta() != 0:
+                logging.error("Failed to execute the pipeline at persisting the empty output")
+                return -1
+            logging.info("Successfully executed the pipeline")
+        except Exception as e:
+            logging.error("Failed to execute the pipeline. Check the error below")
+            logging.error(e)
+            return -1
+        return 0
+
+    def run_default_pipeline(self, persist=True):
+        # persist=False stops after preparing output_data, so the caller can merge and persist several runs at once
+        self.instrumentation.overlapped = bool(self.chunk_size and persist and self.pipelined)
+        self.instrumentation.start()
+        self.reject_counts = Counter()
+        self.rejected_rows = 0
+        if persist and self.checkpoint_path and self.run_open_checkpoint() != 0:
+            pipeline_results = -1
+        elif self.chunk_size and persist and self.pipelined:
+            pipeline_results = self.run_pipelined_pipeline()
+        elif self.chunk_size and persist:
+            pipeline_results = self.run_streaming_pipeline()
+        else:
+            pipeline_results = self.run_whole_pipeline(persist=persist)
+        self.instrumentation.stop(pipeline_results)
+        self.close_checkpoint(pipeline_results)
+        self.record_cache_stats()
+        self.record_reject_counts()
+        self.write_run_report()
+        return pipeline_results
+
+    def run_whole_pipeline(self, persist=True):
+        try:
+            logging.info("Running the pipeline")
+            validate_results = self.validate_params()
+            if validate_results != 0:
+                logging.error("Failed to execute the pipeline at validating parameters")
+                return -1
+            ingest_results = self.run_checkpointed_stage('ingest', self.run_ingest_data)
+            if ingest_results != 0:
+                logging.error("Failed to execute the pipeline at ingesting data")
+                return -1
+            if self.incremental:
+                filter_results = self.run_checkpointed_stage('filter_changed', self.run_filter_changed_data)
+                if filter_results != 0:
+                    logging.error("Failed to execute the pipeline at filtering changed loans")
+                    return -1
+                if self.input_data.empty:
+                    logging.info("There are no new or changed loans to score")
+                    return self.run_stage('persist', self.run_persist_empty_delta) if persist else 0
+            prepare_input_results = self.run_checkpointed_stage('prepare_input', self.run_prepare_input_data)
+            if prepare_input_results != 0:
+                logging.error("Failed to execute the pipeline at preparing inputs")
+                return -1
+            if self.input_data.empty:
+                logging.info("There are no valid loans to score")
+                self.output_data = None
+                return 0
+            infer_results = self.run_checkpointed_stage('infer', self.run_infer)
+            if infer_results != 0:
+                logging.error("Failed to execute the pipeline at inferring data")
+                return -1
+            tier_results = self.run_checkpointed_stage('customer_tier', self.run_get_customer_tier)
+            if tier_results != 0:
+                logging.error("Failed to execute the pipeline at getting tiers")
+                return -1
+            prepare_output_results = self.run_checkpointed_stage('prepare_output', self.run_prepare_output_data)
+            if prepare_output_results != 0:
+                logging.error("Failed to execute the pipeline at preparing output data")
+                return -1
+            if not persist:
+                logging.info("Successfully executed the pipeline without persisting the outputs")
+                return 0
+            persist_results = self.run_checkpointed_stage('persist', self.run_persist_data)
+            if persist_results != 0:
+                logging.error("Failed to execute the pipeline at persisting data")
+                return -1
+            if self.incremental:
+                record_results = self.run_stage('record_scored', self.run_record_scored_data)
+                if record_results != 0:
+                    logging.error("Failed to execute the pipeline at recording the scored loans")
+                    return -1
+            logging.info("Successfully executed the pipeline")
+        except Exception as e:
+            logging.error("Failed to execute the pipeline. Check the error below")
+            logging.error(e)
+            return -1
+        return 0
+
+
+if __name__ == "__main__":
+    prediction_pipeline = DefaultPredictor.from_settings(PipelineSettings.from_config())
+    prediction_pipeline.run_default_pipeline()
@@ -1,137 +1,351 @@
-"""
-This module will pre-process the input data
-"""
-import pandas as pd
-from load_model import Model
-from configparser import ConfigParser
-import logging
-
-
-logging.basicConfig(level=logging.DEBUG)
-logging.info('Executing the script as a standalone')
-
-config = ConfigParser()
-config.read('config.ini')
-IDENTIFIERS = config.get('DATA', 'IDENTIFIERS').split(",")
-CATEGORICAL = config.get('DATA', 'CATEGORICAL').split(",")
-SCALER = config['MODELS']['SCALER']
-DATA = config['DATA']['PATH']
-
-'''
-class: DataPreprocess
-Parameters: Data-> pandas Dataframe
-            scaler_path -> string value; full or relative path
-            identifiers -> list object ['col1', 'col2']
-Returns: Original data frame, transformed data frame
-'''
-
-
-class DataPreprocessor:
-    def __init__(self, data, scaler_path, identifiers, categorical):
-        self.data = data
-        self.transformed_data = data.copy()
-        self.scaler_path = scaler_path
-        self.identifiers = identifiers
-        self.categorical = categorical
-
-    def handle_missing_data(self):  # TODO: Implement this function in the future
-        try:
-            logging.info('Handling missing Data')
-            pass
-            logging.info('successfully handled missing data')
-        except Exception as e:
-            logging.error('Handling missing data failed with error:')
-            logging.error(e)
-            return 1
-        return 0
-
-    def handle_invalid_data(self):  # TODO: Implement this function in the future
-        try:
-            logging.info('Handling invalid Data')
-            pass
-            logging.info('successfully handled invalid data')
-        except Exception as e:
-            logging.error('Handling invalid data failed with error:')
-            logging.error(e)
-            return 1
-        return 0
-
-    def handle_categorical_data(self):  # TODO: Implement a more dynamic function later
-        try:
-            logging.info('Handling discrete Data')
-            for col in self.categorical:
-                if col == 'loan_type':
-                    self.transformed_data[col] = self.transformed_data[col].apply(lambda x: 1 if x =='Home' else 0)
-                elif col == 'gender':
-                    self.transformed_data[col] = self.transformed_data[col].apply(lambda x: 1 if x =='Male' else 0)
-                else:
-                    self.transformed_data[col] = self.transformed_data[col].apply(lambda x: 1 if x =='Yes' else 0)
-            logging.info('successfully handled discrete data')
-        except Exception as e:
-            logging.error('Handling discrete data failed with error:')
-            logging.error(e)
-            return 1
-        return 0
-
-    def remove_identifiers(self):
-        try:
-            logging.info('removing identifier Data')
-            self.transformed_data.drop(self.identifiers, axis=1, inplace=True)
-            logging.info('successfully removed identifier data')
-        except Exception as e:
-            logging.error('removing identifier data failed with error:')
-            logging.error(e)
-            return 1
-        return 0
-
-    def normalize_data(self):
-        try:
-            logging.info('Normalizing Data')
-            scaler = Model(self.scaler_path)
-            scaler_loaded = scaler.load_model()
-            self.transformed_data = scaler_loaded.transform(self.transformed_data)
-            logging.info('successfully  normalized data')
-        except Exception as e:
-            logging.error('normalizing data failed with error:')
-            logging.error(e)
-            return 1
-        return 0
-
-    def prepare_data(self):
-        try:
-            missing_data_result = self.handle_missing_data()
-            if missing_data_result != 0:
-                logging.error('The Data Preparation has failed. Please check the error messages')
-                return None
-            invalid_data_result = self.handle_invalid_data()
-            if invalid_data_result != 0:
-                logging.error('The Data Preparation has failed. Please check the error messages')
-                return None
-            categorical_data_result = self.handle_categorical_data()
-            if categorical_data_result != 0:
-                logging.error('The Data Preparation has failed. Please check the error messages')
-                return None
-            remove_identifier_result = self.remove_identifiers()
-            if remove_identifier_result != 0:
-                logging.error('The Data Preparation has failed. Please check the error messages')
-                return None
-            normalize_result = self.normalize_data()
-            if normalize_result != 0:
-                logging.error('The Data Preparation has failed. Please check the error messages')
-                return None
-
-        except Exception as e:
-            logging.error('The Data Preparation has failed. Please check the error messages')
-            logging.error(e)
-            return None
-        logging.info('Successfully Prepared the data')
-        return self.transformed_data
-
-
-if __name__ == "__main__":
-    data_ = pd.read_csv(DATA)
-    preprocessor = DataPreprocessor(data_, SCALER, IDENTIFIERS)
-    transform_data = preprocessor.prepare_data()
-    print(transform_data.shape)
-
-
+"""
+This module will pre-process the input data
+
+When a DataValidator is given, the rows breaking a validation rule are taken out before the features are built:
+missing values first (handle_missing_data), then values that are not numbers, out of range, too long or not an
+allowed category (handle_invalid_data). The rejected rows are kept in rejected_data with the rules they broke, so
+one bad record no longer fails the whole run.
+"""
+import pickle
+from collections import Counter, OrderedDict
+import numpy as np
+import pandas as pd
+from load_model import Model
+from app_config import get_config
+from ingest_data import get_schema_columns
+import logging
+
+
+logging.basicConfig(level=logging.DEBUG)
+logging.info('Executing the script as a standalone')
+
+config = get_config()
+IDENTIFIERS = config.get('DATA', 'IDENTIFIERS').split(",")
+CATEGORICAL = config.get('DATA', 'CATEGORICAL').split(",")
+SCALER = config['MODELS']['SCALER']
+ENCODER = config['MODELS']['ENCODER']
+DATA = config['DATA']['PATH']
+ENCODING = dict(config.items('ENCODING'))
+CREATE_QUERY = config['QUERY']['CREATE']
+CATEGORIES = {col: levels.split(",") for col, levels in config.items('CATEGORIES')}
+RANGES = {col: tuple(float(bound) if bound.strip() else None for bound in bounds.split(","))
+          for col, bounds in config.items('RANGES')}
+
+MISSING_RULES = ['null']
+INVALID_RULES = ['type', 'range', 'length', 'category']
+INTEGER_RANGES = {'TINYINT': 2 ** 7, 'SMALLINT': 2 ** 15, 'MEDIUMINT': 2 ** 23, 'INT': 2 ** 31, 'INTEGER': 2 ** 31,
+                  'BIGINT': 2 ** 63}
+NUMERIC_TYPES = list(INTEGER_RANGES) + ['DECIMAL', 'FLOAT', 'DOUBLE']
+TEXT_TYPES = ['CHAR', 'VARCHAR', 'TEXT']
+REJECTED_RULES_COLUMN = 'rejected_rules'
+
+'''
+class: CategoricalEncoder
+Parameters: levels -> dict object {'col': ['level1', 'level2']}
+Returns: the data frame with every categorical column replaced by integer codes from transform
+         The levels of a column are coded 1, 2, ... in the given order and any other value (or missing) is coded 0,
+         so the levels have to be listed in the order the model was trained with
+'''
+
+
+class CategoricalEncoder:
+    def __init__(self, levels):
+        self.levels = levels
+
+    @classmethod
+    def from_config(cls, categorical, encoding=None):
+        encoding = ENCODING if encoding is None else encoding
+        return cls({col: encoding[col].split(",") for col in categorical})
+
+    @classmethod
+    def load(cls, path):
+        return cls(Model(path).load_model()['levels'])
+
+    def save(self, path):
+        with open(path, 'wb') as encoder_file:
+            pickle.dump({'levels': self.levels}, encoder_file)
+
+    def encode(self, col, values):
+        levels = self.levels[col]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            # code the few categories once and take the code of every row from them (-1, missing, takes the 0)
+            codes = np.append(pd.Index(levels).get_indexer(values.cat.categories).astype(np.int64) + 1, 0)
+            return codes[values.cat.codes.to_numpy()]
+        if values.dtype == object:
+            return pd.Index(levels).get_indexer(values).astype(np.int64) + 1
+        # string columns compare faster level by level than through a hash table
+        codes = np.zeros(len(values), dtype=np.int64)
+        for code, level in enumerate(levels, 1):
+            codes[(values == level).to_numpy(dtype=bool, na_value=False)] = code
+        return codes
+
+    def transform(self, data):
+        for col in self.levels:
+            data[col] = self.encode(col, data[col])
+        return data
+
+
+'''
+class: DataValidator
+Parameters: rules -> list object of (name, column, kind, argument) tuples; kind is 'null', 'type' (not a number),
+                     'range' (argument (low, high), either may be None), 'length' (argument the longest string) or
+                     'category' (argument the allowed values)
+Returns: an ordered dict of the rule names and the boolean masks of the rows breaking them from get_masks
+'''
+
+
+class DataValidator:
+    def __init__(self, rules):
+        self.rules = rules
+
+    @classmethod
+    def from_schema(cls, schema_path=CREATE_QUERY, categories=None, ranges=None):
+        # numeric columns are model features or identifiers, so they may not be missing even when the table allows it
+        categories = CATEGORIES if categories is None else categories
+        ranges = RANGES if ranges is None else ranges
+        rules = []
+        for col, sql_type, sizes, not_null in get_schema_columns(schema_path) if schema_path else []:
+            if not_null or sql_type in NUMERIC_TYPES:
+                rules.append((col + '_null', col, 'null', None))
+            if sql_type in NUMERIC_TYPES:
+                rules.append((col + '_type', col, 'type', None))
+                rules.append((col + '_range', col, 'range', ranges.get(col, cls.get_type_range(sql_type, sizes))))
+            elif sql_type in TEXT_TYPES and sizes and col not in categories:
+                rules.append((col + '_length', col, 'length', sizes[0]))
+        rules += [(col + '_range', col, 'range', bounds) for col, bounds in ranges.items()
+                  if (col + '_range') not in [rule[0] for rule in rules]]
+        rules += [(col + '_category', col, 'category', levels) for col, levels in categories.items()]
+        return cls(rules)
+
+    @staticmethod
+    def get_type_range(sql_type, sizes):
+        if sql_type in INTEGER_RANGES:
+            return -INTEGER_RANGES[sql_type], INTEGER_RANGES[sql_type] - 1
+        if sql_type == 'DECIMAL' and sizes:
+            largest = 10.0 ** (sizes[0] - (sizes[1] if len(sizes) > 1 else 0))
+            return -largest, largest
+        return None, None
+
+    @staticmethod
+    def get_numbers(values):
+        if pd.api.types.is_numeric_dtype(values.dtype):
+            return values.to_numpy(dtype=np.float64, na_value=np.nan)
+        return pd.to_numeric(values, errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+
+    def get_mask(self, data, col, kind, argument):
+        values = data[col]
+        if kind == 'null':
+            return values.isna().to_numpy()
+        if kind == 'type':
+            return np.isnan(self.get_numbers(values)) & values.notna().to_numpy()
+        if kind == 'range':
+            numbers = self.get_numbers(values)
+            low, high = argument
+            mask = np.isinf(numbers)
+            if low is not None:
+                mask |= numbers < low
+            if high is not None:
+                mask |= numbers > high
+            return mask
+        if kind == 'length':
+            return (values.astype(str).str.len() > argument).to_numpy() & values.notna().to_numpy()
+        if kind == 'category':
+            return ~values.isin(argument).to_numpy() & values.notna().to_numpy()
+        raise ValueError("Unknown validation rule " + str(kind))
+
+    def get_masks(self, data, kinds):
+        return OrderedDict((name, self.get_mask(data, col, kind, argument)) for name, col, kind, argument in self.rules
+                           if kind in kinds and col in data.columns)
+
+
+'''
+class: DataPreprocess
+Parameters: Data-> pandas Dataframe
+            scaler_path -> string value; full or relative path
+            identifiers -> list object ['col1', 'col2']
+            scaler -> an already loaded scaler, used instead of loading scaler_path
+            encoder -> CategoricalEncoder, defaults to the levels in the [ENCODING] config for the categorical columns
+            validator -> DataValidator; the rows breaking its rules are moved from data to rejected_data (with the
+                         broken rules in the rejected_rules column) and counted per rule in reject_counts
+Returns: Original data frame, transformed data frame
+         prepare_features returns the features as one C contiguous matrix instead (memory lean mode), filled
+         column by column straight from the input without copying the data frame
+'''
+
+
+class DataPreprocessor:
+    def __init__(self, data, scaler_path, identifiers, categorical, scaler=None, encoder=None, validator=None):
+        self.data = data
+        self.transformed_data = None
+        self.scaler_path = scaler_path
+        self.scaler = scaler
+        self.identifiers = identifiers
+        self.categorical = categorical
+        self.encoder = encoder
+        self.validator = validator
+        self.valid_rows = np.ones(len(data), dtype=bool)
+        self.rejected_data = None
+        self.reject_counts = Counter()
+
+    def reject_rows(self, kinds):
+        masks = self.validator.get_masks(self.data, kinds)
+        if not masks:
+            return
+        broken = np.column_stack(list(masks.values()))
+        rejected = broken.any(axis=1)
+        if not rejected.any():
+            return
+        names = np.array(list(masks))
+        self.reject_counts.update({name: int(count) for name, count in zip(names, broken.sum(axis=0)) if count})
+        rejected_data = self.data.loc[rejected].copy()
+        rejected_data[REJECTED_RULES_COLUMN] = [",".join(names[row]) for row in broken[rejected]]
+        self.rejected_data = rejected_data if self.rejected_data is None \
+            else pd.concat([self.rejected_data, rejected_data])
+        self.data = self.data.loc[~rejected]
+        self.valid_rows[np.flatnonzero(self.valid_rows)[rejected]] = False
+        logging.warning('Rejected %d of %d rows: %s', rejected.sum(), len(rejected),
+                        ", ".join(name + " " + str(count) for name, count in zip(names, broken.sum(axis=0)) if count))
+
+    def handle_missing_data(self):
+        try:
+            logging.info('Handling missing Data')
+            if self.validator is not None:
+                self.reject_rows(MISSING_RULES)
+            logging.info('successfully handled missing data')
+        except Exception as e:
+            logging.error('Handling missing data failed with error:')
+            logging.error(e)
+            return 1
+        return 0
+
+    def handle_invalid_data(self):
+        try:
+            logging.info('Handling invalid Data')
+            if self.validator is not None:
+                self.reject_rows(INVALID_RULES)
+                # numbers read as text because of a bad value are numbers again once the bad rows are out
+                for col in {col for _, col, kind, _ in self.validator.rules if kind == 'type'} & set(self.data.columns):
+                    if not pd.api.types.is_numeric_dtype(self.data[col].dtype):
+                        self.data = self.data.assign(**{col: pd.to_numeric(self.data[col])})
+            logging.info('successfully handled invalid data')
+        except Exception as e:
+            logging.error('Handling invalid data failed with error:')
+            logging.error(e)
+            return 1
+        return 0
+
+    def handle_categorical_data(self):
+        try:
+            logging.info('Handling discrete Data')
+            if self.encoder is None:
+                self.encoder = CategoricalEncoder.from_config(self.categorical)
+            self.encoder.transform(self.transformed_data)
+            logging.info('successfully handled discrete data')
+        except Exception as e:
+            logging.error('Handling discrete data failed with error:')
+            logging.error(e)
+            return 1
+        return 0
+
+    def remove_identifiers(self):
+        try:
+            logging.info('removing identifier Data')
+            self.transformed_data.drop(self.identifiers, axis=1, inplace=True)
+            logging.info('successfully removed identifier data')
+        except Exception as e:
+            logging.error('removing identifier data failed with error:')
+            logging.error(e)
+            return 1
+        return 0
+
+    def normalize_data(self):
+        try:
+            logging.info('Normalizing Data')
+            if self.scaler is None:
+                self.scaler = Model(self.scaler_path).load_model()
+            if len(self.transformed_data):  # every row may have been rejected
+                self.transformed_data = self.scaler.transform(self.transformed_data)
+            logging.info('successfully  normalized data')
+        except Exception as e:
+            logging.error('normalizing data failed with error:')
+            logging.error(e)
+            return 1
+        return 0
+
+    def get_feature_matrix(self, dtype=np.float32):
+        if self.encoder is None:
+            self.encoder = CategoricalEncoder.from_config(self.categorical)
+        features = [col for col in self.data.columns if col not in self.identifiers]
+        matrix = np.empty((len(self.data), len(features)), dtype=dtype)
+        for position, col in enumerate(features):
+            if col in self.encoder.levels:
+                matrix[:, position] = self.encoder.encode(col, self.data[col])
+            else:
+                matrix[:, position] = self.data[col].to_numpy(dtype=dtype, na_value=np.nan)
+        return matrix
+
+    def build_feature_matrix(self, dtype=np.float32):
+        try:
+            logging.info('Building the feature matrix')
+            self.transformed_data = self.get_feature_matrix(dtype)
+            logging.info('successfully built the feature matrix')
+        except Exception as e:
+            logging.error('building the feature matrix failed with error:')
+            logging.error(e)
+            return 1
+        return 0
+
+    def prepare_features(self, dtype=np.float32):
+        try:
+            for step in [self.handle_missing_data, self.handle_invalid_data, lambda: self.build_feature_matrix(dtype)]:
+                if step() != 0:
+                    logging.error('The Data Preparation has failed. Please check the error messages')
+                    return None
+        except Exception as e:
+            logging.error('The Data Preparation has failed. Please check the error messages')
+            logging.error(e)
+            return None
+        logging.info('Successfully Prepared the features')
+        return self.transformed_data
+
+    def prepare_data(self, normalize=True):
+        try:
+            missing_data_result = self.handle_missing_data()
+            if missing_data_result != 0:
+                logging.error('The Data Preparation has failed. Please check the error messages')
+                return None
+            invalid_data_result = self.handle_invalid_data()
+            if invalid_data_result != 0:
+                logging.error('The Data Preparation has failed. Please check the error messages')
+                return None
+            self.transformed_data = self.data.copy()
+            categorical_data_result = self.handle_categorical_data()
+            if categorical_data_result != 0:
+                logging.error('The Data Preparation has failed. Please check the error messages')
+                return None
+            remove_identifier_result = self.remove_identifiers()
+            if remove_identifier_result != 0:
+                logging.error('The Data Preparation has failed. Please check the error messages')
+                return None
+            normalize_result = self.normalize_data() if normalize else 0
+            if normalize_result != 0:
+                logging.error('The Data Preparation has failed. Please check the error messages')
+                return None
+
+        except Exception as e:
+            logging.error('The Data Preparation has failed. Please check the error messages')
+            logging.error(e)
+            return None
+        logging.info('Successfully Prepared the data')
+        return self.transformed_data
+
+
+if __name__ == "__main__":
+    CategoricalEncoder.from_config(CATEGORICAL).save(ENCODER)
+    data_ = pd.read_csv(DATA)
+    preprocessor = DataPreprocessor(data_, SCALER, IDENTIFIERS, CATEGORICAL,
+                                    encoder=CategoricalEncoder.load(ENCODER), validator=DataValidator.from_schema())
+    transform_data = preprocessor.prepare_data()
+    print(transform_data.shape, dict(preprocessor.reject_counts))
+
+
@@ -0,0 +1,165 @@
+"""
+This module keeps a local sqlite cache of the probabilities and tiers already computed for a feature row
+
+A result is keyed by the hash of the encoded (unscaled) feature row and stored under a namespace ('probability'
+or 'tier') and a version: the hash of the model artifacts for the probabilities and of the rules for the tiers.
+When a saved model changes its version changes and the results of the old version are no longer served. They
+are not deleted on open, since other configs (e.g. an ensemble batch run next to the scoring service) may share
+the cache file and still use them; unused versions age out. Entries older than ttl seconds expire and the least
+recently used entries are evicted once there are more than max_entries.
+
+Counting the entries scans the whole table, so a cache only counts them when the entries it may have added pass
+max_entries, or every MAINTENANCE_ROWS rows it put, and then evicts down to (1 - EVICT_SLACK) * max_entries.
+"""
+import logging
+import time
+import numpy as np
+import pandas as pd
+from app_config import get_config
+from score_store import connect_sqlite, hash_rows
+
+logging.basicConfig(level=logging.DEBUG)
+logging.info('Executing the script as a standalone')
+
+'''
+Read Config File
+'''
+config = get_config()
+CACHE = config['CACHE']['PATH']
+TTL_HOURS = float(config['CACHE']['TTL_HOURS'])
+MAX_ENTRIES = int(float(config['CACHE']['MAX_ENTRIES']))
+
+MAINTENANCE_ROWS = 100000
+EVICT_SLACK = 0.1
+
+CREATE_CACHE_QUERY = "CREATE TABLE IF NOT EXISTS results (namespace TEXT NOT NULL, version TEXT NOT NULL, " \
+                     "feature_hash INTEGER NOT NULL, value, created_at REAL NOT NULL, used_at REAL NOT NULL, " \
+                     "PRIMARY KEY (namespace, version, feature_hash))"
+CREATE_USED_INDEX_QUERY = "CREATE INDEX IF NOT EXISTS results_used_at ON results (used_at)"
+CREATE_LOOKUP_QUERY = "CREATE TEMP TABLE IF NOT EXISTS lookup (feature_hash INTEGER PRIMARY KEY)"
+INSERT_LOOKUP_QUERY = "INSERT OR IGNORE INTO lookup (feature_hash) VALUES (?)"
+CLEAR_LOOKUP_QUERY = "DELETE FROM lookup"
+SELECT_CACHE_QUERY = "SELECT results.feature_hash, results.value FROM lookup CROSS JOIN results " \
+                     "ON results.namespace = ? AND results.version = ? " \
+                     "AND results.feature_hash = lookup.feature_hash WHERE results.created_at >= ?"
+UPSERT_CACHE_QUERY = "INSERT OR REPLACE INTO results (namespace, version, feature_hash, value, created_at, used_at) " \
+                     "VALUES (?, ?, ?, ?, ?, ?)"
+TOUCH_CACHE_QUERY = "UPDATE results SET used_at = ? WHERE namespace = ? AND version = ? AND created_at >= ? " \
+                    "AND feature_hash IN (SELECT feature_hash FROM lookup)"
+DELETE_EXPIRED_QUERY = "DELETE FROM results WHERE created_at < ?"
+DELETE_LRU_QUERY = "DELETE FROM results WHERE rowid IN (SELECT rowid FROM results ORDER BY used_at LIMIT ?)"
+COUNT_QUERY = "SELECT COUNT(*) FROM results"
+
+
+def hash_features(features):
+    return hash_rows(pd.DataFrame(np.asarray(features)))
+
+
+'''
+class: ResultCache
+Parameters: path -> string value; path of the sqlite cache file
+            namespace -> 'probability' or 'tier'; the kind of result cached
+            version -> string value; from score_store.get_model_version over what the results depend on
+            ttl -> seconds an entry is served for; never expires when 0 or None
+            max_entries -> number of entries kept over all namespaces, the least recently used are evicted first
+Returns: a boolean mask of the hashes found and the cached values from get
+'''
+
+
+class ResultCache:
+    def __init__(self, path, namespace, version, ttl=None, max_entries=None):
+        self.path = path
+        self.namespace = namespace
+        self.version = version
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.connector = None
+        self.hits = 0
+        self.misses = 0
+        self.entries = None  # an upper bound of the entries, counted when it passes max_entries
+        self.put_rows = 0  # rows put since the last eviction
+
+    def connect(self):
+        if self.connector is None:
+            self.connector = connect_sqlite(self.path)
+            self.connector.execute(CREATE_CACHE_QUERY)
+            self.connector.execute(CREATE_USED_INDEX_QUERY)
+            self.connector.execute(CREATE_LOOKUP_QUERY)
+            self.connector.commit()
+        return self.connector
+
+    def get(self, feature_hashes):
+        # only the requested hashes are read: a temporary table of them is joined on the primary key of results
+        # (CROSS JOIN keeps sqlite from scanning the whole version and probing the lookup table instead)
+        oldest = time.time() - self.ttl if self.ttl else 0
+        connector = self.connect()
+        connector.execute(CLEAR_LOOKUP_QUERY)
+        connector.executemany(INSERT_LOOKUP_QUERY, ((feature_hash,) for feature_hash in
+                                                    np.unique(feature_hashes).tolist()))
+        cached = pd.read_sql_query(SELECT_CACHE_QUERY, connector, params=(self.namespace, self.version, oldest))
+        positions = pd.Index(cached['feature_hash']).get_indexer(feature_hashes) if len(cached) \
+            else np.full(len(feature_hashes), -1)
+        found = positions >= 0
+        values = cached['value'].to_numpy(dtype=object)[positions[found]] if found.any() else np.empty(0, object)
+        self.hits += int(found.sum())
+        self.misses += int((~found).sum())
+        # the read ends before the touch: in WAL mode a read transaction that starts writing after another process
+        # wrote fails at once instead of waiting for the busy timeout
+        connector.commit()
+        if found.any():
+            connector.execute(TOUCH_CACHE_QUERY, (time.time(), self.namespace, self.version, oldest))
+        connector.execute(CLEAR_LOOKUP_QUERY)
+        connector.commit()
+        logging.info("%d of %d %s results were cached", found.sum(), len(found), self.namespace)
+        return found, values
+
+    def put(self, feature_hashes, values):
+        now = time.time()
+        rows = [(self.namespace, self.version, feature_hash, value, now, now)
+                for feature_hash, value in zip(feature_hashes.tolist(), list(values))]
+        connector = self.connect()
+        connector.executemany(UPSERT_CACHE_QUERY, rows)
+        connector.commit()
+        self.put_rows += len(rows)
+        if self.entries is not None:
+            self.entries += len(rows)  # replaced entries are counted again, so this can only overestimate
+        if self.needs_eviction():
+            self.evict()
+
+    def needs_eviction(self):
+        if self.put_rows >= MAINTENANCE_ROWS:
+            return bool(self.ttl or self.max_entries)
+        return bool(self.max_entries) and (self.entries is None or self.entries > self.max_entries)
+
+    def evict(self):
+        connector = self.connect()
+        if self.ttl:
+            connector.execute(DELETE_EXPIRED_QUERY, (time.time() - self.ttl,))
+        if self.max_entries:
+            self.entries = connector.execute(COUNT_QUERY).fetchone()[0]
+            if self.entries > self.max_entries:
+                extra = self.entries - int(self.max_entries * (1 - EVICT_SLACK))
+                connector.execute(DELETE_LRU_QUERY, (extra,))
+                self.entries -= extra
+                logging.info("Evicted the %d least recently used cached results", extra)
+        connector.commit()
+        self.put_rows = 0
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else None}
+
+    def close(self):
+        if self.connector is not None:
+            self.connector.close()
+            self.connector = None
+
+
+if __name__ == "__main__":
+    cache = ResultCache(CACHE, 'probability', 'standalone', ttl=TTL_HOURS * 3600, max_entries=MAX_ENTRIES)
+    hashes = hash_features(np.random.default_rng(0).integers(0, 10, (1000, 3)))
+    found_, _ = cache.get(hashes)
+    cache.put(hashes[~found_], np.zeros((~found_).sum()))
+    cache.get(hashes)
+    print(cache.get_stats())
+    cache.close()
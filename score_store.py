@@ -0,0 +1,121 @@
+"""
+This module keeps a local sqlite sidecar of the loans already scored, for incremental runs
+
+For every loan_id the store keeps a hash of its input row and the version of the models and rules it was
+scored with. Only loans that are new, whose row changed or that were scored by another model version
+need to be scored again.
+
+The workers of batch_runner share the sqlite files, so connect_sqlite opens them in write ahead log mode (readers
+do not block the writer) with a busy timeout: a worker waits for the lock of another one instead of failing.
+"""
+import hashlib
+import logging
+import sqlite3
+from app_config import get_config
+from load_model import get_artifact_file
+import numpy as np
+import pandas as pd
+
+logging.basicConfig(level=logging.DEBUG)
+logging.info('Executing the script as a standalone')
+
+'''
+Read Config File
+'''
+config = get_config()
+STORE = config['INCREMENTAL']['STORE']
+DATA = config['DATA']['PATH']
+
+BUSY_TIMEOUT = 60  # seconds a connection waits for another process to release the lock of the file
+
+WAL_QUERY = "PRAGMA journal_mode=WAL"
+CREATE_STORE_QUERY = "CREATE TABLE IF NOT EXISTS loan_scores (loan_id INTEGER PRIMARY KEY, row_hash INTEGER NOT NULL, " \
+                     "model_version TEXT NOT NULL)"
+CREATE_LOOKUP_QUERY = "CREATE TEMP TABLE IF NOT EXISTS lookup (loan_id INTEGER PRIMARY KEY)"
+INSERT_LOOKUP_QUERY = "INSERT OR IGNORE INTO lookup (loan_id) VALUES (?)"
+CLEAR_LOOKUP_QUERY = "DELETE FROM lookup"
+SELECT_STORE_QUERY = "SELECT loan_scores.loan_id, loan_scores.row_hash FROM lookup CROSS JOIN loan_scores " \
+                     "ON loan_scores.loan_id = lookup.loan_id WHERE loan_scores.model_version = ?"
+UPSERT_STORE_QUERY = "INSERT OR REPLACE INTO loan_scores (loan_id, row_hash, model_version) VALUES (?, ?, ?)"
+
+
+def connect_sqlite(path, timeout=BUSY_TIMEOUT):
+    connector = sqlite3.connect(path, timeout=timeout)
+    connector.execute(WAL_QUERY)
+    return connector
+
+
+def hash_rows(data, columns=None):
+    columns = data.columns if columns is None else columns
+    return pd.util.hash_pandas_object(data[columns], index=False).to_numpy().view(np.int64)
+
+
+def get_model_version(paths, rules=None):
+    version = hashlib.sha256()
+    for path in paths:
+        with open(get_artifact_file(path), 'rb') as artifact_file:
+            version.update(artifact_file.read())
+    version.update(repr(rules).encode('utf-8'))
+    return version.hexdigest()[:16]
+
+
+'''
+class: ScoreStore
+Parameters: path -> string value; path of the sqlite sidecar file
+            model_version -> string value; from get_model_version
+            key -> the identifier column of a loan
+Returns: boolean mask of the rows to score from get_changed_rows
+'''
+
+
+class ScoreStore:
+    def __init__(self, path, model_version, key='loan_id'):
+        self.path = path
+        self.model_version = model_version
+        self.key = key
+        self.connector = None
+
+    def connect(self):
+        if self.connector is None:
+            self.connector = connect_sqlite(self.path)
+            self.connector.execute(CREATE_STORE_QUERY)
+            self.connector.execute(CREATE_LOOKUP_QUERY)
+            self.connector.commit()
+        return self.connector
+
+    def get_changed_rows(self, data, row_hashes):
+        # only the loans of data are read, joined from a temporary table of their keys on the loan_id primary key
+        connector = self.connect()
+        connector.execute(CLEAR_LOOKUP_QUERY)
+        connector.executemany(INSERT_LOOKUP_QUERY, ((loan_id,) for loan_id in pd.unique(data[self.key]).tolist()))
+        scored = pd.read_sql_query(SELECT_STORE_QUERY, connector, params=(self.model_version,))
+        connector.execute(CLEAR_LOOKUP_QUERY)
+        connector.commit()
+        if scored.empty:
+            logging.info("None of the loans were scored with model version " + self.model_version + " yet")
+            return np.ones(len(data), dtype=bool)
+        positions = pd.Index(scored['loan_id']).get_indexer(data[self.key])
+        previous_hashes = scored['row_hash'].to_numpy(dtype=np.int64)[positions]
+        changed = (positions < 0) | (previous_hashes != row_hashes)
+        logging.info("%d of %d loans are new or changed since the last run", changed.sum(), len(changed))
+        return changed
+
+    def record_scored_rows(self, data, row_hashes):
+        rows = zip(data[self.key].tolist(), row_hashes.tolist(), [self.model_version] * len(data))
+        connector = self.connect()
+        connector.executemany(UPSERT_STORE_QUERY, rows)
+        connector.commit()
+
+    def close(self):
+        if self.connector is not None:
+            self.connector.close()
+            self.connector = None
+
+
+if __name__ == "__main__":
+    data_ = pd.read_csv(DATA)
+    store = ScoreStore(STORE, 'standalone')
+    hashes = hash_rows(data_)
+    print(store.get_changed_rows(data_, hashes).sum())
+    store.record_scored_rows(data_, hashes)
+    print(store.get_changed_rows(data_, hashes).sum())
@@ -0,0 +1,348 @@
+"""
+This module serves real time default probability and tier scoring over HTTP
+
+The scaler, classifier and tier rules are loaded once and kept resident. Concurrent requests are
+coalesced into micro batches (up to max_batch_size records or max_wait_ms milliseconds) so the
+model scores a matrix per batch instead of one row per request.
+
+Endpoints:
+POST /score   -> a loan record or a list of loan records as JSON
+GET /metrics  -> p50/p99 latency, throughput and batch statistics as JSON
+GET /health   -> liveness check
+"""
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+from collections import deque
+from app_config import get_config
+import numpy as np
+import pandas as pd
+from load_model import Model
+from prepare_input_data import DataPreprocessor, CategoricalEncoder, DataValidator, REJECTED_RULES_COLUMN
+from infer import Classifier
+from get_customer_tier import TierClassifier
+
+logging.basicConfig(level=logging.DEBUG)
+logging.info('Executing the script as a standalone')
+
+'''
+Read Config File
+'''
+config = get_config()
+CLASSIFIER = config['MODELS']['CLASSIFIER']
+SCALER = config['MODELS']['SCALER']
+ENCODER = config['MODELS']['ENCODER']
+IDENTIFIERS = config.get('DATA', 'IDENTIFIERS').split(",")
+CATEGORICAL = config.get('DATA', 'CATEGORICAL').split(",")
+COLUMNS = config.get('DATA', 'COLUMNS').split(",")
+DATA = config['DATA']['PATH']
+CUSTOMER = config.items('CUSTOMER')
+VALIDATION = config.getboolean('VALIDATION', 'ENABLED')
+SCHEMA = config['DATA']['SCHEMA'] or config['QUERY']['CREATE']
+HOST = config['SCORING']['HOST']
+PORT = int(config['SCORING']['PORT'])
+MAX_BATCH_SIZE = int(config['SCORING']['MAX_BATCH_SIZE'])
+MAX_WAIT_MS = float(config['SCORING']['MAX_WAIT_MS'])
+
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}
+
+'''
+class: ScoringService
+Parameters: model -> loaded classifier
+            scaler -> loaded scaler
+            identifiers, categorical, columns -> list objects from the [DATA] config
+            rules -> tier rules from the [CUSTOMER] config
+            max_batch_size -> maximum number of records scored together
+            max_wait_ms -> maximum time the first record of a batch waits for more records
+            encoder -> CategoricalEncoder, the same encoder artifact the batch pipeline scores with
+            validator -> DataValidator; a record breaking its rules fails with a ValueError, as the batch pipeline
+                         would quarantine it
+Returns: a list of dicts with loan_id, default_probability and customer_tier from score
+         A record that can not be scored only fails its own request, not the other records of its micro batch
+'''
+
+
+class ScoringService:
+    def __init__(self, model, scaler, identifiers, categorical, columns, rules, max_batch_size=64, max_wait_ms=5,
+                 encoder=None, validator=None):
+        self.model = model
+        self.scaler = scaler
+        self.encoder = encoder
+        self.validator = validator
+        self.identifiers = identifiers
+        self.categorical = categorical
+        self.columns = columns
+        self.tier_classifier = TierClassifier(None, rules)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = None
+        self.batch_task = None
+        self.latencies = deque(maxlen=100000)
+        self.batch_sizes = deque(maxlen=10000)
+        self.started_at = None
+        self.scored = 0
+
+    async def start(self):
+        if self.tier_classifier.compile_rules() != 0:
+            raise ValueError("The tier rules could not be compiled")
+        self.queue = asyncio.Queue()
+        self.batch_task = asyncio.create_task(self.batch_worker())
+        self.started_at = time.perf_counter()
+
+    async def stop(self):
+        self.batch_task.cancel()
+        try:
+            await self.batch_task
+        except asyncio.CancelledError:
+            pass
+
+    def validate_records(self, records):
+        if not isinstance(records, list):
+            raise ValueError("The body should be a JSON object or a list of JSON objects")
+        for record in records:
+            if not isinstance(record, dict):
+                raise ValueError("Each record should be a JSON object")
+            missing = [col for col in self.columns if col not in record]
+            if missing:
+                raise ValueError("The record is missing the columns " + ",".join(missing))
+
+    async def score(self, records):
+        self.validate_records(records)
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        futures = []
+        for record in records:
+            future = loop.create_future()
+            await self.queue.put((record, future))
+            futures.append(future)
+        results = await asyncio.gather(*futures)
+        self.latencies.append(time.perf_counter() - start)
+        return results
+
+    async def collect_batch(self):
+        batch = [await self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def batch_worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.collect_batch()
+            records = [record for record, _ in batch]
+            try:
+                results = await loop.run_in_executor(None, self.score_batch, records)
+            except Exception as e:
+                logging.error("Failed to score the batch. Check the error below")
+                logging.error(e)
+                # score the records one by one, so only the records that fail on their own get an error
+                results = await loop.run_in_executor(None, self.score_records, records) if len(records) > 1 else [e]
+            for (_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+            self.batch_sizes.append(len(batch))
+            self.scored += sum(not isinstance(result, Exception) for result in results)
+
+    def score_records(self, records):
+        results = []
+        for record in records:
+            try:
+                results.extend(self.score_batch([record]))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def score_batch(self, records):
+        # a list with the scores of every record, or the ValueError of a record rejected by the validator
+        data = pd.DataFrame.from_records(records, columns=self.columns)
+        data_preprocessor = DataPreprocessor(data=data, scaler_path=None, identifiers=self.identifiers,
+                                             categorical=self.categorical, scaler=self.scaler, encoder=self.encoder,
+                                             validator=self.validator)
+        transformed_data = data_preprocessor.prepare_data()
+        if transformed_data is None:
+            raise ValueError("The records could not be prepared")
+        results = [None] * len(records)
+        if data_preprocessor.rejected_data is not None:
+            for position, rules in data_preprocessor.rejected_data[REJECTED_RULES_COLUMN].items():
+                results[position] = ValueError("The record breaks the validation rules " + rules)
+        valid_data = data_preprocessor.data
+        if len(valid_data) == 0:
+            return results
+        probabilities = Classifier(data=transformed_data, model_path=None, model=self.model).infer_data()
+        if probabilities is None:
+            raise ValueError("The records could not be scored")
+        self.tier_classifier.data = valid_data
+        tiers = self.tier_classifier.rule_engine()
+        if tiers is None:
+            raise ValueError("The tiers could not be generated")
+        for position, loan_id, probability, tier in zip(valid_data.index, valid_data['loan_id'].tolist(),
+                                                        probabilities, tiers.tolist()):
+            results[position] = {'loan_id': loan_id, 'default_probability': float(probability),
+                                 'customer_tier': tier}
+        return results
+
+    def get_metrics(self):
+        latencies = np.array(self.latencies) * 1000
+        elapsed = time.perf_counter() - self.started_at
+        return {'requests': len(latencies),
+                'records_scored': self.scored,
+                'throughput_records_per_second': self.scored / elapsed if elapsed > 0 else 0.0,
+                'latency_p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+                'latency_p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+                'mean_batch_size': float(np.mean(self.batch_sizes)) if self.batch_sizes else None}
+
+
+'''
+HTTP handling on top of asyncio streams
+'''
+
+
+async def read_request(reader):
+    request_line = await reader.readline()
+    if not request_line:
+        return None, None, None
+    method, path, _ = request_line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, value = line.decode('latin-1').split(':', 1)
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return method, path, body
+
+
+async def write_response(writer, status, payload):
+    body = json.dumps(payload).encode('utf-8')
+    writer.write(('HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n'
+                  % (status, STATUS_TEXT[status], len(body))).encode('latin-1') + body)
+    await writer.drain()
+
+
+def make_handler(service):
+    async def handle(reader, writer):
+        try:
+            while True:
+                method, path, body = await read_request(reader)
+                if method is None:
+                    break
+                if method == 'POST' and path == '/score':
+                    try:
+                        records = json.loads(body)
+                        if isinstance(records, dict):
+                            records = [records]
+                        service.validate_records(records)
+                    except (ValueError, TypeError, AttributeError) as e:
+                        await write_response(writer, 400, {'error': str(e)})
+                        continue
+                    try:
+                        await write_response(writer, 200, await service.score(records))
+                    except ValueError as e:
+                        await write_response(writer, 400, {'error': str(e)})
+                    except Exception as e:
+                        await write_response(writer, 500, {'error': str(e)})
+                elif method == 'GET' and path == '/metrics':
+                    await write_response(writer, 200, service.get_metrics())
+                elif method == 'GET' and path == '/health':
+                    await write_response(writer, 200, {'status': 'ok'})
+                else:
+                    await write_response(writer, 404, {'error': 'Unknown endpoint ' + path})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except ValueError as e:
+            # a malformed request line, header or Content-Length: the next request cannot be found in the stream
+            try:
+                await write_response(writer, 400, {'error': 'Malformed request: ' + str(e)})
+            except ConnectionError:
+                pass
+        finally:
+            writer.close()
+    return handle
+
+
+async def serve(service, host, port):
+    await service.start()
+    server = await asyncio.start_server(make_handler(service), host, port)
+    logging.info("Scoring service listening on " + host + ":" + str(port))
+    async with server:
+        await server.serve_forever()
+
+
+'''
+Load test client: one keep-alive connection per concurrent client, one record per request
+'''
+
+
+def load_records(path):
+    if path.endswith('.jsonl'):
+        with open(path, 'r') as records_file:
+            return [json.loads(line) for line in records_file if line.strip()]
+    return pd.read_csv(path).to_dict(orient='records')
+
+
+async def run_client(host, port, records, latencies):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for record in records:
+            body = json.dumps(record).encode('utf-8')
+            start = time.perf_counter()
+            writer.write(('POST /score HTTP/1.1\r\nHost: %s\r\nContent-Type: application/json\r\n'
+                          'Content-Length: %d\r\n\r\n' % (host, len(body))).encode('latin-1') + body)
+            await writer.drain()
+            headers = {}
+            await reader.readline()
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, value = line.decode('latin-1').split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+            await reader.readexactly(int(headers.get('content-length', 0)))
+            latencies.append(time.perf_counter() - start)
+    finally:
+        writer.close()
+
+
+async def run_load_test(host, port, records, concurrency=32, total=10000):
+    requests = [records[i % len(records)] for i in range(total)]
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*[run_client(host, port, requests[i::concurrency], latencies)
+                           for i in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    latencies = np.array(latencies) * 1000
+    results = {'requests': len(latencies),
+               'throughput_requests_per_second': len(latencies) / elapsed,
+               'latency_p50_ms': float(np.percentile(latencies, 50)),
+               'latency_p99_ms': float(np.percentile(latencies, 99))}
+    logging.info("Load test results: " + json.dumps(results))
+    return results
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'loadtest':
+        fixture = sys.argv[2] if len(sys.argv) > 2 else DATA
+        asyncio.run(run_load_test(HOST, PORT, load_records(fixture)))
+    else:
+        logging.getLogger().setLevel(logging.WARNING)  # the per batch INFO logs slow down online scoring
+        scoring_service = ScoringService(Model(CLASSIFIER).load_model(), Model(SCALER).load_model(), IDENTIFIERS,
+                                         CATEGORICAL, COLUMNS, CUSTOMER, max_batch_size=MAX_BATCH_SIZE,
+                                         max_wait_ms=MAX_WAIT_MS,
+                                         encoder=CategoricalEncoder.load(ENCODER) if os.path.exists(ENCODER) else None,
+                                         validator=DataValidator.from_schema(SCHEMA) if VALIDATION else None)
+        asyncio.run(serve(scoring_service, HOST, PORT))
@@ -0,0 +1,129 @@
+"""
+This script generates synthetic loan data in the format of the inference input, for benchmarks at any scale
+
+The rows are sampled from the training data (data/train), so the joint distribution of the columns is kept,
+and the continuous columns are jittered within their observed range so the rows are not exact copies.
+The one hot loan type and the 0/1 insurance and gender columns of the training data are mapped back to the
+values of the inference input. The dtypes follow the CREATE TABLE query and customer_id/loan_id are unique.
+
+Usage: python synthetic_data.py <rows> <output path (.csv, .parquet or .feather)>
+"""
+import logging
+import os
+import sys
+from app_config import get_config
+import numpy as np
+import pandas as pd
+from ingest_data import FILE_FORMATS, get_schema_dtypes
+
+logging.basicConfig(level=logging.DEBUG)
+logging.info('Executing the script as a standalone')
+
+'''
+Read Config File
+'''
+config = get_config()
+TRAIN = config['BENCHMARK']['TRAIN']
+CREATE_QUERY = config['QUERY']['CREATE']
+COLUMNS = config.get('DATA', 'COLUMNS').split(",")
+
+# dummy_dataset.csv labels the education loans of the training data as Vehicle loans
+LOAN_TYPES = {'Home_loan': 'Home', 'Auto_loan': 'Vehicle', 'Education_loan': 'Vehicle'}
+BINARY_VALUES = {'insurance': ('No', 'Yes'), 'gender': ('Female', 'Male')}
+JITTER_COLUMNS = ['age', 'savings', 'spend_behaviour_change', 'credit_score_change', 'monthly_payments',
+                  'outstanding_amount', 'total_percent_paid']
+JITTER_SCALE = 0.05
+DECIMALS = {'savings': 2, 'spend_behaviour_change': 2, 'total_percent_paid': 2}
+CHUNK_SIZE = 1000000
+
+'''
+class: SyntheticLoanGenerator
+Parameters: train_path -> string value; path of the training data
+            schema_path -> string value; path of the CREATE TABLE query the dtypes are derived from
+            columns -> list object of the generated columns, in order
+            seed -> seed of the random generator
+Returns: a pandas DataFrame of synthetic loans from generate
+'''
+
+
+class SyntheticLoanGenerator:
+    def __init__(self, train_path=TRAIN, schema_path=CREATE_QUERY, columns=None, seed=0):
+        self.train_path = train_path
+        self.schema_path = schema_path
+        self.columns = columns or COLUMNS
+        self.random = np.random.default_rng(seed)
+        self.profile = None
+        self.dtypes = None
+
+    def fit(self):
+        train = pd.read_csv(self.train_path)
+        profile = pd.DataFrame(index=train.index)
+        loan_types = list(LOAN_TYPES)
+        profile['loan_type'] = np.array([LOAN_TYPES[col] for col in loan_types])[train[loan_types].to_numpy().argmax(1)]
+        for col, values in BINARY_VALUES.items():
+            profile[col] = np.array(values)[train[col].to_numpy()]
+        for col in self.columns:
+            if col not in profile:
+                profile[col] = train[col]
+        self.profile = profile[self.columns]
+        self.dtypes = {col: dtype for col, dtype in get_schema_dtypes(self.schema_path).items() if col in self.columns}
+        return self
+
+    def jitter(self, values, col):
+        observed = self.profile[col]
+        noise = self.random.normal(0, JITTER_SCALE * observed.std(), len(values))
+        values = np.clip(values + noise, observed.min(), observed.max())
+        if col in DECIMALS:
+            return np.round(values, DECIMALS[col])
+        return np.rint(values)
+
+    def generate(self, rows, start=0):
+        if self.profile is None:
+            self.fit()
+        data = self.profile.iloc[self.random.integers(0, len(self.profile), rows)].reset_index(drop=True)
+        for col in JITTER_COLUMNS:
+            if col in data:
+                data[col] = self.jitter(data[col].to_numpy(dtype=np.float64), col)
+        ids = np.arange(start + 1, start + rows + 1)
+        if 'customer_id' in data:
+            data['customer_id'] = ids
+        if 'loan_id' in data:
+            data['loan_id'] = ids + 1120  # the loan ids of the sample data start after 1120
+        data.index = pd.RangeIndex(start, start + rows)
+        return data.astype(self.dtypes)
+
+    def generate_chunks(self, rows, chunk_size=CHUNK_SIZE):
+        for start in range(0, rows, chunk_size):
+            yield self.generate(min(chunk_size, rows - start), start=start)
+
+    def write(self, path, rows, chunk_size=CHUNK_SIZE):
+        # writes chunk by chunk so 1e7 rows never have to be in memory together
+        file_format = FILE_FORMATS.get(os.path.splitext(path)[1].lower(), 'csv')
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if file_format == 'csv':
+            for chunk in self.generate_chunks(rows, chunk_size):
+                chunk.to_csv(path, mode='a' if chunk.index[0] > 0 else 'w', header=chunk.index[0] == 0, index=False)
+        elif file_format == 'parquet':
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            writer = None
+            try:
+                for chunk in self.generate_chunks(rows, chunk_size):
+                    table = pa.Table.from_pandas(chunk, preserve_index=False)
+                    if writer is None:
+                        writer = pq.ParquetWriter(path, table.schema)
+                    writer.write_table(table)
+            finally:
+                if writer is not None:
+                    writer.close()
+        else:
+            import pyarrow.feather as feather
+            feather.write_feather(pd.concat(self.generate_chunks(rows, chunk_size)), path)
+        logging.info("Saved %d synthetic loans at %s", rows, path)
+        return path
+
+
+if __name__ == "__main__":
+    SyntheticLoanGenerator().write(sys.argv[2], int(float(sys.argv[1])))
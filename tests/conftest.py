@@ -0,0 +1,83 @@
+"""
+The tests run in a work directory holding the data, saved models and queries of the zips and a copy of config.ini
+
+The modules read config.ini at import time, so the work directory and the DEFAULT_PREDICTION_CONFIG environment
+variable are set up here, before any test module imports them. The Windows separators of the config paths are
+turned into forward slashes, which both Windows and Linux accept.
+
+The scaler and models are fitted on the training data by the saved_models fixture instead of read from
+saved_models.zip, whose pickles only load with the scikit-learn version they were saved with.
+"""
+import atexit
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import zipfile
+import numpy as np
+import pandas as pd
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ARCHIVES = ['data.zip', 'saved_models.zip', 'sql.zip']
+DUMMY_DATA = os.path.join('data', 'infer', 'dummy_dataset.csv')
+TRAIN_DATA = os.path.join('data', 'train', 'dummy_data_with_targets.csv')
+TARGET = 'default'
+
+WORK_DIR = tempfile.mkdtemp(prefix='default_prediction_tests_')
+atexit.register(shutil.rmtree, WORK_DIR, True)
+for archive in ARCHIVES:
+    with zipfile.ZipFile(os.path.join(ROOT, archive)) as archive_file:
+        archive_file.extractall(WORK_DIR)
+with open(os.path.join(ROOT, 'config.ini'), 'r') as config_file:
+    config_text = config_file.read().replace('\\\\', '/')
+with open(os.path.join(WORK_DIR, 'config.ini'), 'w') as config_file:
+    config_file.write(config_text)
+os.environ['DEFAULT_PREDICTION_CONFIG'] = os.path.join(WORK_DIR, 'config.ini')
+os.chdir(WORK_DIR)
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture
+def dummy_data():
+    return pd.read_csv(DUMMY_DATA)
+
+
+@pytest.fixture(scope='session')
+def saved_models(tmp_path_factory):
+    from sklearn.ensemble import GradientBoostingClassifier, RandomForestClassifier
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.preprocessing import MinMaxScaler
+    from app_config import PipelineSettings
+    settings = PipelineSettings.from_config()
+    train_data = pd.read_csv(TRAIN_DATA)
+    # the training data has one column per loan type; the pipeline codes Home loans 1 and the others 0
+    train_data['loan_type'] = train_data['Home_loan']
+    features = [col for col in pd.read_csv(DUMMY_DATA, nrows=0).columns if col not in settings['identifiers']]
+    scaler = MinMaxScaler().fit(train_data[features].to_numpy(dtype=np.float64))
+    scaled = scaler.transform(train_data[features].to_numpy(dtype=np.float64))
+    artifacts = {'scaler': scaler,
+                 'logistic_regression': LogisticRegression(max_iter=1000).fit(scaled, train_data[TARGET]),
+                 'rf': RandomForestClassifier(n_estimators=20, random_state=0).fit(scaled, train_data[TARGET]),
+                 'gbm': GradientBoostingClassifier(n_estimators=20, random_state=0).fit(scaled, train_data[TARGET])}
+    directory = tmp_path_factory.mktemp('saved_models')
+    paths = {}
+    for name, artifact in artifacts.items():
+        paths[name] = str(directory / (name + '.sav'))
+        with open(paths[name], 'wb') as artifact_file:
+            pickle.dump(artifact, artifact_file)
+    return paths
+
+
+@pytest.fixture
+def settings(saved_models, tmp_path):
+    # the pipeline settings of the config, reading the dummy data and writing every output under tmp_path
+    from app_config import PipelineSettings
+    os.makedirs(str(tmp_path / 'insights'))
+    return PipelineSettings.from_config().replace(sql=False, database=None, input_path=DUMMY_DATA,
+                                                  model_path=saved_models['logistic_regression'],
+                                                  scaler_path=saved_models['scaler'], encoder_path=None,
+                                                  output_path=str(tmp_path / 'insights') + os.sep,
+                                                  quarantine_path=str(tmp_path / 'quarantine'), metrics_path=None,
+                                                  prometheus_path=None, checkpoint_path=None)
@@ -0,0 +1,36 @@
+import os
+import pandas as pd
+import pytest
+from batch_runner import BatchRunner
+
+
+@pytest.fixture
+def partitions(dummy_data, tmp_path):
+    directory = tmp_path / 'partitions'
+    directory.mkdir()
+    for part, start in enumerate(range(0, len(dummy_data), 100)):
+        dummy_data.iloc[start:start + 100].to_csv(str(directory / ('part-%d.csv' % part)), index=False)
+    return directory
+
+
+def get_merged_output(settings):
+    return os.path.join(settings['output_path'], 'merged.csv')
+
+
+def test_merged_run_persists_every_partition(settings, dummy_data, partitions):
+    settings = settings.replace(output_name='merged')
+    assert BatchRunner(str(partitions), settings=settings, workers=2, merge=True).run() == 0
+    assert sorted(pd.read_csv(get_merged_output(settings))['loan_id']) == sorted(dummy_data['loan_id'])
+
+
+def test_merged_run_keeps_the_previous_output_when_a_partition_fails(settings, partitions):
+    settings = settings.replace(output_name='merged')
+    with open(get_merged_output(settings), 'w') as output_file:
+        output_file.write('previous output\n')
+    with open(str(partitions / 'part-9.csv'), 'w') as corrupt_file:
+        corrupt_file.write('not,a,loan\n1,2,3\n')
+    runner = BatchRunner(str(partitions), settings=settings, workers=2, merge=True)
+    assert runner.run() == -1
+    assert runner.report['failed'] == [str(partitions / 'part-9.csv')]
+    with open(get_merged_output(settings)) as output_file:
+        assert output_file.read() == 'previous output\n'
@@ -0,0 +1,35 @@
+import itertools
+import pandas as pd
+import pytest
+from app_config import PipelineSettings
+from get_customer_tier import TierClassifier
+from synthetic_data import SyntheticLoanGenerator
+
+
+@pytest.fixture
+def rules():
+    return PipelineSettings.from_config()['customer_rules']
+
+
+@pytest.fixture
+def boundary_data(rules):
+    # every combination of the values around the thresholds of the rules
+    values = []
+    for col, rule in rules:
+        high, low, _ = rule.split(",")
+        values.append(sorted({int(bound) + step for bound in (high, low) for step in (-1, 0, 1)}))
+    return pd.DataFrame(list(itertools.product(*values)), columns=[col for col, _ in rules])
+
+
+@pytest.mark.parametrize('source', ['dummy', 'boundary', 'synthetic'])
+def test_vectorized_tiers_match_the_row_wise_tiers(dummy_data, boundary_data, rules, source):
+    data = {'dummy': dummy_data, 'boundary': boundary_data,
+            'synthetic': SyntheticLoanGenerator(seed=1).generate(5000)}[source]
+    row_wise = TierClassifier(data, rules).rule_engine(vectorized=False)
+    pd.testing.assert_series_equal(TierClassifier(data, rules).rule_engine(vectorized=True), row_wise)
+    categorical = TierClassifier(data, rules).rule_engine(vectorized=True, categorical=True)
+    pd.testing.assert_series_equal(categorical.astype(row_wise.dtype), row_wise)
+
+
+def test_every_tier_is_reached(boundary_data, rules):
+    assert set(TierClassifier(boundary_data, rules).rule_engine()) == {'A', 'B', 'C'}
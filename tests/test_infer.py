@@ -0,0 +1,60 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pytest
+import infer
+from app_config import PipelineSettings
+from infer import Classifier, COMPILED_REGISTRY, compile_model
+from load_model import Model
+from prepare_input_data import DataPreprocessor
+from synthetic_data import SyntheticLoanGenerator
+
+
+@pytest.fixture
+def preprocessor(saved_models):
+    settings = PipelineSettings.from_config()
+    data = SyntheticLoanGenerator(seed=2).generate(3000)
+    return DataPreprocessor(data=data, scaler_path=saved_models['scaler'], identifiers=settings['identifiers'],
+                            categorical=settings['categorical'])
+
+
+@pytest.fixture
+def scaler(saved_models):
+    return Model(saved_models['scaler'], use_cache=False).load_model()
+
+
+@pytest.mark.parametrize('name, dtype, tolerance', [('logistic_regression', np.float64, 1e-9),
+                                                     ('logistic_regression', np.float32, 1e-4),
+                                                     ('rf', np.float64, 1e-9),
+                                                     ('gbm', np.float64, 1e-9)])
+@pytest.mark.parametrize('compiled_trees', [False, True])
+def test_compiled_model_scores_like_predict_proba(saved_models, preprocessor, scaler, name, dtype, tolerance,
+                                                  compiled_trees):
+    model = Model(saved_models[name], use_cache=False).load_model()
+    features = preprocessor.get_feature_matrix(np.float64)
+    expected = Classifier(data=scaler.transform(features), model_path=None, model=model).infer_data()
+    COMPILED_REGISTRY.clear()
+    compiled = Classifier(data=features, model_path=None, model=model, compiled=True, scaler=scaler, dtype=dtype,
+                          compiled_trees=compiled_trees)
+    np.testing.assert_allclose(compiled.infer_data(), expected, rtol=tolerance, atol=tolerance)
+    # the compiled model is reused by the next batches, which it was not checked on
+    batch = Classifier(data=features[:7], model_path=None, model=model, compiled=True, scaler=scaler, dtype=dtype,
+                       compiled_trees=compiled_trees)
+    np.testing.assert_allclose(batch.infer_data(), expected[:7], rtol=tolerance, atol=tolerance)
+
+
+def test_threads_share_one_compiled_model(saved_models, preprocessor, scaler, monkeypatch):
+    model = Model(saved_models['logistic_regression'], use_cache=False).load_model()
+    features = preprocessor.get_feature_matrix(np.float64)
+    compiled_models = []
+
+    def compile_slowly(*args, **kwargs):
+        time.sleep(0.05)
+        compiled_models.append(compile_model(*args, **kwargs))
+        return compiled_models[-1]
+    monkeypatch.setattr(infer, 'compile_model', compile_slowly)
+    COMPILED_REGISTRY.clear()
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda _: COMPILED_REGISTRY.get(scaler, model, features), range(8)))
+    assert len(compiled_models) == 1
+    assert all(result is compiled_models[0] for result in results)
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+from sklearn.ensemble import GradientBoostingClassifier
+from sklearn.neighbors import KNeighborsClassifier
+from app_config import PipelineSettings
+from load_model import Model, load_artifact, export_artifact
+from prepare_input_data import DataPreprocessor
+
+
+@pytest.fixture
+def features(dummy_data, saved_models):
+    settings = PipelineSettings.from_config()
+    transformed_data = DataPreprocessor(data=dummy_data, scaler_path=saved_models['scaler'],
+                                        identifiers=settings['identifiers'],
+                                        categorical=settings['categorical']).prepare_data()
+    return np.asarray(transformed_data, dtype=np.float64)
+
+
+@pytest.mark.parametrize('name', ['logistic_regression', 'rf', 'gbm'])
+def test_exported_artifact_scores_like_the_pickle(tmp_path, saved_models, features, name):
+    pickled = Model(saved_models[name], use_cache=False).load_model()
+    artifact_path = str(tmp_path / name)
+    assert Model(saved_models[name], use_cache=False).export_model(artifact_path, features) == 0
+    exported = Model(artifact_path, use_cache=False).load_model()
+    np.testing.assert_allclose(exported.predict_proba(features), pickled.predict_proba(features),
+                               rtol=1e-9, atol=1e-12)
+
+
+def test_exported_scaler_transforms_like_the_pickle(tmp_path, saved_models, dummy_data):
+    scaler = Model(saved_models['scaler'], use_cache=False).load_model()
+    features = np.random.default_rng(0).random((100, scaler.n_features_in_))
+    exported = load_artifact(export_artifact(scaler, str(tmp_path / 'scaler')))
+    np.testing.assert_allclose(exported.transform(features), scaler.transform(features))
+
+
+def test_export_rejects_unsupported_models(tmp_path, features):
+    labels = (features[:, 0] > np.median(features[:, 0])).astype(int)
+    exponential = GradientBoostingClassifier(loss='exponential', n_estimators=5).fit(features, labels)
+    with pytest.raises(ValueError, match='log loss'):
+        export_artifact(exponential, str(tmp_path / 'exponential'))
+    with pytest.raises(ValueError, match='can not be exported'):
+        export_artifact(KNeighborsClassifier().fit(features, labels), str(tmp_path / 'neighbors'))
@@ -0,0 +1,180 @@
+"""
+The table writes are checked on the statements a fake DB-API connector records, so the MySQL statements are
+compared as text and never run against a server; only the replace mode is also run, on sqlite.
+"""
+import glob
+import os
+import re
+import sqlite3
+import pandas as pd
+import pytest
+from persist_data import DataPersister, STAGING_SUFFIX, TEMP_SUFFIX
+
+QUERIES = {'create': "CREATE TABLE IF NOT EXISTS {db}.{table} (loan_id INTEGER PRIMARY KEY, customer_tiers TEXT, "
+                     "default_probability REAL)",
+           'drop': "DROP TABLE IF EXISTS {db}.{table}",
+           'insert': "INSERT INTO `{table}` (`{columns}`) VALUES (%s, %s, %s)"}
+COLUMNS = "`loan_id`,`customer_tiers`,`default_probability`"
+INSERT = "INSERT INTO `scores` (" + COLUMNS + ") VALUES (%s, %s, %s)"
+ROW_ALIAS_UPDATES = "AS new ON DUPLICATE KEY UPDATE `loan_id`=new.`loan_id`, `customer_tiers`=new.`customer_tiers`, " \
+                    "`default_probability`=new.`default_probability`"
+VALUES_UPDATES = "ON DUPLICATE KEY UPDATE `loan_id`=VALUES(`loan_id`), `customer_tiers`=VALUES(`customer_tiers`), " \
+                 "`default_probability`=VALUES(`default_probability`)"
+# the server versions mysql.connector reports, and whether they know the row alias of INSERT ... AS new
+SERVERS = [('8.0.21', True), ('8.0.18', False), ('5.7.32-log', False), ('5.5.5-10.5.8-MariaDB', False), (None, False)]
+
+
+class RecordingCursor:
+    def __init__(self, statements):
+        self.statements = statements
+
+    def execute(self, sql, params=None):
+        # the temporary file of a LOAD DATA statement gets a new name every time
+        self.statements.append(re.sub("INFILE '[^']*'", "INFILE 'chunk.csv'", ' '.join(sql.split())))
+
+    def executemany(self, sql, rows):
+        self.statements.append(' '.join(sql.split()) + ' x' + str(len(rows)))
+
+    def close(self):
+        pass
+
+
+class RecordingConnector:
+    # a DB-API connection that records the statements instead of running them
+    def __init__(self, server_info=None):
+        self.statements = []
+        self.server_info = server_info
+
+    def get_server_info(self):
+        return self.server_info
+
+    def cursor(self):
+        return RecordingCursor(self.statements)
+
+    def commit(self):
+        self.statements.append('COMMIT')
+
+
+@pytest.fixture
+def output_data():
+    return pd.DataFrame({'loan_id': range(1, 8), 'customer_tiers': list('ABCABCA'),
+                         'default_probability': [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7]})
+
+
+@pytest.fixture
+def queries(tmp_path):
+    paths = {}
+    for name, query in QUERIES.items():
+        paths[name] = str(tmp_path / name)
+        with open(paths[name], 'w') as query_file:
+            query_file.write(query)
+    return paths
+
+
+def get_table_persister(data, queries, **params):
+    return DataPersister(data, table='scores', create_query=queries['create'], drop_query=queries['drop'],
+                         insert_query=queries['insert'], chunk_size=3, **params)
+
+
+def read_part(path, directory):
+    part = pd.read_parquet(path) if path.endswith('.parquet') else pd.read_csv(path, index_col=0)
+    # the partition columns are in the directory names (Hive layout)
+    keys = os.path.relpath(os.path.dirname(path), directory).split(os.sep)
+    return part.assign(**dict(key.split('=') for key in keys if '=' in key))
+
+
+def read_output(path):
+    if not os.path.isdir(path):
+        return pd.read_csv(path, index_col=0)
+    parts = sorted(glob.glob(os.path.join(path, '**', 'part-*'), recursive=True))
+    return pd.concat([read_part(part, path) for part in parts]).sort_values('loan_id').reset_index(drop=True)
+
+
+@pytest.mark.parametrize('file_format, compression, partition_cols', [('csv', None, None),
+                                                                      ('csv', 'gzip', None),
+                                                                      ('parquet', None, None),
+                                                                      ('parquet', 'zstd', None),
+                                                                      ('csv', None, ['customer_tiers']),
+                                                                      ('parquet', None, ['customer_tiers'])])
+def test_file_output_holds_the_data(tmp_path, output_data, file_format, compression, partition_cols):
+    persister = DataPersister(output_data, path=str(tmp_path) + os.sep, file_name='scores', chunk_size=3,
+                              file_format=file_format, compression=compression, partition_cols=partition_cols)
+    assert persister.persist() == 0
+    assert not os.path.exists(persister.get_file_path() + TEMP_SUFFIX)
+    data = read_output(persister.get_file_path())
+    pd.testing.assert_frame_equal(data[output_data.columns], output_data, check_dtype=False)
+
+
+@pytest.mark.parametrize('file_format', ['csv', 'parquet'])
+def test_appended_file_chunks_are_swapped_in_at_the_end(tmp_path, output_data, file_format):
+    params = dict(path=str(tmp_path) + os.sep, file_name='scores', chunk_size=3, file_format=file_format, swap=False)
+    first = DataPersister(output_data.iloc[:4], **params)
+    assert first.persist() == 0
+    assert not os.path.exists(first.get_file_path())
+    assert DataPersister(output_data.iloc[4:], append=True, **params).persist() == 0
+    assert first.persist_swap() == 0
+    data = read_output(first.get_file_path())
+    pd.testing.assert_frame_equal(data[output_data.columns], output_data, check_dtype=False)
+
+
+@pytest.mark.parametrize('write_mode, inserts', [('executemany', [INSERT + ' x3', 'COMMIT', INSERT + ' x3', 'COMMIT',
+                                                                  INSERT + ' x1', 'COMMIT']),
+                                                 ('row', [INSERT] * 7 + ['COMMIT'])])
+def test_replace_recreates_the_table(output_data, queries, write_mode, inserts):
+    connector = RecordingConnector()
+    assert get_table_persister(output_data, queries, db={'database': 'loans'}, connector=connector,
+                               write_mode=write_mode).persist() == 0
+    assert connector.statements == ['DROP TABLE IF EXISTS loans.scores', 'COMMIT',
+                                    QUERIES['create'].format(db='loans', table='scores'), 'COMMIT'] + inserts
+
+
+def test_swap_loads_the_staging_table_and_renames_it_in(output_data, queries):
+    connector = RecordingConnector()
+    assert get_table_persister(output_data, queries, db={'database': 'loans'}, connector=connector,
+                               persist_mode='swap').persist() == 0
+    staging = 'scores' + STAGING_SUFFIX
+    insert = INSERT.replace('`scores`', '`' + staging + '`')
+    assert connector.statements == ['DROP TABLE IF EXISTS loans.' + staging, 'COMMIT',
+                                    QUERIES['create'].format(db='loans', table=staging), 'COMMIT',
+                                    insert + ' x3', 'COMMIT', insert + ' x3', 'COMMIT', insert + ' x1', 'COMMIT',
+                                    QUERIES['create'].format(db='loans', table='scores'),
+                                    'DROP TABLE IF EXISTS loans.scores_old',
+                                    'RENAME TABLE loans.scores TO loans.scores_old, loans.' + staging +
+                                    ' TO loans.scores',
+                                    'DROP TABLE IF EXISTS loans.scores_old', 'COMMIT']
+
+
+@pytest.mark.parametrize('server_info, row_alias', SERVERS)
+def test_upsert_updates_the_rows_on_their_key(output_data, queries, server_info, row_alias):
+    connector = RecordingConnector(server_info)
+    assert get_table_persister(output_data, queries, db={'database': 'loans'}, connector=connector,
+                               persist_mode='upsert').persist() == 0
+    upsert = INSERT + ' ' + (ROW_ALIAS_UPDATES if row_alias else VALUES_UPDATES)
+    assert connector.statements == [QUERIES['create'].format(db='loans', table='scores'), 'COMMIT',
+                                    upsert + ' x3', 'COMMIT', upsert + ' x3', 'COMMIT', upsert + ' x1', 'COMMIT']
+
+
+@pytest.mark.parametrize('server_info, row_alias', SERVERS)
+def test_load_data_upserts_every_chunk_from_a_temporary_table(output_data, queries, server_info, row_alias):
+    connector = RecordingConnector(server_info)
+    assert get_table_persister(output_data, queries, db={'database': 'loans'}, connector=connector,
+                               persist_mode='upsert', write_mode='load_data').persist() == 0
+    chunk = ["DELETE FROM `scores_upsert`",
+             "LOAD DATA LOCAL INFILE 'chunk.csv' INTO TABLE `scores_upsert` FIELDS TERMINATED BY ',' "
+             "OPTIONALLY ENCLOSED BY '\"' LINES TERMINATED BY '\\n' (" + COLUMNS + ")",
+             "INSERT INTO `scores` (" + COLUMNS + ") SELECT * FROM (SELECT " + COLUMNS + " FROM `scores_upsert`) " +
+             (ROW_ALIAS_UPDATES if row_alias else "AS new " + VALUES_UPDATES), 'COMMIT']
+    assert connector.statements == [QUERIES['create'].format(db='loans', table='scores'), 'COMMIT',
+                                    "CREATE TEMPORARY TABLE IF NOT EXISTS `scores_upsert` LIKE `scores`"] + \
+        chunk * 3 + ["DROP TEMPORARY TABLE IF EXISTS `scores_upsert`"]
+
+
+def test_connector_without_db_details_saves_to_its_table(output_data, queries, tmp_path):
+    with open(queries['insert'], 'w') as query_file:
+        query_file.write("INSERT INTO `{table}` (`{columns}`) VALUES (?, ?, ?)")
+    connector = sqlite3.connect(str(tmp_path / 'scores.sqlite'))
+    assert get_table_persister(output_data, queries, connector=connector, path=str(tmp_path) + os.sep).persist() == 0
+    data = pd.read_sql_query("SELECT * FROM scores ORDER BY loan_id", connector)
+    pd.testing.assert_frame_equal(data, output_data, check_dtype=False)
+    assert not glob.glob(str(tmp_path / '*.csv'))
+    connector.close()
@@ -0,0 +1,107 @@
+import glob
+import json
+import os
+import pandas as pd
+import pytest
+from predict_default_probability import DefaultPredictor
+from prepare_input_data import REJECTED_RULES_COLUMN
+
+BAD_ROWS = {3: ('savings', 'x'), 25: ('age', 150), 47: ('gender', 'Other'), 90: ('savings', 'x'),
+            130: ('loan_id', None), 171: ('age', 7)}
+RUN_MODES = {'streaming': {'chunk_size': 30},
+             'pipelined': {'chunk_size': 30, 'pipelined': True},
+             'parquet': {'chunk_size': 30, 'output_format': 'parquet'},
+             'memory_lean': {'chunk_size': 30, 'memory_lean': True, 'compiled': True}}
+
+
+class FlakyPredictor(DefaultPredictor):
+    # fails the fail_stage stage, or the fail_persist-th persist call after writing half of its rows
+    fail_stage = None
+    fail_persist = None
+    persist_calls = 0
+
+    def run_infer(self):
+        return -1 if self.fail_stage == 'infer' else super().run_infer()
+
+    def run_get_customer_tier(self):
+        return -1 if self.fail_stage == 'customer_tier' else super().run_get_customer_tier()
+
+    def run_persist_data(self, append=False, swap=True, data=None):
+        FlakyPredictor.persist_calls += 1
+        if FlakyPredictor.persist_calls == self.fail_persist:
+            data = self.output_data if data is None else data
+            super().run_persist_data(append=append, swap=swap, data=data.iloc[:len(data) // 2])
+            return -1
+        return super().run_persist_data(append=append, swap=swap, data=data)
+
+
+@pytest.fixture
+def bad_settings(settings, dummy_data, tmp_path):
+    data = dummy_data.astype({'savings': object, 'gender': object})
+    for row, (col, value) in BAD_ROWS.items():
+        data.loc[row, col] = value
+    input_path = str(tmp_path / 'bad_dataset.csv')
+    data.to_csv(input_path, index=False)
+    return settings.replace(input_path=input_path, validation=True, checkpoint_path=str(tmp_path / 'checkpoints'))
+
+
+def run_pipeline(settings, output_name, cls=DefaultPredictor, **changes):
+    FlakyPredictor.persist_calls = 0
+    return cls.from_settings(settings, output_name=output_name, **changes).run_default_pipeline()
+
+
+def read_output(settings, output_name):
+    path = os.path.join(settings['output_path'], output_name)
+    if os.path.isdir(path):
+        parts = sorted(glob.glob(os.path.join(path, '**', '*.parquet'), recursive=True))
+        return pd.concat([pd.read_parquet(part) for part in parts], ignore_index=True)
+    return pd.read_csv(path + '.csv', index_col=0).reset_index(drop=True)
+
+
+def read_quarantine(settings, output_name):
+    return pd.read_csv(os.path.join(settings['quarantine_path'], output_name + '_rejected.csv'))
+
+
+@pytest.mark.parametrize('mode', ['whole'] + list(RUN_MODES))
+def test_invalid_rows_are_quarantined_instead_of_scored(bad_settings, tmp_path, mode):
+    metrics_path = str(tmp_path / 'run_report.json')
+    assert run_pipeline(bad_settings, 'scores', metrics_path=metrics_path, checkpoint_path=None,
+                        **RUN_MODES.get(mode, {})) == 0
+    output_data = read_output(bad_settings, 'scores')
+    quarantine = read_quarantine(bad_settings, 'scores')
+    assert len(output_data) == 200 - len(BAD_ROWS)
+    assert sorted(quarantine['customer_id']) == sorted(row + 1 for row in BAD_ROWS)
+    assert not set(quarantine['customer_id']) & set(output_data['customer_id'])
+    assert quarantine[REJECTED_RULES_COLUMN].notna().all()
+    with open(metrics_path) as report_file:
+        assert json.load(report_file)['values']['rejected_rows'] == len(BAD_ROWS)
+
+
+@pytest.mark.parametrize('fail_stage, fail_persist', [('infer', None), ('customer_tier', None), (None, 1)])
+def test_resumed_run_matches_an_uninterrupted_run(bad_settings, fail_stage, fail_persist):
+    assert run_pipeline(bad_settings, 'reference', checkpoint_path=None) == 0
+    FlakyPredictor.fail_stage, FlakyPredictor.fail_persist = fail_stage, fail_persist
+    try:
+        assert run_pipeline(bad_settings, 'resumed', FlakyPredictor) == -1
+    finally:
+        FlakyPredictor.fail_stage, FlakyPredictor.fail_persist = None, None
+    assert os.listdir(bad_settings['checkpoint_path'])
+    assert run_pipeline(bad_settings, 'resumed', FlakyPredictor, resume=True) == 0
+    assert not os.listdir(bad_settings['checkpoint_path'])
+    pd.testing.assert_frame_equal(read_output(bad_settings, 'resumed'), read_output(bad_settings, 'reference'))
+    pd.testing.assert_frame_equal(read_quarantine(bad_settings, 'resumed'), read_quarantine(bad_settings, 'reference'))
+
+
+@pytest.mark.parametrize('mode', list(RUN_MODES))
+def test_resumed_chunked_run_matches_an_uninterrupted_run(bad_settings, mode):
+    assert run_pipeline(bad_settings, 'reference', checkpoint_path=None, **RUN_MODES[mode]) == 0
+    FlakyPredictor.fail_persist = 4
+    try:
+        assert run_pipeline(bad_settings, 'resumed', FlakyPredictor, **RUN_MODES[mode]) == -1
+    finally:
+        FlakyPredictor.fail_persist = None
+    assert run_pipeline(bad_settings, 'resumed', FlakyPredictor, resume=True, **RUN_MODES[mode]) == 0
+    # only the chunks after the 3 committed ones are scored again
+    assert FlakyPredictor.persist_calls == 4
+    pd.testing.assert_frame_equal(read_output(bad_settings, 'resumed'), read_output(bad_settings, 'reference'))
+    pd.testing.assert_frame_equal(read_quarantine(bad_settings, 'resumed'), read_quarantine(bad_settings, 'reference'))
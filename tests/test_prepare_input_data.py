@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+from app_config import PipelineSettings
+from benchmark import encode_categorical_row_wise
+from prepare_input_data import CategoricalEncoder, DataPreprocessor, DataValidator, REJECTED_RULES_COLUMN
+
+BAD_ROWS = {3: ('savings', 'x', 'savings_type'),
+            10: ('age', 150, 'age_range'),
+            17: ('gender', 'Other', 'gender_category'),
+            24: ('loan_id', None, 'loan_id_null')}
+
+
+@pytest.fixture
+def categorical():
+    return PipelineSettings.from_config()['categorical']
+
+
+@pytest.fixture
+def categorical_data(dummy_data, categorical):
+    # the levels of the dummy data plus values the encoder does not know and missing values
+    data = dummy_data[categorical].astype(object)
+    data.iloc[::7] = 'unknown'
+    data.iloc[::11] = None
+    return data
+
+
+@pytest.mark.parametrize('dtype', [object, 'str', 'category'])
+def test_encoder_matches_the_row_wise_encoding(categorical_data, categorical, dtype):
+    encoder = CategoricalEncoder.from_config(categorical)
+    expected = encode_categorical_row_wise(categorical_data.copy(), encoder)
+    encoded = encoder.transform(categorical_data.astype(dtype))
+    for col in categorical:
+        np.testing.assert_array_equal(encoded[col].to_numpy(dtype=np.int64), expected[col].to_numpy(dtype=np.int64))
+
+
+@pytest.fixture
+def bad_data(dummy_data):
+    data = dummy_data.astype({'savings': object, 'gender': object})
+    for row, (col, value, _) in BAD_ROWS.items():
+        data.loc[row, col] = value
+    return data
+
+
+def test_validator_rejects_the_invalid_rows(bad_data, saved_models):
+    settings = PipelineSettings.from_config()
+    preprocessor = DataPreprocessor(data=bad_data, scaler_path=saved_models['scaler'],
+                                    identifiers=settings['identifiers'], categorical=settings['categorical'],
+                                    validator=DataValidator.from_schema(settings['create_query']))
+    transformed_data = preprocessor.prepare_data()
+    assert len(transformed_data) == len(bad_data) - len(BAD_ROWS)
+    # the rows with missing values are rejected before the invalid ones
+    rejected_data = preprocessor.rejected_data.sort_index()
+    assert rejected_data.index.tolist() == sorted(BAD_ROWS)
+    assert rejected_data[REJECTED_RULES_COLUMN].tolist() == [BAD_ROWS[row][2] for row in sorted(BAD_ROWS)]
+    assert dict(preprocessor.reject_counts) == {rule: 1 for _, _, rule in BAD_ROWS.values()}
+    assert not preprocessor.valid_rows[sorted(BAD_ROWS)].any()
+    assert preprocessor.valid_rows.sum() == len(transformed_data)
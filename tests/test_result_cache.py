@@ -0,0 +1,54 @@
+import numpy as np
+from result_cache import ResultCache, EVICT_SLACK
+
+
+def get_hashes(start, count):
+    return np.arange(start, start + count, dtype=np.int64)
+
+
+def count_entries(cache):
+    return cache.connect().execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+
+def test_versions_sharing_a_file_keep_each_others_results(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    first = ResultCache(path, 'probability', 'model-a')
+    first.put(get_hashes(0, 10), np.linspace(0, 1, 10))
+    first.close()
+    second = ResultCache(path, 'probability', 'model-b')
+    found, _ = second.get(get_hashes(0, 10))
+    assert not found.any()
+    second.put(get_hashes(0, 10), np.zeros(10))
+    second.close()
+    first = ResultCache(path, 'probability', 'model-a')
+    found, values = first.get(get_hashes(0, 10))
+    assert found.all()
+    np.testing.assert_allclose(values.astype(float), np.linspace(0, 1, 10))
+    first.close()
+
+
+def test_eviction_caps_the_entries_to_the_most_recently_used(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache.sqlite'), 'probability', 'model-a', max_entries=1000)
+    for batch in range(50):
+        cache.put(get_hashes(batch * 100, 100), np.full(100, batch / 50))
+    assert count_entries(cache) <= 1000
+    assert cache.entries >= count_entries(cache)
+    # the oldest batches were evicted, the newest ones are still served
+    assert not cache.get(get_hashes(0, 100))[0].any()
+    assert cache.get(get_hashes(4900, 100))[0].all()
+    cache.close()
+
+
+def test_entries_are_only_counted_once_the_next_puts_may_pass_the_cap(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache.sqlite'), 'probability', 'model-a', max_entries=1000)
+    cache.put(get_hashes(0, 1100), np.zeros(1100))
+    assert count_entries(cache) == int(1000 * (1 - EVICT_SLACK))
+    counts = []
+    cache.connect().set_trace_callback(lambda sql: counts.append(sql) if 'COUNT(*)' in sql else None)
+    for batch in range(10):
+        cache.put(get_hashes(2000 + batch * 10, 10), np.zeros(10))
+    # 900 entries are left after the eviction, so only the 11th put of 10 rows could pass the cap again
+    assert len(counts) == 0
+    cache.put(get_hashes(3000, 10), np.zeros(10))
+    assert len(counts) == 1
+    cache.close()
@@ -0,0 +1,32 @@
+import asyncio
+import json
+import pytest
+from scoring_service import make_handler
+
+
+async def send(request):
+    # the endpoints these requests reach do not use the service
+    server = await asyncio.start_server(make_handler(None), '127.0.0.1', 0)
+    async with server:
+        reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname()[:2])
+        writer.write(request)
+        writer.write_eof()  # the connection is kept alive until the client is done
+        await writer.drain()
+        response = await reader.read()
+        writer.close()
+    status_line, _, body = response.partition(b'\r\n\r\n')
+    return int(status_line.split(b' ')[1]), json.loads(body)
+
+
+@pytest.mark.parametrize('request_line, headers', [(b'GARBAGE\r\n', b''),
+                                                   (b'GET /health HTTP/1.1\r\n', b'no colon here\r\n'),
+                                                   (b'POST /score HTTP/1.1\r\n', b'Content-Length: ten\r\n')])
+def test_malformed_request_gets_a_bad_request_response(request_line, headers):
+    status, payload = asyncio.run(send(request_line + headers + b'\r\n'))
+    assert status == 400
+    assert payload['error'].startswith('Malformed request')
+
+
+def test_well_formed_request_is_answered():
+    status, payload = asyncio.run(send(b'GET /health HTTP/1.1\r\nHost: localhost\r\n\r\n'))
+    assert (status, payload) == (200, {'status': 'ok'})